@@ -5,10 +5,12 @@ import json
 from train_rl import parse_args as webenv_args
 from env import WebEnv  # TODO: just use webshopEnv?
 import torch
+from web_agent_site.engine.features import load_feature_store
 from models.custom_qformer import QFormerConfigForWebshop, QFormerModelForWebshop
 from PIL import Image
 import torch
 from train_choice_il_qformer import *
+from image_cache import open_image_cache
 from transformers import BartForConditionalGeneration, BartTokenizer
 from tqdm import tqdm
 from functools import partial
@@ -76,31 +78,19 @@ Action: click[Buy Now]
 """
 
 FEAT_CONV = '/home/haoyang/webshop/data/feat_conv.pt'
-feat_conv = torch.load(FEAT_CONV)
+# Memory-mapped image features, converted from FEAT_CONV on first use
+feat_conv = load_feature_store(feat_conv=FEAT_CONV)
 cache = {"asin2name": None, "name2asin": None}
-DEFAULT_FILE_PATH = "../data/items_shuffle.json"
-# We want to map image url to its product ASIN because in WebEnv we only have the URL
-# and we need ASIN to access downloaded images
-url2asin = {}
-f = open(DEFAULT_FILE_PATH, 'r')
-data = json.load(f)
-for d in data:
-    if ('product_information' not in d) or ('images' not in d) or ('asin' not in d):
-        continue
-    url = d['images'][0]
-    if len(url) == 0 and len(d['images']) > 1:
-        url = d['images'][1]
-    url2asin[url] = d['asin'].upper()
-data = None # save RAM
-f.close()
 args = webenv_args()[0]
-env = WebEnv(args, split='test', feat_conv=feat_conv, cache=cache, url2asin=url2asin)
+env = WebEnv(args, split='test', feat_conv=feat_conv, cache=cache)
 print('env loaded')
 
 # load Model
 bart_tokenizer = BartTokenizer.from_pretrained('facebook/bart-large')
 image_processor = Blip2ImageEvalProcessor.from_config({'name': 'blip2_image_eval', 'image_size': 224})
-my_data_collator = partial(data_collator, image_processor=image_processor)
+# Preprocessed product images (see image_cache.py), decoded from IMAGE_PATH when missing
+image_cache = open_image_cache()
+my_data_collator = partial(data_collator, image_processor=image_processor, image_cache=image_cache)
 
 
 def parse_args():
@@ -167,10 +157,13 @@ def predict_v(obs, info, model, prompt, idx, softmax=False, rule=False, bart_mod
     actions = list(map(process, valid_acts))
     raw_image_asin = info.get('raw_image').upper()
 
-    eval_processor = Blip2ImageEvalProcessor.from_config({'name': 'blip2_image_eval', 'image_size': 224})
+    eval_processor = image_processor
+    cached = image_cache.get(raw_image_asin) if image_cache is not None and raw_image_asin != "NONE" else None
     if raw_image_asin == "NONE":
         print("No image")
         image = eval_processor(Image.new('RGB', (224, 224), (255, 255, 255))).unsqueeze(0).cuda()
+    elif cached is not None:
+        image = cached.unsqueeze(0).cuda()
     else:
         try:
             pil_image = Image.open(os.path.join(IMAGE_PATH, raw_image_asin + ".jpg"))
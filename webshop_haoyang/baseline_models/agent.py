@@ -118,11 +118,14 @@ class Agent:
     
 
     def update(self, transitions, last_values, step=None, rewards_invdy=None):
-        returns, advs = discount_reward(transitions, last_values, self.gamma)
+        returns, _ = discount_reward(transitions, last_values, self.gamma)
         stats_global = defaultdict(float)
-        for transition, adv in zip(transitions, advs):
+        for transition, ret in zip(transitions, returns):
             stats = {}
-            log_valid, valid_sizes = self.network.rl_forward(transition.state, transition.valid_acts)
+            # `act` runs without grad, so the value head is trained on values from
+            # this pass, which shares its state encoding with the action logits
+            log_valid, valid_sizes, state_values = self.network.rl_forward(transition.state, transition.valid_acts, value=True)
+            adv = ret - state_values
             act_values = log_valid.split(valid_sizes)
             log_a = torch.stack([values[acts.index(act)]
                                         for values, acts, act in zip(act_values, transition.valid_acts, transition.act)])
@@ -135,7 +138,7 @@ class Agent:
                 stats[k] = self.w[k] * stats[k] / len(transitions)
             stats['loss'] = sum(stats[k] for k in stats)
             stats['returns'] = torch.stack(returns).mean() / len(transitions)
-            stats['advs'] = torch.stack(advs).mean() / len(transitions)
+            stats['advs'] = adv.mean() / len(transitions)
             stats['loss'].backward()
 
             # Compute the gradient norm
@@ -6,6 +6,7 @@ import torch.nn.functional as F
 from transformers import AutoTokenizer
 from collections import defaultdict, namedtuple
 from models.custom_qformer import QFormerConfigForWebshop, QFormerModelForWebshop, QFormerFrozenModelForWebshop
+from qformer_cache import open_qformer_cache
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -37,7 +38,9 @@ class Agent:
         embedding_dim = args.embedding_dim
 
         # network
-        config = QFormerConfigForWebshop(image=True)
+        # Frozen Q-Former: read image embeddings from --qformer_cache instead of loading BLIP-2
+        self.qformer_cache = open_qformer_cache(getattr(args, 'qformer_cache', '')) if freeze_qformer else None
+        config = QFormerConfigForWebshop(image=True, cached_image_emb=self.qformer_cache is not None)
         if freeze_qformer:
             self.network = QFormerFrozenModelForWebshop(config, token_embed_size=len(self.tokenizer))
         else:
@@ -65,13 +68,17 @@ class Agent:
         goal_str = info['goal']
         # image_feat = info.get('image_feat')
         raw_image = info.get('raw_image')
-        assert self.image_processor is not None
-        if raw_image is None:
-            image_tensor = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
+        if self.qformer_cache is not None:
+            # (1, 32, 768) cached Q-Former embeddings, the blank image's if there is none
+            image_tensor = self.qformer_cache.get(raw_image).unsqueeze(0)
         else:
-            image_tensor = self.image_processor(raw_image, return_tensors="pt")['pixel_values'] # [0]
-        if len(image_tensor.shape) == 3:
-            image_tensor = torch.unsqueeze(image_tensor, dim=0)
+            assert self.image_processor is not None
+            if raw_image is None:
+                image_tensor = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
+            else:
+                image_tensor = self.image_processor(raw_image, return_tensors="pt")['pixel_values'] # [0]
+            if len(image_tensor.shape) == 3:
+                image_tensor = torch.unsqueeze(image_tensor, dim=0)
         return State(obs_ids, goal_ids, click, estimate, obs_str, goal_str, image_tensor)
 
 
@@ -125,11 +132,14 @@ class Agent:
     
 
     def update(self, transitions, last_values, step=None, rewards_invdy=None):
-        returns, advs = discount_reward(transitions, last_values, self.gamma)
+        returns, _ = discount_reward(transitions, last_values, self.gamma)
         stats_global = defaultdict(float)
-        for transition, adv in zip(transitions, advs):
+        for transition, ret in zip(transitions, returns):
             stats = {}
-            log_valid, valid_sizes = self.network.rl_forward(transition.state, transition.valid_acts)
+            # `act` runs without grad, so the value head is trained on values from
+            # this pass, which shares its state encoding with the action logits
+            log_valid, valid_sizes, state_values = self.network.rl_forward(transition.state, transition.valid_acts, value=True)
+            adv = ret - state_values
             act_values = log_valid.split(valid_sizes)
             log_a = torch.stack([values[acts.index(act)]
                                         for values, acts, act in zip(act_values, transition.valid_acts, transition.act)])
@@ -142,7 +152,7 @@ class Agent:
                 stats[k] = self.w[k] * stats[k] / len(transitions)
             stats['loss'] = sum(stats[k] for k in stats)
             stats['returns'] = torch.stack(returns).mean() / len(transitions)
-            stats['advs'] = torch.stack(advs).mean() / len(transitions)
+            stats['advs'] = adv.mean() / len(transitions)
             stats['loss'].backward()
 
             # Compute the gradient norm
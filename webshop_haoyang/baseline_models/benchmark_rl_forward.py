@@ -0,0 +1,77 @@
+"""
+Benchmark of `rl_forward` on one step of `num_envs` states.
+
+Compares the batched call with one call per state (how `rl_forward` used to
+run) on a randomly initialized BERT-base `BertModelForWebshop`, for
+observations of random length and up to 10 valid actions per state:
+
+    python benchmark_rl_forward.py --num_envs 4 16 64 --device cpu
+"""
+import argparse
+import random
+import time
+
+import torch
+from transformers import BertConfig
+
+from agent import State
+from models.bert import BertConfigForWebshop, BertModelForWebshop
+
+
+def random_ids(length):
+    return [101] + [random.randint(1000, 30000) for _ in range(length - 2)] + [102]
+
+
+def random_step(num_envs, min_len, max_len, num_acts=10):
+    """States and valid action ids of `num_envs` envs"""
+    states, act_batch = [], []
+    for _ in range(num_envs):
+        obs = random_ids(random.randint(min_len, max_len))
+        states.append(State(obs, None, True, 0.0, '', '', None))
+        act_batch.append([random_ids(random.randint(4, 24)) for _ in range(random.randint(2, num_acts))])
+    return states, act_batch
+
+
+def timed(fn, repeat):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time batched vs per-state rl_forward')
+    parser.add_argument('--num_envs', default=[4, 16, 64], type=int, nargs='+')
+    parser.add_argument('--min_len', default=64, type=int, help='Shortest observation in tokens')
+    parser.add_argument('--max_len', default=512, type=int, help='Longest observation in tokens')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    config = BertConfigForWebshop(pretrained_bert=False, **BertConfig().to_dict())
+    model = BertModelForWebshop(config).to(args.device).eval()
+
+    for num_envs in args.num_envs:
+        states, act_batch = random_step(num_envs, args.min_len, args.max_len)
+
+        def per_state():
+            return [model.rl_forward([s], [a], value=True, act=True) for s, a in zip(states, act_batch)]
+
+        def batched():
+            return model.rl_forward(states, act_batch, value=True, act=True)
+
+        with torch.no_grad():
+            reference = per_state()
+            act_values, act_sizes, values = batched()
+            assert act_sizes == [len(a) for a in act_batch]
+            assert torch.allclose(act_values, torch.cat([r[0] for r in reference]), atol=1e-4)
+            assert torch.allclose(values, torch.cat([r[2] for r in reference]), atol=1e-4)
+            # Forward cost only, no activations are kept for backward
+            t_loop = timed(per_state, args.repeat)
+            t_batch = timed(batched, args.repeat)
+        print(f'num_envs={num_envs:3d}  per-state {t_loop * 1000:8.1f} ms  '
+              f'batched {t_batch * 1000:8.1f} ms  speedup {t_loop / t_batch:.2f}x')
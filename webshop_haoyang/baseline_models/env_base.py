@@ -56,6 +56,10 @@ class WebEnv:
         self.get_image = args.get_image
         self.item_rank = -1
         self.reduce_click = 1
+        # Valid actions of the current page, computed once per page transition
+        self.valid_actions = None
+        # Last score and its (goal, asin, options) key, see `score`
+        self.score_key = self.score_value = None
 
         if args.extra_search_path != "":
             self.extra_search = json.load(open(args.extra_search_path))
@@ -78,7 +82,16 @@ class WebEnv:
                 [f'{att} {query}' for att in atts] + [inst.lower()]
         return texts
 
+    def new_page(self):
+        """Drop the valid actions of the previous page after a step or reset"""
+        self.valid_actions = None
+
     def get_valid_actions(self):
+        if self.valid_actions is None:
+            self.valid_actions = self._get_valid_actions()
+        return list(self.valid_actions)
+
+    def _get_valid_actions(self):
         valid_info = self.env.get_available_actions()
         if valid_info['has_search_bar']:  # only search action available
             atts = self.session['goal']['attributes']
@@ -114,11 +127,15 @@ class WebEnv:
         valid_acts = self.get_valid_actions()
         if 'click[description]' not in valid_acts:
             return 0.0
-        product = self.env.server.product_item_dict[self.session["asin"]]
         goal = self.session['goal']
-        price = self.env.server.product_prices.get(self.session["asin"])
         options = self.session['options']
-        return get_reward(product, goal, price, options)
+        # The score only changes when the item or its options do
+        key = (goal['asin'], goal['instruction_text'], self.session["asin"], tuple(sorted(options.items())))
+        if key != self.score_key:
+            product = self.env.server.product_item_dict[self.session["asin"]]
+            price = self.env.server.product_prices.get(self.session["asin"])
+            self.score_key, self.score_value = key, get_reward(product, goal, price, options)
+        return self.score_value
 
     def estimate_score(self, atts, opts, verify=False):
         """
@@ -126,11 +143,11 @@ class WebEnv:
         """
         valid_acts = self.get_valid_actions()
         assert 'click[description]' in valid_acts
-        # estimate r_att
-        desc = self.step('click[description]')[0].lower()
-        self.step('click[< prev]')
-        feat = self.step('click[features]')[0].lower()
-        ob = self.step('click[< prev]')[0].lower()
+        # estimate r_att from the product text, without visiting its pages
+        product = self.env.server.product_item_dict[self.session['asin']]
+        desc = (product.get('Description') or '').lower()
+        feat = '\n'.join(product.get('BulletPoints') or []).lower()
+        ob = self.cur_ob.lower()
         n_att = 0
         for att in atts:
             if att in desc or att in feat or att in ob:
@@ -159,13 +176,14 @@ class WebEnv:
             action = f'click[{self.name2asin[action[13:-1]]}]'
 
         ob, reward, done, info = self.env.step(action)
+        self.new_page()
 
         if action.startswith('click[') and action[6:-1] in self.asin2name:
             self.items_clicked[action[6:-1]] += 1
-            desc = self.env.step('click[description]')[0].lower()
-            self.env.step('click[< prev]')
-            feat = self.env.step('click[features]')[0].lower()
-            self.env.step('click[< prev]')
+            # Read the description/features pages' content instead of visiting them
+            product = self.env.server.product_item_dict[self.session['asin']]
+            desc = (product.get('Description') or '').lower()
+            feat = '\n'.join(product.get('BulletPoints') or []).lower()
         else:
             desc = feat = ''
         r_visit = 0.0
@@ -213,6 +231,7 @@ class WebEnv:
         if idx is None:
             idx = random.sample(self.goal_idxs, k=1)[0]
         ob, info = self.env.reset(idx)
+        self.new_page()
         self.session = self.env.server.user_sessions[self.env.session]
         if info is None:
             info = {}
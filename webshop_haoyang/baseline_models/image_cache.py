@@ -0,0 +1,144 @@
+"""
+Preprocessed product image cache for the Q-Former / BLIP-2 pipelines.
+
+The collators and inference used to decode `IMAGE_PATH/<ASIN>.jpg` and run the
+BLIP-2 image processor on every sample of every epoch. A one-time pass
+
+    python image_cache.py --image_path ../all_images --out ../data/image_cache
+
+resizes every image to 3 x 224 x 224 (bicubic, as both BLIP-2 processors do)
+and stores the uint8 pixels in a memory-mapped array keyed by ASIN:
+
+    pixels.npy  -- uint8 (N, 3, 224, 224), rows in ASIN order
+    asins.npy   -- sorted |S10 ASIN of each row
+
+`ImageCache.get` gathers a row and applies the processors' rescale +
+normalize, which gives the same tensor as the processor on the original JPEG.
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_CACHE_PATH = "../data/image_cache"
+IMAGE_SIZE = 224
+# OpenAI CLIP statistics, used by `Blip2Processor` and minigpt4's `Blip2ImageEvalProcessor`
+IMAGE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+IMAGE_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def load_pixels(path, image_size=IMAGE_SIZE):
+    """Resized RGB pixels of an image as uint8 (3, H, W), or `None` if it cannot be read"""
+    try:
+        image = Image.open(path).convert('RGB')
+    except (OSError, ValueError):
+        return None
+    image = image.resize((image_size, image_size), resample=Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8).transpose(2, 0, 1)
+
+
+def build_image_cache(image_path, out_dir, asins=None, image_size=IMAGE_SIZE, workers=None):
+    """
+    Decode and resize product images once into a memory-mapped array.
+
+    Arguments:
+    image_path (`str`) -- directory of `<ASIN>.jpg` images
+    out_dir (`str`) -- cache directory, created if missing
+    asins (`list`) -- ASINs to cache (default: every image in `image_path`)
+    workers (`int`) -- decoding processes (default: all cores)
+    """
+    if asins is None:
+        asins = [name[:-4] for name in os.listdir(image_path) if name.endswith('.jpg')]
+    asins = sorted({asin.upper() for asin in asins})
+    paths = [os.path.join(image_path, asin + '.jpg') for asin in asins]
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(out_dir, 'asins.npy')):
+        os.remove(os.path.join(out_dir, 'asins.npy'))
+
+    pixels = np.lib.format.open_memmap(
+        os.path.join(out_dir, 'pixels.npy.tmp'), mode='w+', dtype=np.uint8,
+        shape=(len(asins), 3, image_size, image_size),
+    )
+    found = np.zeros(len(asins), dtype=bool)
+    with Pool(workers) as pool:
+        for row, image in enumerate(pool.imap(load_pixels, paths, chunksize=64)):
+            if image is not None:
+                pixels[row] = image
+                found[row] = True
+    pixels.flush()
+    del pixels
+
+    # Unreadable images are left out, so their ASINs miss the cache as before
+    if not found.all():
+        full = np.load(os.path.join(out_dir, 'pixels.npy.tmp'), mmap_mode='r')
+        np.save(os.path.join(out_dir, 'pixels.npy'), full[found])
+        del full
+        os.remove(os.path.join(out_dir, 'pixels.npy.tmp'))
+    else:
+        os.replace(os.path.join(out_dir, 'pixels.npy.tmp'), os.path.join(out_dir, 'pixels.npy'))
+    # Written last so a partially written cache is never picked up
+    np.save(os.path.join(out_dir, 'asins.npy'), np.array(asins, dtype='S10')[found])
+    return int(found.sum())
+
+
+def open_image_cache(cache_dir=IMAGE_CACHE_PATH):
+    """`ImageCache` of `cache_dir`, or `None` if it has not been built"""
+    if not os.path.exists(os.path.join(cache_dir, 'asins.npy')):
+        return None
+    return ImageCache(cache_dir)
+
+
+class ImageCache:
+    """Preprocessed images looked up by ASIN"""
+    def __init__(self, cache_dir, mean=IMAGE_MEAN, std=IMAGE_STD):
+        self.cache_dir = cache_dir
+        # Copy-on-write mapping, so torch can wrap rows without a warning
+        self.pixels = np.load(os.path.join(cache_dir, 'pixels.npy'), mmap_mode='c')
+        self.asins = np.load(os.path.join(cache_dir, 'asins.npy'), mmap_mode='r')
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+
+    def __getstate__(self):
+        # DataLoader workers map the files again instead of receiving a copy
+        return {'cache_dir': self.cache_dir, 'mean': self.mean.flatten().tolist(), 'std': self.std.flatten().tolist()}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'], state['mean'], state['std'])
+
+    def __len__(self):
+        return len(self.asins)
+
+    def __contains__(self, asin):
+        return self.row(asin) is not None
+
+    def row(self, asin):
+        key = asin.upper().encode('ascii', errors='ignore')
+        i = int(np.searchsorted(self.asins, key))
+        if i < len(self.asins) and self.asins[i] == key:
+            return i
+        return None
+
+    def get(self, asin):
+        """Normalized float32 (3, 224, 224) pixels of `asin`, or `None` if it is not cached"""
+        row = self.row(asin)
+        if row is None:
+            return None
+        return self.at(row)
+
+    def at(self, row):
+        """Normalized pixels of the image in `row`"""
+        pixels = torch.from_numpy(self.pixels[row]).float().div_(255)
+        return pixels.sub_(self.mean).div_(self.std)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preprocess product images into a memory-mapped cache')
+    parser.add_argument('--image_path', default="../all_images", help='Directory of <ASIN>.jpg images')
+    parser.add_argument('--out', default=IMAGE_CACHE_PATH, help='Cache directory')
+    parser.add_argument('--workers', default=None, type=int)
+    args = parser.parse_args()
+    n = build_image_cache(args.image_path, args.out, workers=args.workers)
+    print(f'Cached {n} images in {args.out}')
@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -8,7 +11,13 @@ from transformers import (
     PreTrainedModel,
 )
 from transformers.modeling_outputs import SequenceClassifierOutput
-from .modules import EncoderRNN, BiAttention, get_aggregated
+from .modules import EncoderRNN, BiAttention, get_aggregated, rl_batches
+
+
+@dataclass
+class SequenceClassifierOutputWithValues(SequenceClassifierOutput):
+    """`SequenceClassifierOutput` plus the state values of `forward(..., value=True)`"""
+    values: Optional[torch.FloatTensor] = None
 
 
 class BertConfigForWebshop(PretrainedConfig):
@@ -60,10 +69,12 @@ class BertModelForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         if images is not None and self.image_linear is not None:
             images = self.image_linear(images)
             state_rep = torch.cat([images.unsqueeze(1), state_rep], dim=1)
@@ -83,41 +94,37 @@ class BertModelForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -156,10 +163,12 @@ class BertLargeForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         if images is not None and self.image_linear is not None:
             images = self.image_linear(images)
             state_rep = torch.cat([images.unsqueeze(1), state_rep], dim=1)
@@ -179,41 +188,37 @@ class BertLargeForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
\ No newline at end of file
@@ -9,10 +9,10 @@ from transformers import (
 )
 from transformers.modeling_outputs import SequenceClassifierOutput
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
-from .modules import EncoderRNN, BiAttention, get_aggregated
+from .modules import EncoderRNN, BiAttention, get_aggregated, rl_batches
 from transformers import T5Tokenizer, T5ForConditionalGeneration
 from transformers import RobertaTokenizer, RobertaModel, RobertaConfig# , RwkvConfig, RwkvModel
-from .bert import BertConfigForWebshop
+from .bert import BertConfigForWebshop, SequenceClassifierOutputWithValues
 
 class T5SmallForWebshop(PreTrainedModel):
 
@@ -37,10 +37,12 @@ class T5SmallForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         if images is not None and self.image_linear is not None:
             images = self.image_linear(images)
             state_rep = torch.cat([images.unsqueeze(1), state_rep], dim=1)
@@ -60,41 +62,37 @@ class T5SmallForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -123,10 +121,12 @@ class T5BaseForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         if images is not None and self.image_linear is not None:
             images = self.image_linear(images)
             state_rep = torch.cat([images.unsqueeze(1), state_rep], dim=1)
@@ -146,41 +146,37 @@ class T5BaseForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -209,10 +205,12 @@ class T5LargeForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         if images is not None and self.image_linear is not None:
             images = self.image_linear(images)
             state_rep = torch.cat([images.unsqueeze(1), state_rep], dim=1)
@@ -232,41 +230,37 @@ class T5LargeForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -296,11 +290,13 @@ class FlanT5SmallForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         # print(state_rep.shape)
         
         if images is not None and self.image_linear is not None:
@@ -322,41 +318,37 @@ class FlanT5SmallForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -403,11 +395,13 @@ class FlanT5BaseForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         # print(state_rep.shape)
         
         if images is not None and self.image_linear is not None:
@@ -429,41 +423,37 @@ class FlanT5BaseForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -493,11 +483,13 @@ class FlanT5LargeForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
         state_rep = self.t5.encoder(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         # print(state_rep.shape)
         
         if images is not None and self.image_linear is not None:
@@ -519,41 +511,37 @@ class FlanT5LargeForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -601,11 +589,13 @@ class RobertaBaseForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         # print(state_rep.shape)
         
         if images is not None and self.image_linear is not None:
@@ -627,41 +617,37 @@ class RobertaBaseForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -694,11 +680,13 @@ class RobertaLargeForWebshop(PreTrainedModel):
                 nn.Linear(128, 1),
             )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
         sizes = sizes.tolist()
         # print(state_input_ids.shape, action_input_ids.shape)
         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         # print(state_rep.shape)
         
         if images is not None and self.image_linear is not None:
@@ -720,41 +708,37 @@ class RobertaLargeForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
 
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
                 if self.image_linear is not None:
-                    images = [state.image_feat]
-                    images = [torch.zeros(512) if _ is None else _ for _ in images] 
-                    images = torch.stack(images).cuda()  # BS x 512
+                    images = [state_batch[i].image_feat for i in idxs]
+                    images = [torch.zeros(512) if _ is None else _ for _ in images]
+                    images = torch.stack(images).to(self.device)  # BS x 512
                 else:
                     images = None
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, images=images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -787,7 +771,7 @@ class RobertaLargeForWebshop(PreTrainedModel):
 #                 nn.Linear(128, 1),
 #             )
 
-#     def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None):
+#     def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, images=None, labels=None, value=False):
 #         sizes = sizes.tolist()
 #         # print(state_input_ids.shape, action_input_ids.shape)
 #         # state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
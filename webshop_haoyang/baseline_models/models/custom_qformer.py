@@ -8,7 +8,8 @@ from transformers import (
     PreTrainedModel,
 )
 from transformers.modeling_outputs import SequenceClassifierOutput
-from .modules import EncoderRNN, BiAttention, get_aggregated
+from .modules import EncoderRNN, BiAttention, get_aggregated, rl_batches
+from .bert import SequenceClassifierOutputWithValues
 from transformers import Blip2ForConditionalGeneration, AutoProcessor, AutoTokenizer, Blip2Model, BlipModel, BlipTextModel
 from PIL import Image
 
@@ -19,10 +20,14 @@ class QFormerConfigForWebshop(PretrainedConfig):
         self,
         pretrained_blip=True,
         image=False,
+        cached_image_emb=False,
         **kwargs
     ):
         self.pretrained_blip = pretrained_blip
         self.image = image
+        # Frozen model only: take Q-Former embeddings from `qformer_cache.py`
+        # instead of pixels, without loading BLIP-2
+        self.cached_image_emb = cached_image_emb
         super().__init__(**kwargs)
 
 
@@ -57,16 +62,18 @@ class QFormerModelForWebshop(PreTrainedModel):
             nn.Linear(128, 1),
         )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, raw_images, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, raw_images, labels=None, value=False):
         sizes = sizes.tolist()
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
         image_emb = self.blip.get_qformer_features(pixel_values=raw_images).last_hidden_state
         image_emb = self.proj_layer(image_emb)
         # print(state_rep.shape)
         # print(image_emb.shape)
 
         state_rep = torch.cat([image_emb, state_rep], dim=1)
-        image_emb_mask = torch.ones(state_attention_mask.shape[0], self.image_emb_seqlen).cuda()
+        image_emb_mask = torch.ones(state_attention_mask.shape[0], self.image_emb_seqlen, device=state_attention_mask.device)
         state_attention_mask = torch.cat([image_emb_mask, state_attention_mask], dim=1)
 
         assert state_attention_mask.shape[1] == state_rep.shape[1]
@@ -86,9 +93,10 @@ class QFormerModelForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
     
     # Expected shapes of forward():
@@ -100,31 +108,25 @@ class QFormerModelForWebshop(PreTrainedModel):
     
     # Adapted from BERT RL
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
-                raw_images = state.raw_image.cuda()
-
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, raw_images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                raw_images = torch.cat([state_batch[i].raw_image for i in idxs], dim=0).to(self.device)
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, raw_images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
@@ -136,12 +138,15 @@ class QFormerFrozenModelForWebshop(PreTrainedModel):
 
     def __init__(self, config, token_embed_size=30526, embedding_dimension = 2560, blip1 = False):
         super().__init__(config)
-        self.blip = Blip2Model.from_pretrained("Salesforce/blip2-opt-2.7b")
-        self.blip.language_model = None # save GPU memory
-        for param in self.blip.vision_model.parameters(): # freeze ViT in BLIP-2
-            param.requires_grad = False
-        for param in self.blip.qformer.parameters():
-            param.requires_grad = False
+        if getattr(config, 'cached_image_emb', False):
+            self.blip = None # image embeddings come precomputed
+        else:
+            self.blip = Blip2Model.from_pretrained("Salesforce/blip2-opt-2.7b")
+            self.blip.language_model = None # save GPU memory
+            for param in self.blip.vision_model.parameters(): # freeze ViT in BLIP-2
+                param.requires_grad = False
+            for param in self.blip.qformer.parameters():
+                param.requires_grad = False
         self.proj_layer = nn.Linear(768, 768) # hidden_dims of both qformer and bert are 768
         
         bert_config = BertConfig.from_pretrained('bert-base-uncased')
@@ -163,16 +168,18 @@ class QFormerFrozenModelForWebshop(PreTrainedModel):
             nn.Linear(128, 1),
         )
 
-    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, raw_images, labels=None):
+    def forward(self, state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, sizes, raw_images, labels=None, value=False):
         sizes = sizes.tolist()
         state_rep = self.bert(state_input_ids, attention_mask=state_attention_mask)[0]
-        image_emb = self.blip.get_qformer_features(pixel_values=raw_images).last_hidden_state
+        # State value from the same encoding, for `rl_forward`
+        values = self.linear_3(state_rep[:, 0]).squeeze(1) if value else None
+        image_emb = self.image_embeddings(raw_images)
         image_emb = self.proj_layer(image_emb)
         # print(state_rep.shape)
         # print(image_emb.shape)
 
         state_rep = torch.cat([image_emb, state_rep], dim=1)
-        image_emb_mask = torch.ones(state_attention_mask.shape[0], self.image_emb_seqlen).cuda()
+        image_emb_mask = torch.ones(state_attention_mask.shape[0], self.image_emb_seqlen, device=state_attention_mask.device)
         state_attention_mask = torch.cat([image_emb_mask, state_attention_mask], dim=1)
 
         assert state_attention_mask.shape[1] == state_rep.shape[1]
@@ -192,45 +199,47 @@ class QFormerFrozenModelForWebshop(PreTrainedModel):
         if labels is not None:
             loss = - sum([logit[label] for logit, label in zip(logits, labels)]) / len(logits)
         
-        return SequenceClassifierOutput(
+        return SequenceClassifierOutputWithValues(
             loss=loss,
             logits=logits,
+            values=values,
         )
     
+    def image_embeddings(self, raw_images):
+        """Frozen Q-Former output for pixels (B, 3, 224, 224); cached embeddings (B, 32, 768) pass through"""
+        if raw_images.dim() == 3:
+            return raw_images
+        with torch.no_grad():
+            return self.blip.get_qformer_features(pixel_values=raw_images).last_hidden_state
+
     # Expected shapes of forward():
     # Shape of state_input_ids: torch.Size([1, 512])
     # Shape of state_attention_mask: torch.Size([1, 512])
     # Shape of action_input_ids: torch.Size([12, 52])
     # Shape of action_attention_mask: torch.Size([12, 52])
-    # Shape of raw_images: torch.Size([1, 3, 224, 224])
+    # Shape of raw_images: torch.Size([1, 3, 224, 224]), or torch.Size([1, 32, 768]) if cached
     
     # Adapted from BERT RL
     def rl_forward(self, state_batch, act_batch, value=False, q=False, act=False):
-        act_values = []
-        act_sizes = []
-        values = []
-        for state, valid_acts in zip(state_batch, act_batch):
+        act_values = [None] * len(state_batch)
+        act_sizes = [len(valid_acts) for valid_acts in act_batch]
+        values = [None] * len(state_batch)
+        # One encoder call per group of similar-length states, see `rl_batches`
+        for idxs, state_ids, state_mask, act_ids, act_mask, act_size in rl_batches(state_batch, act_batch, self.device):
             with torch.set_grad_enabled(not act):
-                state_ids = torch.tensor([state.obs]).cuda()
-                state_mask = (state_ids > 0).int()
-                act_lens = [len(_) for _ in valid_acts]
-                act_ids = [torch.tensor(_) for _ in valid_acts]
-                act_ids = nn.utils.rnn.pad_sequence(act_ids, batch_first=True).cuda()
-                act_mask = (act_ids > 0).int()
-                act_size = torch.tensor([len(valid_acts)]).cuda()
-                raw_images = state.raw_image.cuda()
-
-                logits = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, raw_images).logits[0]
-                act_values.append(logits)
-                act_sizes.append(len(valid_acts))
+                raw_images = torch.cat([state_batch[i].raw_image for i in idxs], dim=0).to(self.device)
+                # Action logits and state values share one encoder pass
+                output = self.forward(state_ids, state_mask, act_ids, act_mask, act_size, raw_images, value=value)
+            for i, logit in zip(idxs, output.logits):
+                act_values[i] = logit
             if value:
-                v = self.bert(state_ids, state_mask)[0]
-                values.append(self.linear_3(v[0][0]))
+                for i, v in zip(idxs, output.values):
+                    values[i] = v
         act_values = torch.cat(act_values, dim=0)
         act_values = torch.cat([F.log_softmax(_, dim=0) for _ in act_values.split(act_sizes)], dim=0)
         # Optionally, output state value prediction
         if value:
-            values = torch.cat(values, dim=0)
+            values = torch.stack(values)
             return act_values, act_sizes, values
         else:
             return act_values, act_sizes
\ No newline at end of file
@@ -28,6 +28,55 @@ def get_aggregated(output, lens, method):
         return output[:, 0, :]
 
 
+# On CPU, batching long observations costs more in attention memory traffic than
+# it saves; states are grouped by length and groups are capped at this many
+# padded state tokens there
+CPU_BATCH_TOKENS = 1024
+
+
+def length_buckets(lengths, max_padding=0.1, max_tokens=None):
+    """
+    Split indices into groups of similar length, so padding a group to its
+    longest member adds at most `max_padding` times its real tokens, and
+    (if given) the padded group has at most `max_tokens` tokens.
+    """
+    buckets, bucket, total = [], [], 0
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Ascending lengths: lengths[i] is the padded length if i joins the bucket
+        padded = lengths[i] * (len(bucket) + 1)
+        if bucket and (padded > (1 + max_padding) * (total + lengths[i]) or
+                       max_tokens is not None and padded > max_tokens):
+            buckets.append(bucket)
+            bucket, total = [], 0
+        bucket.append(i)
+        total += lengths[i]
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def rl_batches(state_batch, act_batch, device, max_padding=0.1):
+    """
+    Padded inputs of `rl_forward`, so the encoders run on all states at once
+    instead of once per state. On GPU that is a single batch padded to the
+    longest observation; on CPU, groups of similar observation length (see
+    `length_buckets`).
+    Yields (indices, state ids/mask (B x L), action ids/mask (sum(sizes) x L'), sizes (B)).
+    """
+    if torch.device(device).type == 'cpu':
+        groups = length_buckets([len(state.obs) for state in state_batch], max_padding, CPU_BATCH_TOKENS)
+    else:
+        groups = [list(range(len(state_batch)))] if state_batch else []
+    for idxs in groups:
+        state_ids = rnn.pad_sequence([torch.tensor(state_batch[i].obs) for i in idxs], batch_first=True).to(device)
+        state_mask = (state_ids > 0).int()
+        act_ids = [torch.tensor(act) for i in idxs for act in act_batch[i]]
+        act_ids = rnn.pad_sequence(act_ids, batch_first=True).to(device)
+        act_mask = (act_ids > 0).int()
+        sizes = torch.tensor([len(act_batch[i]) for i in idxs]).to(device)
+        yield idxs, state_ids, state_mask, act_ids, act_mask, sizes
+
+
 class EncoderRNN(nn.Module):
     def __init__(self, input_size, num_units, nlayers, concat,
                  bidir, layernorm, return_last):
@@ -0,0 +1,121 @@
+"""
+Precomputed frozen Q-Former embeddings for `QFormerFrozenModelForWebshop`.
+
+The frozen model reruns BLIP-2's vision tower and Q-Former on the same product
+images every epoch. A one-time pass over the preprocessed image cache (see
+`image_cache.py`)
+
+    python qformer_cache.py --image_cache ../data/image_cache --out ../data/qformer_cache
+
+stores the 32 x 768 query embeddings of each ASIN in a memory-mapped array:
+
+    embeddings.npy -- (N, 32, 768) float16 (or float32) Q-Former outputs
+    asins.npy      -- sorted |S10 ASIN of each row, as in the image cache
+    blank.npy      -- (32, 768) embedding of the all-ones image used for
+                      samples without an image
+
+With `QFormerConfigForWebshop(cached_image_emb=True)` the model skips loading
+BLIP-2 and takes these embeddings in place of `raw_images`.
+"""
+import argparse
+import os
+
+import numpy as np
+import torch
+
+from image_cache import IMAGE_CACHE_PATH, IMAGE_SIZE, ImageCache
+
+QFORMER_CACHE_PATH = "../data/qformer_cache"
+NUM_QUERY_TOKENS = 32
+QFORMER_HIDDEN = 768
+
+
+def build_qformer_cache(image_cache, out_dir, batch_size=64, device='cuda', dtype='float16'):
+    """
+    Run the frozen BLIP-2 image tower and Q-Former once over every cached image.
+
+    Arguments:
+    image_cache (`ImageCache`) -- preprocessed images
+    out_dir (`str`) -- cache directory, created if missing
+    dtype (`str`) -- 'float16' (half the size) or 'float32'
+    """
+    from transformers import Blip2Model
+    blip = Blip2Model.from_pretrained("Salesforce/blip2-opt-2.7b")
+    blip.language_model = None
+    blip = blip.to(device).eval()
+
+    def qformer(pixels):
+        with torch.no_grad():
+            return blip.get_qformer_features(pixel_values=pixels.to(device)).last_hidden_state.float().cpu().numpy()
+
+    os.makedirs(out_dir, exist_ok=True)
+    if os.path.exists(os.path.join(out_dir, 'asins.npy')):
+        os.remove(os.path.join(out_dir, 'asins.npy'))
+    embeddings = np.lib.format.open_memmap(
+        os.path.join(out_dir, 'embeddings.npy'), mode='w+', dtype=dtype,
+        shape=(len(image_cache), NUM_QUERY_TOKENS, QFORMER_HIDDEN),
+    )
+    for start in range(0, len(image_cache), batch_size):
+        rows = range(start, min(start + batch_size, len(image_cache)))
+        embeddings[start:rows.stop] = qformer(torch.stack([image_cache.at(row) for row in rows]))
+    embeddings.flush()
+    del embeddings
+
+    # Same placeholder as the collators use for samples without an image
+    blank = qformer(torch.ones((1, 3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32))[0]
+    np.save(os.path.join(out_dir, 'blank.npy'), blank.astype(dtype))
+    # Written last so a partially written cache is never picked up
+    np.save(os.path.join(out_dir, 'asins.npy'), np.asarray(image_cache.asins))
+    return len(image_cache)
+
+
+def open_qformer_cache(cache_dir=QFORMER_CACHE_PATH):
+    """`QFormerCache` of `cache_dir`, or `None` if it has not been built"""
+    if not cache_dir or not os.path.exists(os.path.join(cache_dir, 'asins.npy')):
+        return None
+    return QFormerCache(cache_dir)
+
+
+class QFormerCache:
+    """Frozen Q-Former embeddings looked up by ASIN"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.embeddings = np.load(os.path.join(cache_dir, 'embeddings.npy'), mmap_mode='c')
+        self.asins = np.load(os.path.join(cache_dir, 'asins.npy'), mmap_mode='r')
+        self.blank = torch.from_numpy(np.load(os.path.join(cache_dir, 'blank.npy'))).float()
+
+    def __getstate__(self):
+        # DataLoader workers map the files again instead of receiving a copy
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def __len__(self):
+        return len(self.asins)
+
+    def row(self, asin):
+        key = asin.upper().encode('ascii', errors='ignore')
+        i = int(np.searchsorted(self.asins, key))
+        if i < len(self.asins) and self.asins[i] == key:
+            return i
+        return None
+
+    def get(self, asin):
+        """Float32 (32, 768) embeddings of `asin`; the blank image's if it has none"""
+        row = self.row(asin) if isinstance(asin, str) and asin.lower() != 'none' else None
+        if row is None:
+            return self.blank
+        return torch.from_numpy(self.embeddings[row]).float()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute frozen Q-Former embeddings of all cached product images')
+    parser.add_argument('--image_cache', default=IMAGE_CACHE_PATH, help='Cache built by image_cache.py')
+    parser.add_argument('--out', default=QFORMER_CACHE_PATH, help='Cache directory')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--dtype', default='float16', choices=['float16', 'float32'])
+    args = parser.parse_args()
+    n = build_qformer_cache(ImageCache(args.image_cache), args.out, args.batch_size, args.device, args.dtype)
+    print(f'Cached Q-Former embeddings of {n} images in {args.out}')
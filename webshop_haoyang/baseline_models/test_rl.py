@@ -5,34 +5,17 @@ import json
 from train_rl import parse_args as webenv_args
 from env import WebEnv  # TODO: just use webshopEnv?
 import torch
+from web_agent_site.engine.features import load_feature_store
 from models.custom_qformer import QFormerConfigForWebshop, QFormerModelForWebshop
 
 FEAT_CONV = '/home/haoyang/webshop/data/feat_conv.pt'
-feat_conv = torch.load(FEAT_CONV)
+# Memory-mapped image features, converted from FEAT_CONV on first use
+feat_conv = load_feature_store(feat_conv=FEAT_CONV)
 
 cache = {"asin2name": None, "name2asin": None}
 
-DEFAULT_FILE_PATH = "../data/items_shuffle.json"
-# We want to map image url to its product ASIN because in WebEnv we only have the URL
-# and we need ASIN to access downloaded images
-url2asin = {}
-f = open(DEFAULT_FILE_PATH, 'r')
-print("Line 19")
-data = json.load(f)
-print("Line 22")
-for d in data:
-    if ('product_information' not in d) or ('images' not in d) or ('asin' not in d):
-        continue
-    url = d['images'][0]
-    if len(url) == 0 and len(d['images']) > 1:
-        url = d['images'][1]
-    url2asin[url] = d['asin'].upper()
-data = None # save RAM
-f.close()
-print("Line 32")
-
 args = webenv_args()[0]
-env = WebEnv(args, split='test', feat_conv=feat_conv, cache=cache, url2asin=url2asin)
+env = WebEnv(args, split='test', feat_conv=feat_conv, cache=cache)
 print('env loaded')
 
 
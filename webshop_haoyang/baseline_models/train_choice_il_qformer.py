@@ -55,6 +55,8 @@ from models.bert_vit import BertVitForWebshop
 from transformers import RobertaTokenizer
 from models.custom_blip import BlipModelForWebshop, BlipConfigForWebshop
 from models.custom_qformer import QFormerConfigForWebshop, QFormerModelForWebshop, QFormerFrozenModelForWebshop
+from image_cache import IMAGE_CACHE_PATH, open_image_cache
+from qformer_cache import open_qformer_cache
 
 
 JSON_PATH = "../data/items_shuffle.json"
@@ -182,7 +184,11 @@ def get_dataset(split, tokenizer=None):
     }
     return Dataset.from_dict(dataset)
 
-def data_collator(batch, image_processor):
+def data_collator(batch, image_processor, image_cache=None, qformer_cache=None):
+    """
+    `image_cache` (`ImageCache`) serves preprocessed images, decoding from IMAGE_PATH only on a miss.
+    With `qformer_cache` (`QFormerCache`), `raw_images` holds cached (32, 768) Q-Former embeddings instead.
+    """
     state_input_ids, state_attention_mask, action_input_ids, action_attention_mask, raw_images, sizes, labels, images = [
     ], [], [], [], [], [], [], []
     transform = transforms.Compose([
@@ -197,21 +203,27 @@ def data_collator(batch, image_processor):
         
         # We load images from disk on-the-fly to save memory
         # Elements of raw_images have shape (3, H, W)
-        if sample['raw_images'] == 'none':
+        if qformer_cache is not None:
+            raw_images.append(qformer_cache.get(sample['raw_images']))
+        elif sample['raw_images'] == 'none':
             raw_image = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
             raw_images.append(raw_image)
         else:
             asin = sample['raw_images'].upper()
-            try: # just in case the image doesn't exist due to some strange reasons
-                image = Image.open(os.path.join(IMAGE_PATH, asin + ".jpg"))
-                image_tensor = image_processor(image, return_tensors="pt")['pixel_values'] # [0]
-                if len(image_tensor.shape) == 4:
-                    image_tensor = image_tensor[0]
+            image_tensor = image_cache.get(asin) if image_cache is not None else None
+            if image_tensor is not None:
                 raw_images.append(image_tensor)
-            except:
-                image_tensor = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
-                raw_images.append(image_tensor)
-                print("Image not found: " + os.path.join(IMAGE_PATH, asin + ".jpg"))
+            else:
+                try: # just in case the image doesn't exist due to some strange reasons
+                    image = Image.open(os.path.join(IMAGE_PATH, asin + ".jpg"))
+                    image_tensor = image_processor(image, return_tensors="pt")['pixel_values'] # [0]
+                    if len(image_tensor.shape) == 4:
+                        image_tensor = image_tensor[0]
+                    raw_images.append(image_tensor)
+                except:
+                    image_tensor = torch.ones((3, IMAGE_SIZE, IMAGE_SIZE), dtype=torch.float32)
+                    raw_images.append(image_tensor)
+                    print("Image not found: " + os.path.join(IMAGE_PATH, asin + ".jpg"))
         
         sizes.append(sample['sizes'])
         labels.append(sample['labels'])
@@ -362,6 +374,10 @@ def parse_args():
                         default=10, help="Logging in training")
 
     parser.add_argument("--model_name", type=str, default="qformer", help="Name of the text encoder model (e.g. bert-base, t5-small, ...)")
+    parser.add_argument("--image_cache", type=str, default=IMAGE_CACHE_PATH,
+                        help="Preprocessed image cache built by image_cache.py; images are decoded from IMAGE_PATH if it is missing")
+    parser.add_argument("--qformer_cache", type=str, default="",
+                        help="Q-Former embeddings built by qformer_cache.py; qformer_frozen then trains without loading BLIP-2")
 
     args = parser.parse_args()
 
@@ -419,7 +435,11 @@ def main():
     #
     # In distributed training, the .from_pretrained methods guarantee that only one local process can concurrently
     # download model & vocab.
-    config = QFormerConfigForWebshop(image=args.image, pretrain_bert=args.pretrain)
+    qformer_cache = open_qformer_cache(args.qformer_cache) if args.model_name == "qformer_frozen" else None
+    if args.qformer_cache and qformer_cache is None:
+        print("Q-Former cache unused: it needs --model_name qformer_frozen and a cache built by qformer_cache.py")
+    config = QFormerConfigForWebshop(image=args.image, pretrain_bert=args.pretrain,
+                                     cached_image_emb=qformer_cache is not None)
     # image_processor = AutoImageProcessor.from_pretrained("google/vit-base-patch16-224-in21k")
     image_processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b").image_processor
     eval_processor = None
@@ -448,12 +468,14 @@ def main():
     
     train_dataset = get_dataset("train", tokenizer=tokenizer)
     eval_dataset = get_dataset("eval", tokenizer=tokenizer)
-    collate_fn_with_image_processor = partial(data_collator, image_processor=image_processor)
+    image_cache = open_image_cache(args.image_cache)
+    print("Image cache: {}".format(args.image_cache if image_cache is not None else "none"))
+    collate_fn_with_image_processor = partial(data_collator, image_processor=image_processor, image_cache=image_cache, qformer_cache=qformer_cache)
     train_dataloader = DataLoader(
         train_dataset, shuffle=True, collate_fn=collate_fn_with_image_processor, batch_size=args.per_device_train_batch_size
     )
     if eval_processor is not None:
-        collate_fn_with_eval_processor = partial(data_collator, image_processor=eval_processor)
+        collate_fn_with_eval_processor = partial(data_collator, image_processor=eval_processor, image_cache=image_cache, qformer_cache=qformer_cache)
         eval_dataloader = DataLoader(
             eval_dataset, collate_fn=collate_fn_with_eval_processor, batch_size=args.per_device_eval_batch_size
         )
@@ -2,11 +2,13 @@ import argparse
 import logging
 import time
 import torch
+from web_agent_site.engine.features import load_feature_store
 from collections import defaultdict
 
 import logger
 from agent_qformer import Agent, TransitionPG
 from env import WebEnv
+from vec_env import VectorWebEnv
 from tqdm import tqdm
 
 from transformers import Blip2Processor
@@ -68,18 +70,44 @@ def evaluate_episode(agent, env, split, method='greedy', idx=None):
 
 def agg(envs, attr):
     res = defaultdict(int)
-    for env in envs:
-        for k, v in getattr(env, attr).items():
+    if isinstance(envs, VectorWebEnv):
+        values = envs.get_attr(attr)
+    else:
+        values = [getattr(env, attr) for env in envs]
+    for value in values:
+        for k, v in value.items():
             res[k] += v
     return res
 
 
+def reset_envs(envs):
+    if isinstance(envs, VectorWebEnv):
+        return envs.reset()
+    return [env.reset() for env in envs]
+
+
+def step_envs(envs, action_strs):
+    """
+    Step all envs, returns a list of (ob, reward, done, info). Like VectorWebEnv,
+    finished envs are reset right away and the new (ob, info) is put in info['reset'].
+    """
+    if isinstance(envs, VectorWebEnv):
+        return envs.step(action_strs)
+    results = []
+    for env, action_str in zip(envs, action_strs):
+        ob, reward, done, info = env.step(action_str)
+        if done:
+            info['category'] = env.session['goal']['category']
+            info['reset'] = env.reset()
+        results.append((ob, reward, done, info))
+    return results
+
+
 def train(agent, eval_env, test_env, envs, args):
     start = time.time()
     states, valids, transitions = [], [], []
     state0 = None
-    for env in envs:
-        ob, info = env.reset()
+    for ob, info in reset_envs(envs):
         if state0 is None:
             state0 = (ob, info)
         states.append(agent.build_state(ob, info))
@@ -108,8 +136,8 @@ def train(agent, eval_env, test_env, envs, args):
 
         # step in envs
         next_states, next_valids, rewards, dones = [], [], [], []
-        for env, action_str, action_id, state in zip(envs, action_strs, action_ids, states):
-            ob, reward, done, info = env.step(action_str)
+        results = step_envs(envs, action_strs)
+        for ob, reward, done, info in results:
             # print(info['raw_image'])
             # if info['raw_image'] is None:
             #     print(action_str)
@@ -134,7 +162,7 @@ def train(agent, eval_env, test_env, envs, args):
                 next_states + [next_state], next_valids + [next_valid], rewards + [reward], dones + [done]
             if done:
                 tb.logkv_mean('EpisodeScore', info['score'])
-                category = env.session['goal']['category']
+                category = info['category']
                 tb.logkv_mean(f'EpisodeScore_{category}', info['score'])
                 if 'verbose' in info:
                     for k, v in info['verbose'].items():
@@ -152,9 +180,9 @@ def train(agent, eval_env, test_env, envs, args):
             torch.cuda.empty_cache()
 
         # handle done
-        for i, env in enumerate(envs):
-            if dones[i]:               
-                ob, info = env.reset()
+        for i, (_, _, done, info) in enumerate(results):
+            if done:
+                ob, info = info['reset']
                 if i == 0:
                     state0 = (ob, info)
                 next_states[i] = agent.build_state(ob, info)
@@ -170,6 +198,11 @@ def train(agent, eval_env, test_env, envs, args):
         if step % args.log_freq == 0:
             tb.logkv('Step', step)
             tb.logkv('FPS', int((step * len(envs)) / (time.time() - start)))
+            if isinstance(envs, VectorWebEnv):
+                parses = envs.get_attr('parses_per_step')
+            else:
+                parses = [env.parses_per_step for env in envs]
+            tb.logkv('ParsesPerStep', sum(parses) / len(parses))
             for k, v in agg(envs, 'stats').items():
                 tb.logkv(k, v)
             items_clicked = agg(envs, 'items_clicked')
@@ -195,6 +228,7 @@ def parse_args():
 
     # rl
     parser.add_argument('--num_envs', default=4, type=int)
+    parser.add_argument('--vector_env', default=0, type=int, help='step train envs in worker processes (needs compiled catalog)')
     parser.add_argument('--step_limit', default=100, type=int)
     parser.add_argument('--max_steps', default=300000, type=int)
     parser.add_argument('--learning_rate', default=1e-5, type=float)
@@ -220,6 +254,8 @@ def parse_args():
 
     # env
     parser.add_argument('--num', default=None, type=int)
+    parser.add_argument('--search_backend', default='lucene', type=str, choices=['lucene', 'bm25', 'dense', 'hybrid'], help='bm25 indexes the catalog in memory, no Java needed; dense and hybrid need `python -m web_agent_site.engine.dense`')
+    parser.add_argument('--qformer_cache', default='', type=str, help='Q-Former embeddings built by qformer_cache.py, used with --freeze 1 instead of loading BLIP-2')
     parser.add_argument('--click_item_name', default=1, type=int)
     parser.add_argument('--state_format', default='text_rich', type=str)
     parser.add_argument('--human_goals', default=1, type=int, help='use human goals')
@@ -246,7 +282,8 @@ def parse_args():
 
 import psutil
 FEAT_CONV = '/home/haoyang/webshop/data/feat_conv.pt'
-feat_conv = torch.load(FEAT_CONV)
+# Memory-mapped image features, converted from FEAT_CONV on first use
+feat_conv = load_feature_store(feat_conv=FEAT_CONV)
 import json
 
 def main():
@@ -263,38 +300,34 @@ def main():
     agent = Agent(args, image_processor, freeze_qformer=args.freeze)
     
     # To save RAM, reate a shared object for mappings in dataset
+    # (url -> asin and asin <-> name mappings are served by the env's SimServer)
     cache = {"asin2name": None, "name2asin": None}
 
-    DEFAULT_FILE_PATH = "../data/items_shuffle.json"
-    # We want to map image url to its product ASIN because in WebEnv we only have the URL
-    # and we need ASIN to access downloaded images
-    url2asin = {}
-    f = open(DEFAULT_FILE_PATH, 'r')
-    data = json.load(f)
-    for d in data:
-        if ('product_information' not in d) or ('images' not in d) or ('asin' not in d):
-            continue
-        url = d['images'][0]
-        if len(url) == 0 and len(d['images']) > 1:
-            url = d['images'][1]
-        url2asin[url] = d['asin'].upper()
-    data = None # save RAM
-    f.close()
-
-    train_env = WebEnv(args, split='train', id='train_', feat_conv=feat_conv, cache=cache, url2asin=url2asin)
+    train_env = WebEnv(args, split='train', id='train_', feat_conv=feat_conv, cache=cache)
     print("-----TRAINING ENV LOADED------")
     # memory_info = psutil.Process().memory_info()
     # print(f"243, RSS: {memory_info.rss / (1024 * 1024):.2f} MB")
     server = train_env.env.server
     # memory_info = psutil.Process().memory_info()
     # print(f"246, RSS: {memory_info.rss / (1024 * 1024):.2f} MB")
-    eval_env = WebEnv(args, split='eval', id='eval_', server=server, feat_conv=feat_conv, cache=cache, url2asin=url2asin)
+    eval_env = WebEnv(args, split='eval', id='eval_', server=server, feat_conv=feat_conv, cache=cache)
     # print("LINE 244")
-    test_env = WebEnv(args, split='test', id='test_', server=server, feat_conv=feat_conv, cache=cache, url2asin=url2asin)
+    test_env = WebEnv(args, split='test', id='test_', server=server, feat_conv=feat_conv, cache=cache)
     # print("LINE 245")
-    envs = [WebEnv(args, split='train', server=server, id=f'train{i}_', feat_conv=feat_conv, cache=cache, url2asin=url2asin) for i in range(args.num_envs)]
+    if args.vector_env:
+        # train envs step in worker processes attached to the shared server state
+        # (workers read the mappings from the attached catalog)
+        envs = VectorWebEnv(args, split='train', num_envs=args.num_envs, shared_name=server.share(),
+                            feat_conv=feat_conv)
+    else:
+        envs = [WebEnv(args, split='train', server=server, id=f'train{i}_', feat_conv=feat_conv, cache=cache) for i in range(args.num_envs)]
     print("loaded")
-    train(agent, eval_env, test_env, envs, args)
+    try:
+        train(agent, eval_env, test_env, envs, args)
+    finally:
+        if args.vector_env:
+            envs.close()
+            server.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+import random
+import traceback
+import multiprocessing as mp
+
+from env import WebEnv
+
+
+def _worker(remote, parent_remote, env_fn, seed):
+    """Runs one `WebEnv` and serves commands sent over `remote`"""
+    parent_remote.close()
+    # forked workers inherit the parent's random state; give each its own goal stream
+    random.seed(seed)
+    env = None
+    try:
+        env = env_fn()
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                ob, reward, done, info = env.step(data)
+                if done:
+                    # auto-reset, the last observation of the episode stays in the result
+                    info['category'] = env.session['goal']['category']
+                    info['reset'] = env.reset()
+                remote.send(('ok', (ob, reward, done, info)))
+            elif cmd == 'reset':
+                remote.send(('ok', env.reset(data)))
+            elif cmd == 'get_attr':
+                remote.send(('ok', getattr(env, data)))
+            elif cmd == 'close':
+                remote.send(('ok', None))
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    except Exception:
+        remote.send(('error', traceback.format_exc()))
+    finally:
+        if env is not None:
+            env.env.server.close()
+        remote.close()
+
+
+class VectorWebEnv:
+    '''
+    Runs `num_envs` WebEnvs in worker processes and steps them as one batch.
+    Workers attach to the catalog and goals published by `SimServer.share()`,
+    so the product table is not copied per worker.
+
+    `step` returns a list of (ob, reward, done, info). A finished env is reset
+    in its worker right away: the final step is returned as usual and the
+    (ob, info) of the new episode is stored in `info['reset']`, with the goal
+    category of the finished episode in `info['category']`.
+    '''
+
+    def __init__(self, args, split, num_envs, shared_name, id_prefix='train',
+                 feat_conv=None, cache=None, url2asin=None, context=None):
+        ctx = mp.get_context(context)
+        self.num_envs = num_envs
+        self.closed = False
+        self.remotes, self.processes = [], []
+        for i in range(num_envs):
+            env_fn = _EnvFactory(args, split, f'{id_prefix}{i}_', shared_name,
+                                 feat_conv, cache, url2asin)
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(work_remote, remote, env_fn, args.seed + i + 1),
+                                  daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+    def __len__(self):
+        return self.num_envs
+
+    def _call(self, cmd, data):
+        for remote, d in zip(self.remotes, data):
+            remote.send((cmd, d))
+        results = []
+        for remote in self.remotes:
+            status, result = remote.recv()
+            if status == 'error':
+                self.close()
+                raise RuntimeError('WebEnv worker failed:\n' + result)
+            results.append(result)
+        return results
+
+    def reset(self, idxs=None):
+        """Reset all envs, returns a list of (ob, info)"""
+        if idxs is None:
+            idxs = [None] * self.num_envs
+        return self._call('reset', idxs)
+
+    def step(self, actions):
+        """Step env i with actions[i], returns a list of (ob, reward, done, info)"""
+        assert len(actions) == self.num_envs
+        return self._call('step', actions)
+
+    def get_attr(self, name):
+        """Value of attribute `name` of every env, e.g. 'stats'"""
+        return self._call('get_attr', [name] * self.num_envs)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for remote in self.remotes:
+            try:
+                remote.send(('close', None))
+                remote.recv()
+            except (OSError, EOFError):
+                pass
+        for process in self.processes:
+            process.join()
+
+
+class _EnvFactory:
+    ''' Picklable WebEnv constructor, so workers can also be spawned. '''
+
+    def __init__(self, args, split, id, shared_name, feat_conv, cache, url2asin):
+        self.args = args
+        self.split = split
+        self.id = id
+        self.shared_name = shared_name
+        self.feat_conv = feat_conv
+        self.cache = cache
+        self.url2asin = url2asin
+
+    def __call__(self):
+        cache = self.cache
+        if cache is None:
+            cache = {"asin2name": None, "name2asin": None}
+        return WebEnv(self.args, self.split, id=self.id, shared_name=self.shared_name,
+                      feat_conv=self.feat_conv, cache=cache, url2asin=self.url2asin)
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark of the attribute and option rewards over the test goals.
+
+Scores every test goal against its target product and `--num_products` random
+products, once with the batched `rapidfuzz` matcher and once with the per-pair
+`thefuzz` loop, and checks that both give the same rewards.
+"""
+import argparse
+import random
+import time
+
+from web_agent_site.engine import goal as goal_module
+from web_agent_site.engine.engine import load_products
+from web_agent_site.engine.goal import get_attribute_reward, get_goals, get_option_reward
+from web_agent_site.utils import DEFAULT_FILE_PATH
+
+NUM_TEST_GOALS = 500  # goals [0, 500) are the test split, see `WebEnv`
+
+
+def sample_cases(product_item_dict, goals, num_products):
+    asins = list(product_item_dict.keys())
+    cases = []
+    for goal in goals:
+        for asin in [goal['asin']] + random.sample(asins, num_products):
+            product = product_item_dict[asin]
+            options = {
+                name: random.choice(values)
+                for name, values in product.get('options', dict()).items() if values
+            }
+            cases.append((product, goal, options))
+    return cases
+
+
+def score(cases):
+    results = []
+    old_time = time.time()
+    for product, goal, options in cases:
+        goal_options = goal['goal_options']
+        if isinstance(goal_options, dict):
+            goal_options = goal_options.items()
+        results.append((
+            get_attribute_reward(product, goal),
+            get_option_reward(list(options.values()), goal_options),
+        ))
+    return results, (time.time() - old_time) / len(cases) * 1000
+
+
+def benchmark(cases):
+    """Returns ms per case of the batched and the per-pair matcher and whether rewards agree"""
+    cdist, cache_size = goal_module.cdist, goal_module.SEARCH_TEXT_CACHE_SIZE
+    try:
+        goal_module.cdist, goal_module.SEARCH_TEXT_CACHE_SIZE = None, 0
+        goal_module._search_texts.clear()
+        loop_results, loop_ms = score(cases)
+    finally:
+        goal_module.cdist, goal_module.SEARCH_TEXT_CACHE_SIZE = cdist, cache_size
+    goal_module._search_texts.clear()
+    batch_results, batch_ms = score(cases)
+    return batch_ms, loop_ms, batch_results == loop_results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark attribute and option rewards')
+    parser.add_argument('--filepath', default=DEFAULT_FILE_PATH, help='Product JSON file')
+    parser.add_argument('--num_products', default=10, type=int, help='Random products per goal')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    all_products, product_item_dict, product_prices, _ = \
+        load_products(filepath=args.filepath, human_goals=True)
+    goals = get_goals(all_products, product_prices, human_goals=True)
+    # Same goal order as `SimServer`
+    random.seed(233)
+    random.shuffle(goals)
+
+    random.seed(args.seed)
+    cases = sample_cases(product_item_dict, goals[:NUM_TEST_GOALS], args.num_products)
+    batch_ms, loop_ms, same = benchmark(cases)
+    print(f'{len(cases)} (goal, product) pairs: '
+          f'{batch_ms:.3f} ms/pair batched, {loop_ms:.3f} ms/pair per-pair loop, '
+          f'identical rewards: {same}')
@@ -0,0 +1,59 @@
+"""
+Benchmark per-step cost of the text environment with a random policy.
+
+Reports the average wall time of `env.step` and the part of it spent
+rendering HTML pages in `SimServer`.
+"""
+import argparse
+import random
+import time
+
+from web_agent_site.envs import WebAgentTextEnv
+from web_agent_site.envs import web_agent_text_env
+from web_agent_site.models import RandomPolicy
+from web_agent_site.utils import DEBUG_PROD_SIZE
+
+
+def benchmark(env, num_steps):
+    policy = RandomPolicy()
+    render = web_agent_text_env.map_action_to_html
+    timings = dict(step=0.0, render=0.0)
+
+    def timed_render(*args, **kwargs):
+        old_time = time.time()
+        html = render(*args, **kwargs)
+        timings['render'] += time.time() - old_time
+        return html
+
+    try:
+        env.reset()
+        observation = env.observation
+        for _ in range(num_steps):
+            action = policy.forward(observation, env.get_available_actions())
+            web_agent_text_env.map_action_to_html = timed_render
+            old_time = time.time()
+            observation, reward, done, info = env.step(action)
+            timings['step'] += time.time() - old_time
+            web_agent_text_env.map_action_to_html = render
+            if done:
+                env.reset()
+                observation = env.observation
+    finally:
+        web_agent_text_env.map_action_to_html = render
+    return {k: v / num_steps * 1000 for k, v in timings.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark WebAgentTextEnv steps')
+    parser.add_argument('--num_products', default=DEBUG_PROD_SIZE, type=int)
+    parser.add_argument('--observation_mode', default='text', type=str)
+    parser.add_argument('--steps', default=1000, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    env = WebAgentTextEnv(observation_mode=args.observation_mode, num_products=args.num_products)
+    result = benchmark(env, args.steps)
+    print(f'{args.steps} steps: '
+          f'{result["step"]:.2f} ms/step, '
+          f'{result["render"]:.2f} ms/render')
@@ -0,0 +1,110 @@
+"""
+Build the Lucene index of the product catalog.
+
+Documents are streamed from the catalog (`load_products`) into one JSONL shard
+per indexing thread and indexed with pyserini into a single full index. Each
+document also indexes its catalog row, and smaller catalog sizes (a prefix of
+the rows) are searched with a Lucene filter on it (see `LuceneBackend`), so no
+separate indexes are built for them.
+
+A manifest of document hashes is stored next to the index. With `--update`,
+only products that are new or whose document text or row changed are
+re-indexed, replacing their old documents; the documents of removed products
+are replaced by placeholders that no row filter matches.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from tqdm import tqdm
+sys.path.insert(0, '../')
+
+from web_agent_site.utils import DEFAULT_FILE_PATH
+from web_agent_site.engine.engine import load_products
+from web_agent_site.engine.search import (
+    ROW_FIELD,
+    document_hash,
+    index_document,
+    read_manifest,
+    removed_document,
+    write_manifest,
+)
+
+
+def write_shards(docs, out_dir, num_shards):
+    """Write documents round-robin into `num_shards` JSONL files; returns the number written"""
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    files = [open(os.path.join(out_dir, f'documents_{i}.jsonl'), 'w') for i in range(num_shards)]
+    num_docs = 0
+    try:
+        for doc in docs:
+            files[num_docs % num_shards].write(json.dumps(doc) + '\n')
+            num_docs += 1
+    finally:
+        for f in files:
+            f.close()
+    return num_docs
+
+
+def run_indexer(input_dir, index_dir, threads, update=False):
+    cmd = [
+        sys.executable, '-m', 'pyserini.index.lucene',
+        '--collection', 'JsonCollection',
+        '--input', input_dir,
+        '--index', index_dir,
+        '--generator', 'DefaultLuceneDocumentGenerator',
+        '--threads', str(threads),
+        '--storePositions',
+        # Catalog row of each document, for sub-catalog filters
+        '--fields', ROW_FIELD,
+    ]
+    if update:
+        # Add to the existing index, replacing documents with the same id
+        cmd += ['--append', '--uniqueDocid']
+    subprocess.run(cmd, check=True)
+
+
+def build_index(filepath, index_dir, resources_dir, threads, update=False):
+    old_manifest = read_manifest(index_dir) if update else None
+    if update and old_manifest is None:
+        print(f'No manifest in {index_dir}, building the full index.')
+        update = False
+
+    all_products, *_ = load_products(filepath=filepath)
+    manifest = dict()
+
+    def changed_docs():
+        for row, p in tqdm(enumerate(all_products), total=len(all_products)):
+            doc = index_document(p, row)
+            manifest[doc['id']] = document_hash(doc)
+            if not update or old_manifest.get(doc['id']) != manifest[doc['id']]:
+                yield doc
+        if update:
+            for asin in old_manifest.keys() - manifest.keys():
+                yield removed_document(asin)
+
+    num_docs = write_shards(changed_docs(), resources_dir, threads)
+    if num_docs == 0:
+        print('Index is up to date.')
+        return
+    if not update and os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    run_indexer(resources_dir, index_dir, threads, update=update)
+    write_manifest(index_dir, manifest)
+    print(f'Indexed {num_docs} documents into {index_dir}.')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the Lucene index of the product catalog')
+    parser.add_argument('--filepath', default=DEFAULT_FILE_PATH, help='Product JSON file')
+    parser.add_argument('--index', default='indexes', help='Index directory')
+    parser.add_argument('--resources', default='resources', help='Directory for the JSONL document shards')
+    parser.add_argument('--threads', default=os.cpu_count() or 1, type=int)
+    parser.add_argument('--update', action='store_true',
+                        help='only index new and changed products into the existing index')
+    args = parser.parse_args()
+    build_index(args.filepath, args.index, args.resources, args.threads, update=args.update)
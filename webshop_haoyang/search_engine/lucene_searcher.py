@@ -1,4 +1,3 @@
-import json
 from pyserini.search.lucene import LuceneSearcher
 from rich import print
 
@@ -6,10 +5,8 @@ from rich import print
 searcher = LuceneSearcher('indexes')
 hits = searcher.search('rubber sole shoes', k=20)
 
+# The docid of a hit is the product ASIN
 for hit in hits:
-    doc = searcher.doc(hit.docid)
-    print(doc)
-    obj = json.loads(doc.raw())['product']['Title']
-    print(obj)
+    print(hit.docid, hit.score)
 
 print(len(hits))
@@ -65,11 +65,11 @@ LIBMKL_DIR=$(dirname "$LIBMKL_PATH")
 # Export the LD_LIBRARY_PATH
 export LD_LIBRARY_PATH=$LD_LIBRARY_PATH:$LIBMKL_DIR
 
+# Compile product catalog so `load_products` can memory-map it instead of parsing JSON
+python -m web_agent_site.engine.catalog
+
 # Build search engine index
 cd search_engine
-mkdir -p resources resources_100 resources_1k resources_100k
-python convert_product_file_format.py # convert items.json => required doc format
-mkdir -p indexes
 ./run_indexing.sh
 cd ..
 
@@ -0,0 +1,144 @@
+import random
+import pytest
+from web_agent_site.engine.catalog import *
+
+def make_products():
+    return [
+        {
+            'asin': 'B000000003',
+            'Title': 'Soap',
+            'pricing': [4.5],
+            'category': 'beauty',
+            'query': 'soap',
+            'Attributes': ['natural', 'vegan'],
+            'instructions': [{'instruction': 'i want soap'}],
+            'instruction_text': 'find soap',
+            'instruction_attributes': ['natural'],
+        },
+        {
+            'asin': 'B000000001',
+            'Title': 'Shoe',
+            'pricing': [10.0, 20.0],
+            'category': 'fashion',
+            'query': 'shoes',
+            'Attributes': ['vegan', 'vegan'],
+            'instruction_text': None,
+            'instruction_attributes': None,
+        },
+        {
+            'asin': 'B000000002',
+            'Title': 'Shirt',
+            'pricing': [],
+            'category': 'fashion',
+            'query': 'shirt',
+            'Attributes': ['DUMMY_ATTR'],
+        },
+    ]
+
+@pytest.fixture
+def catalog_dir(tmp_path):
+    source = tmp_path / 'items.json'
+    source.write_text('[]')
+    out_dir = str(tmp_path / 'items.catalog')
+    write_catalog(make_products(), [0, 2, 5], out_dir, [str(source)])
+    return out_dir, str(source)
+
+def test_catalog_path_for():
+    assert catalog_path_for('/data/items_shuffle.json') == '/data/items_shuffle.catalog'
+
+def test_open_catalog_stale(catalog_dir, tmp_path):
+    out_dir, source = catalog_dir
+    assert open_catalog(str(tmp_path / 'missing')) is None
+    assert open_catalog(out_dir, source_paths=[source]) is not None
+    with open(source, 'a') as f:
+        f.write(' ')
+    assert open_catalog(out_dir, source_paths=[source]) is None
+
+def test_catalog_views(catalog_dir):
+    out_dir, _ = catalog_dir
+    random.seed(0)
+    all_products, product_item_dict, product_prices, product_index = \
+        open_catalog(out_dir).views()
+    attribute_to_asins = product_index.attribute_to_asins
+
+    assert len(all_products) == 3
+    assert [p['Title'] for p in all_products] == ['Soap', 'Shoe', 'Shirt']
+    assert all_products[-1]['asin'] == 'B000000002'
+    assert 'B000000001' in product_item_dict
+    assert 'B000000009' not in product_item_dict
+    assert product_item_dict['B000000001']['Title'] == 'Shoe'
+    assert list(product_item_dict) == ['B000000003', 'B000000001', 'B000000002']
+
+    random.seed(0)
+    expected_range_price = random.uniform(10.0, 20.0)
+    assert product_prices == {
+        'B000000003': 4.5,
+        'B000000001': expected_range_price,
+        'B000000002': 100.0,
+    }
+
+    assert attribute_to_asins['vegan'] == {'B000000003', 'B000000001'}
+    assert attribute_to_asins['unknown'] == set()
+    assert 'natural' in attribute_to_asins
+
+    assert [p['asin'] for p in product_index.products('category', 'fashion')] == ['B000000001', 'B000000002']
+    assert [p['asin'] for p in product_index.search(['<a>', 'vegan'])] == ['B000000003', 'B000000001']
+    assert product_index.search(['<q>', 'soap', '']) == [all_products[0]]
+    assert product_index.search(['<c>', 'toys']) == []
+
+def test_catalog_goal_fields(catalog_dir):
+    out_dir, _ = catalog_dir
+    human = open_catalog(out_dir, human_goals=True).views()[0]
+    assert 'instructions' in human[0]
+    assert 'instruction_text' not in human[0]
+    synthetic = open_catalog(out_dir, human_goals=False).views()[0]
+    assert 'instructions' not in synthetic[0]
+    assert synthetic[0]['instruction_text'] == 'find soap'
+
+def test_catalog_goal_products(catalog_dir):
+    out_dir, _ = catalog_dir
+    catalog = open_catalog(out_dir)
+    assert catalog.goal_products(human_goals=True) == [{
+        'asin': 'B000000003', 'category': 'beauty', 'query': 'soap', 'Title': 'Soap',
+        'instructions': [{'instruction': 'i want soap'}],
+    }]
+    synthetic = catalog.goal_products(human_goals=False)
+    assert [p['asin'] for p in synthetic] == ['B000000003']
+    assert synthetic[0]['instruction_attributes'] == ['natural'] and 'instructions' not in synthetic[0]
+    # Goal fields are read without decoding products
+    assert catalog.product.cache_info().misses == 0
+    assert open_catalog(out_dir, num_products=0).goal_products() == []
+
+def test_catalog_num_products(catalog_dir):
+    out_dir, _ = catalog_dir
+    all_products, product_item_dict, product_prices, product_index = \
+        open_catalog(out_dir, num_products=3).views()
+    assert len(all_products) == 2
+    assert 'B000000002' not in product_item_dict
+    assert set(product_prices) == {'B000000003', 'B000000001'}
+    assert 'DUMMY_ATTR' not in product_index.attribute_to_asins
+    assert [p['asin'] for p in product_index.search(['<c>', 'fashion'])] == ['B000000001']
+
+def test_catalog_lookups(tmp_path):
+    products = make_products()
+    products[0]['images'] = ['http://img/soap.jpg']
+    products[1]['images'] = ['', 'http://img/shoe.jpg']
+    products[2]['images'] = ['http://img/soap.jpg']
+    products[2]['Title'] = 'SOAP'
+    out_dir = str(tmp_path / 'items.catalog')
+    write_catalog(products, [0, 2, 5], out_dir, [])
+
+    for num_products in [None, 3]:
+        lookups = open_catalog(out_dir, num_products=num_products).lookups()
+        exposed = products if num_products is None else products[:2]
+        expected = ProductLookups.from_products(exposed)
+        for name in ['url2asin', 'asin2name', 'name2asin']:
+            assert dict(getattr(lookups, name)) == getattr(expected, name)
+    # Duplicate urls and names map to the last product
+    assert lookups.url2asin['http://img/soap.jpg'] == 'B000000003'
+    lookups = open_catalog(out_dir).lookups()
+    assert lookups.url2asin['http://img/soap.jpg'] == 'B000000002'
+    assert lookups.name2asin['soap'] == 'b000000002'
+    assert lookups.asin2name['b000000001'] == 'shoe'
+    assert 'B000000001' not in lookups.asin2name
+    assert 'http://img/missing.jpg' not in lookups.url2asin
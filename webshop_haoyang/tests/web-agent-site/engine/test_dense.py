@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+from web_agent_site.engine.dense import *
+from web_agent_site.engine.search import SearchHit
+
+ASINS = [f'B{i:09d}' for i in range(200)]
+
+
+class LookupEncoder:
+    """Encodes the query 'row <i>' as a noisy copy of embedding i"""
+    def __init__(self, embeddings):
+        self.embeddings = normalize_rows(embeddings)
+
+    def __call__(self, queries):
+        rows = [int(q.split()[1]) for q in queries]
+        return self.embeddings[rows] + 0.01
+
+
+@pytest.fixture
+def store(tmp_path):
+    embeddings = np.random.default_rng(0).normal(size=(len(ASINS), 16))
+    write_dense_store(str(tmp_path), ASINS, embeddings, model='toy', nlist=8)
+    return DenseStore(str(tmp_path)), embeddings
+
+
+def brute_force(embeddings, vector, k):
+    scores = normalize_rows(embeddings).astype(np.float16).astype(np.float32) @ vector
+    return [ASINS[i] for i in np.lexsort((np.arange(len(scores)), -scores))[:k]]
+
+
+def test_dense_store(store):
+    store, embeddings = store
+    assert len(store) == len(ASINS) and store.meta['model'] == 'toy'
+    assert store.asin(3) == ASINS[3]
+    assert isinstance(store.embeddings, np.memmap)
+    assert sorted(store.order) == list(range(len(ASINS)))
+    assert store.offsets[0] == 0 and store.offsets[-1] == len(ASINS)
+
+
+def test_dense_searcher_exact_and_ivf(store):
+    store, embeddings = store
+    encoder = LookupEncoder(embeddings)
+    queries = ['row 5', 'row 17', 'row 123']
+    vectors = normalize_rows(encoder(queries))
+    exact = DenseSearcher(store, encoder, ann='exact').search_many(queries, k=10)
+    # Scanning every cluster is exact search
+    ivf = DenseSearcher(store, encoder, ann='ivf', nprobe=8).search_many(queries, k=10)
+    for vector, e, i in zip(vectors, exact, ivf):
+        assert [h.docid for h in e] == brute_force(embeddings, vector, 10)
+        assert [h.docid for h in i] == [h.docid for h in e]
+    assert exact[0][0].docid == ASINS[5]
+    # A few clusters still find the nearest product
+    approx = DenseSearcher(store, encoder, ann='ivf', nprobe=2).search('row 17', k=5)
+    assert approx[0].docid == ASINS[17] and len(approx) == 5
+    with pytest.raises(ValueError):
+        DenseSearcher(store, encoder, ann='lsh')
+
+
+def test_dense_searcher_rows(store, monkeypatch):
+    store, embeddings = store
+    encoder = LookupEncoder(embeddings)
+    rows = np.arange(0, len(ASINS), 7)
+    vectors = normalize_rows(encoder(['row 5', 'row 14']))
+    for ann in ['exact', 'ivf', 'auto']:
+        # Small subsets are scanned exactly
+        searcher = DenseSearcher(store, encoder, ann=ann, nprobe=1, rows=rows)
+        assert searcher.ann == 'exact' and len(searcher) == len(rows)
+        for vector, hits in zip(vectors, searcher.search_many(['row 5', 'row 14'], k=10)):
+            scores = normalize_rows(embeddings[rows]).astype(np.float16).astype(np.float32) @ vector
+            assert [h.docid for h in hits] == [ASINS[r] for r in rows[np.lexsort((rows, -scores))[:10]]]
+    # Larger subsets probe the IVF lists with other rows masked out, and
+    # more clusters until k of their rows are found
+    monkeypatch.setattr('web_agent_site.engine.dense.EXACT_SUBSET_ROWS', 10)
+    searcher = DenseSearcher(store, encoder, ann='auto', nprobe=1, rows=rows)
+    assert searcher.ann == 'ivf'
+    hits = searcher.search('row 14', k=20)
+    assert len(hits) == 20 and {h.docid for h in hits} <= {ASINS[r] for r in rows}
+    assert hits[0].docid == ASINS[14]
+    assert DenseSearcher(store, encoder, rows=[]).search('row 1') == []
+
+
+def test_init_dense_search_engine(store):
+    from web_agent_site.engine.engine import init_search_engine
+    store, embeddings = store
+    # A catalog of 30 products searches only their rows of the full store
+    product_item_dict = {asin: {} for asin in ASINS[:30]}
+    searcher = init_search_engine(num_products=30, backend='dense', product_item_dict=product_item_dict,
+                                  dense_dir=store.store_dir)
+    searcher.encoder = LookupEncoder(embeddings)
+    hits = searcher.search('row 150', k=50)
+    assert len(hits) == 30 and {h.docid for h in hits} == set(product_item_dict)
+    assert searcher.search('row 12', k=1)[0].docid == ASINS[12]
+
+
+class StaticBackend:
+    def __init__(self, ranking):
+        self.ranking = ranking
+
+    def search_many(self, queries, k=10):
+        return [[SearchHit(d, 1.0) for d in self.ranking[:k]] for _ in queries]
+
+
+def test_hybrid_searcher():
+    lexical = StaticBackend(['a', 'b', 'c'])
+    dense = StaticBackend(['c', 'd', 'a'])
+    hits = HybridSearcher(lexical, dense).search('q', k=3)
+    # 'a' and 'c' are found by both backends, 'a' ranks higher overall
+    assert [h.docid for h in hits] == ['a', 'c', 'b']
+    assert hits[0].score == pytest.approx(1 / (RRF_K + 1) + 1 / (RRF_K + 3))
+    hits = HybridSearcher(lexical, dense, dense_weight=0.0).search('q', k=4)
+    assert [h.docid for h in hits] == ['a', 'b', 'c', 'd']
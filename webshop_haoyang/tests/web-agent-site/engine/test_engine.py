@@ -0,0 +1,83 @@
+from web_agent_site.engine.engine import *
+from web_agent_site.engine.search import MANIFEST_FILE
+
+class FakeHit:
+    def __init__(self, docid):
+        self.docid = docid
+
+class FakeSearcher:
+    def __init__(self):
+        self.queries = []
+        self.batches = []
+
+    def search(self, query, k=10):
+        self.queries.append(query)
+        return [FakeHit(f'B{i:09d}') for i in range(min(k, len(query.split())))]
+
+    def search_many(self, queries, k=10):
+        self.batches.append(list(queries))
+        return [self.search(query, k=k) for query in queries]
+
+def test_search_cache_lru():
+    cache = SearchCache(maxsize=2)
+    cache.put(('i', 5, 'a'), ['B1'])
+    cache.put(('i', 5, 'b'), ['B2'])
+    assert cache.get(('i', 5, 'a')) == ('B1',)
+    cache.put(('i', 5, 'c'), ['B3'])
+    # 'b' was least recently used
+    assert cache.get(('i', 5, 'b')) is None
+    assert cache.info() == dict(hits=1, misses=1, size=2, maxsize=2)
+
+def test_search_cache_persist(tmp_path):
+    path = str(tmp_path / 'search_cache.json')
+    cache = SearchCache()
+    assert not cache.load(path)
+    cache.put(('indexes', 50, 'red shoe'), ['B1', 'B2'])
+    cache.save(path)
+    restored = SearchCache()
+    assert restored.load(path)
+    assert restored.get(('indexes', 50, 'red shoe')) == ('B1', 'B2')
+
+def test_search_asins_cached():
+    searcher = FakeSearcher()
+    search_cache.clear()
+    first = search_asins(searcher, ['red', 'shoe'], k=5, search_index='test')
+    assert list(first) == ['B000000000', 'B000000001']
+    assert search_asins(searcher, [' red', 'shoe '], k=5, search_index='test') == first
+    assert searcher.queries == ['red shoe']
+    assert search_cache.info()['hits'] == 1
+    # Uncached without an index name
+    search_asins(searcher, ['red', 'shoe'], k=5)
+    assert len(searcher.queries) == 2
+    search_cache.clear()
+
+def test_search_asins_many():
+    searcher = FakeSearcher()
+    search_cache.clear()
+    search_asins(searcher, ['soap'], k=5, search_index='test')
+    keywords_list = [['soap'], ['red', 'shoe'], ['blue', 'dress', 'cotton'], ['red', 'shoe']]
+    results = search_asins_many(searcher, keywords_list, k=5, search_index='test')
+    assert results == [search_asins(FakeSearcher(), keywords, k=5) for keywords in keywords_list]
+    # One backend call for the distinct uncached queries
+    assert searcher.batches == [['red shoe', 'blue dress cotton']]
+    assert search_asins_many(searcher, keywords_list, k=5, search_index='test') == results
+    assert len(searcher.batches) == 1
+    search_cache.clear()
+
+def test_search_index_name_versions(tmp_path, monkeypatch):
+    monkeypatch.setattr('web_agent_site.engine.engine.SEARCH_ENGINE_DIR', str(tmp_path))
+    full_index = tmp_path / 'indexes'
+    full_index.mkdir()
+    (full_index / 'segments_1').write_text('')
+    products = {'B01': {}, 'B02': {}}
+    # Without a manifest, the prebuilt index of the catalog size is named
+    assert get_search_index_name(100, product_item_dict=products) == 'indexes_100@indexes_100.None'
+    (full_index / MANIFEST_FILE).write_text('{}')
+    name = get_search_index_name(100, product_item_dict=products)
+    assert name.startswith('indexes_100@indexes.segments_1.')
+    assert get_search_index_name(None, product_item_dict=products).startswith('indexes@indexes.')
+    # An update commits a new segments file
+    (full_index / 'segments_a').write_text('')
+    assert get_search_index_name(100, product_item_dict=products).startswith('indexes_100@indexes.segments_a.')
+    assert get_search_index_name(100, 'bm25') == 'bm25_100'
+    assert get_search_index_name(100, 'dense', dense_dir=str(tmp_path / 'dense')) == 'dense_100@None'
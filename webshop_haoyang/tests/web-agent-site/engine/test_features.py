@@ -0,0 +1,55 @@
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from web_agent_site.engine.features import *
+
+URLS = [f'https://img/{i}.jpg' for i in range(50)] + ['https://img/3.jpg']
+
+
+@pytest.fixture
+def feats():
+    return torch.randn(len(URLS), 8)
+
+
+def test_feature_store(tmp_path, feats):
+    write_feature_store(str(tmp_path), URLS, feats)
+    store = open_feature_store(str(tmp_path))
+    ids = {url: idx for idx, url in enumerate(URLS)}
+    assert len(store) == len(ids) and store.dim == 8
+    for url, idx in ids.items():
+        assert torch.equal(store.get(url), feats[idx])
+    # A repeated url maps to its last row, as in the dict
+    assert store.row('https://img/3.jpg') == len(URLS) - 1
+    assert store.get('https://img/missing.jpg') is None
+    assert 'https://img/missing.jpg' not in store
+
+    # Zero-copy view of the mapped file
+    image = store.get(URLS[1])
+    assert image.data_ptr() == store.feats[1].ctypes.data
+
+    # Workers reopen the mapping instead of copying the features
+    clone = pickle.loads(pickle.dumps(store))
+    assert len(pickle.dumps(store)) < 1000
+    assert torch.equal(clone.get(URLS[7]), feats[7])
+
+
+def test_feature_store_float16(tmp_path, feats):
+    write_feature_store(str(tmp_path), URLS, feats, dtype='float16')
+    store = open_feature_store(str(tmp_path))
+    image = store.get(URLS[5])
+    assert image.dtype == torch.float32
+    assert torch.allclose(image, feats[5], atol=1e-2)
+
+
+def test_open_feature_store_stale(tmp_path, feats):
+    source = tmp_path / 'feat_ids.pt'
+    source.write_text('x')
+    store_dir = str(tmp_path / 'store')
+    assert open_feature_store(store_dir) is None
+    write_feature_store(store_dir, URLS, feats, source_paths=[str(source)])
+    assert open_feature_store(store_dir, [str(source)]) is not None
+    source.write_text('changed')
+    assert open_feature_store(store_dir, [str(source)]) is None
@@ -65,6 +65,30 @@ def test_get_type_reward():
     result = get_type_reward(purchased, goal)
     assert result['title_score'] < 0.05
 
+def test_noun_table():
+    names = [
+        "PEAK High Top Mens Basketball Shoes Lou Williams Streetball Master Breathable Non Slip Outdoor Sneakers",
+        "Mens D.O.N. Issue 2 Gca Basketball Sneakers Shoes Casual - Off White",
+    ]
+    build_noun_table(names)
+    for name in names:
+        expected = [t.text.lower() for t in get_nlp()(name) if t.pos_ in NOUN_POS]
+        assert noun_table[name] == expected
+        assert get_nouns(name) == expected
+    # Names outside of the table are parsed on demand
+    assert get_nouns("Lemon Shampoo") == [t.text.lower() for t in get_nlp()("Lemon Shampoo") if t.pos_ in NOUN_POS]
+
+def test_noun_backend():
+    try:
+        set_noun_backend(lambda names: [name.lower().split()[-1:] for name in names])
+        assert get_nouns("Organic Green Tea") == ['tea']
+        set_noun_backend('table')
+        assert get_nouns("Organic Green Tea") == []
+        with pytest.raises(ValueError):
+            set_noun_backend('unknown')
+    finally:
+        set_noun_backend('spacy')
+
 def test_get_attribute_reward():
     # Exact Match
     goal = {
@@ -197,4 +221,74 @@ def test_get_reward():
     purchased['query'] = "Query 2"
     purchased['product_category'] = "a › d › e"
     total_reward = get_reward(purchased, goal, 35, purchased['goal_options'])
-    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
\ No newline at end of file
+    assert isclose(total_reward, 0.2857, abs_tol=1e-2)
+def test_fuzzy_matches():
+    queries = ["tea tree", "Essential Oils!", "lemon", "café latte"]
+    choices = ["tea tree oil", "essential oil", "cafe latte"]
+    expected = [any(fuzz.token_set_ratio(c, q) > 85 for c in choices) for q in queries]
+    assert fuzzy_matches(queries, choices) == expected == [True, True, False, True]
+    assert fuzzy_matches(queries, []) == [False] * 4
+    assert fuzzy_matches([], choices) == []
+
+def test_search_text_cache():
+    product = {'asin': 'B0TEST0001', 'Title': 'Lemon SHAMPOO', 'BulletPoints': ['A', 'B']}
+    assert get_search_text(product, 'Title') == 'lemon shampoo'
+    assert get_search_text(product, 'BulletPoints') == 'a b'
+    # Text is read once per ASIN
+    product['Title'] = 'Other'
+    assert get_search_text(product, 'Title') == 'lemon shampoo'
+
+def test_product_reward_cache():
+    goal = {
+        'asin': 'B0GOAL0001',
+        'instruction_text': 'i want a lemon shampoo',
+        'query': 'shampoo',
+        'product_category': 'a › b › c',
+        'name': 'Lemon Shampoo',
+        'attributes': ['lemon'],
+        'goal_options': ['xl'],
+        'price_upper': 40.00,
+    }
+    product = {
+        'asin': 'B0TEST0002',
+        'query': 'shampoo',
+        'product_category': 'a › b › c',
+        'name': 'Fresh Shampoo',
+        'Attributes': [],
+        'Title': 'Fresh Shampoo',
+        'BulletPoints': ['Smells like lemon'],
+        'Description': '',
+    }
+    try:
+        set_noun_backend(lambda names: [name.lower().split()[-1:] for name in names])
+        assert get_reward(product, goal, 35, {'size': 'xl'}) == 1
+        assert get_reward(product, goal, 35, {'size': 's'}) == 2./3.
+        # Type and attribute rewards are computed once per (goal, ASIN)
+        product['BulletPoints'] = []
+        assert get_reward(product, goal, 35, {'size': 'xl'}) == 1
+        assert get_reward(dict(product, asin=None), goal, 35, {'size': 'xl'}) == 2./3.
+        # Reloading products drops the cached rewards
+        clear_product_caches()
+        assert get_reward(product, goal, 35, {'size': 'xl'}) == 2./3.
+    finally:
+        set_noun_backend('spacy')
+
+def test_init_noun_table(tmp_path):
+    parsed = []
+    def backend(names):
+        parsed.extend(names)
+        return [name.lower().split()[-1:] for name in names]
+    try:
+        set_noun_backend(backend)
+        path = str(tmp_path / 'nouns.json')
+        # Only the table is loaded, nothing is parsed
+        assert init_noun_table(path=path) is None and parsed == []
+        goal_nouns = init_noun_table([{'name': 'Blue Denim Jacket'}, {'name': 'Blue Denim Jacket'}], path=path)
+        assert goal_nouns == {'Blue Denim Jacket': ['jacket']} and parsed == ['Blue Denim Jacket']
+        # Workers add the parent's goal nouns without parsing
+        add_noun_table({'Wool Socks': ['socks']})
+        assert get_nouns('Wool Socks') == ['socks'] and len(parsed) == 1
+    finally:
+        set_noun_backend('spacy')
+        noun_table.pop('Blue Denim Jacket', None)
+        noun_table.pop('Wool Socks', None)
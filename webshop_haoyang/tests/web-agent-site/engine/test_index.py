@@ -0,0 +1,47 @@
+from web_agent_site.engine.index import *
+
+def make_products():
+    return [
+        {'asin': 'B01', 'category': 'beauty', 'query': 'soap', 'Attributes': ['natural', 'vegan', 'vegan']},
+        {'asin': 'B02', 'category': 'fashion', 'query': 'shoes', 'Attributes': ['vegan']},
+        {'asin': 'B03', 'category': 'beauty', 'query': 'hair oil', 'Attributes': []},
+        {'asin': 'B04', 'query': 'soap', 'Attributes': ['natural']},
+    ]
+
+def test_build_postings():
+    postings = build_postings(make_products())
+    assert postings['Attributes'] == {'natural': [0, 3], 'vegan': [0, 1]}
+    assert postings['category'] == {'beauty': [0, 2], 'fashion': [1]}
+    assert postings['query'] == {'soap': [0, 3], 'shoes': [1], 'hair oil': [2]}
+
+def test_search_matches_scan():
+    products = make_products()
+    index = ProductIndex(products, build_postings(products))
+    for keywords in [['<a>', 'vegan'], ['<a>', 'natural', ''], ['<c>', 'beauty'],
+                     ['<c>', 'fashion', 'x'], ['<q>', 'hair', 'oil'], ['<q>', 'none']]:
+        mode, value = keywords[0], ' '.join(keywords[1:]).strip()
+        if mode == '<a>':
+            expected = [p for p in products if value in p['Attributes']]
+        elif mode == '<c>':
+            expected = [p for p in products if p.get('category') == keywords[1].strip()]
+        else:
+            expected = [p for p in products if p['query'] == value]
+        assert index.search(keywords) == expected
+
+def test_attribute_to_asins():
+    products = make_products()
+    attribute_to_asins = ProductIndex(products, build_postings(products)).attribute_to_asins
+    assert attribute_to_asins['vegan'] == {'B01', 'B02'}
+    assert attribute_to_asins['unknown'] == set()
+    assert set(attribute_to_asins) == {'natural', 'vegan'}
+
+def test_product_lookups():
+    products = [
+        {'asin': 'b01', 'Title': 'Red Shoe', 'images': ['http://img/1.jpg']},
+        {'asin': 'B02', 'Title': 'red shoe', 'images': ['', 'http://img/2.jpg']},
+        {'asin': 'B03', 'Title': 'Soap'},
+    ]
+    lookups = ProductLookups.from_products(products)
+    assert lookups.url2asin == {'http://img/1.jpg': 'B01', 'http://img/2.jpg': 'B02'}
+    assert lookups.asin2name == {'b01': 'red shoe', 'b02': 'red shoe', 'b03': 'soap'}
+    assert lookups.name2asin == {'red shoe': 'b02', 'soap': 'b03'}
@@ -0,0 +1,139 @@
+import pytest
+from bs4 import BeautifulSoup
+from bs4.element import Comment
+from web_agent_site.app import app
+from web_agent_site.engine.engine import map_action_to_html, set_url_map
+from web_agent_site.engine.page import *
+
+HTML = """<!DOCTYPE html>
+<html>
+  <head>
+    <title>WebShop</title>
+    <script>let x = "<b>not text</b>";</script>
+  </head>
+  <body>
+    <!-- comment -->
+    <div id="instruction-text" class="text-center">
+      <h4>Instruction: <br>i want a &lt;red&gt; shoe</h4>
+    </div>
+    <button type="submit" class="btn btn-success">Back to Search</button>
+    <button class="btn btn-primary" type="submit">&lt; Prev</button>
+    <h4 class="product-asin"><a class="product-link" href="/x">B000000001</a></h5>
+    <h4 id="asin">asin<pre>  </pre></p>
+    <img id="product-image" src="https://img/1.jpg" class="item-page-img">
+    <h4>size</h4>
+    <input type="radio" id="radio_size0" name="size" value="9 Wide" data-url="/y">
+    <label for="radio_size0">9 Wide</label>
+  </body>
+</html>"""
+
+
+PRODUCT = {
+    'asin': 'B000000001',
+    'Title': 'Men\'s "Trail" Shoe <Waterproof> & Light',
+    'Price': '$29.99 to $35.00',
+    'Rating': 'N.A.',
+    'MainImage': 'https://img/1.jpg',
+    'Description': 'Line one.\n\n  Line <two> &amp; three  ',
+    'BulletPoints': ['  Mesh upper', 'Rubber sole\n', ''],
+    'Reviews': [
+        {'title': 'Great', 'score': '5', 'body': 'Fits well.\nWould buy again'},
+        {'title': '', 'score': 2, 'body': '   '},
+    ],
+    'Attributes': ['lightweight', 'non slip'],
+    'options': {'size': ['9 Wide', '10'], 'color': ['black | white']},
+    'option_to_image': {'black | white': 'https://img/2.jpg'},
+    'category': 'fashion', 'query': 'trail shoe', 'product_category': 'Shoes › Men',
+}
+PAGE_ARGS = dict(
+    session_id='abc', instruction_text='i want a <red> shoe, and price lower than 40.00 dollars',
+    keywords=['trail', 'shoe'], page=1, asin='B000000001', options={'size': '10'},
+)
+PAGES = {
+    'search': ('start', {}),
+    'search_results': ('search[trail shoe]', dict(
+        products=[PRODUCT, dict(PRODUCT, asin='B000000002', Title='  ')], total=2)),
+    'search_results_page_2': ('search[trail shoe]', dict(products=[PRODUCT], total=30, page=2)),
+    'item_page': ('click[B000000001]', dict(product_info=PRODUCT, show_attrs=False)),
+    'item_page_attrs': ('click[B000000001]', dict(product_info=PRODUCT, show_attrs=True)),
+    'description': ('click[Description]', dict(product_info=PRODUCT)),
+    'features': ('click[Features]', dict(product_info=PRODUCT)),
+    'reviews': ('click[Reviews]', dict(product_info=PRODUCT)),
+    'attributes': ('click[Attributes]', dict(product_info=PRODUCT)),
+    'done': ('click[Buy Now]', dict(
+        reward=0.75, reward_info={'r_att': 0.5}, goal_attrs=['non slip'],
+        purchased_attrs=['lightweight'], goal={'asin': 'B000000001', 'query': 'shoe'},
+        mturk_code='abc', query='trail shoe', category='fashion', product_category='Shoes')),
+}
+
+
+def render_page(name):
+    set_url_map(app.url_map)
+    action, kwargs = PAGES[name]
+    return map_action_to_html(action, **dict(PAGE_ARGS, **kwargs))
+
+
+def bs4_segments(html):
+    texts = BeautifulSoup(html, 'html.parser').findAll(text=True)
+    ignore = {'style', 'script', 'head', 'title', 'meta', '[document]'}
+    return [
+        (str(t), t.parent.name, t.parent.get('class'))
+        for t in texts
+        if t.parent.name not in ignore and not isinstance(t, Comment) and t != '\n'
+    ]
+
+
+def test_page_type_of():
+    assert page_type_of(None) is None
+    assert page_type_of('http://127.0.0.1:3000/abc') == ''
+    assert page_type_of('http://127.0.0.1:3000/item_sub_page/abc/B01') == 'item_sub_page'
+    assert page_type_of('http://127.0.0.1:3000/done/abc/B01/{}') == 'done'
+
+
+def test_segments_match_bs4():
+    page = build_page_model(HTML)
+    segments = [(s.text, s.parent, s.parent_class) for s in page.segments]
+    assert segments == bs4_segments(HTML)
+    assert ('  ', 'pre', None) in segments
+
+
+def test_page_fields():
+    page = build_page_model(HTML, 'http://127.0.0.1:3000/item_page/abc')
+    soup = BeautifulSoup(HTML, 'html.parser')
+    assert page.page_type == 'item_page'
+    assert page.instruction_text == soup.find(id='instruction-text').h4.text
+    assert page.image_url == 'https://img/1.jpg'
+    assert not page.has_search_bar
+    assert list(page.clickables) == ['back to search', '< prev', 'b000000001', '9 Wide']
+    assert page.clickables['b000000001'].get('class') == ['product-link']
+    assert page.clickables['9 Wide']['name'] == 'size'
+    assert page.clickables['back to search'].get('name') is None
+
+
+@pytest.mark.parametrize('name', list(PAGES))
+def test_rendered_pages_match_bs4(name):
+    """Every page the server renders reads the same from the page model as from BeautifulSoup"""
+    html = render_page(name)
+    page = build_page_model(html)
+    soup = BeautifulSoup(html, 'html.parser')
+
+    segments = [(s.text, s.parent, s.parent_class) for s in page.segments]
+    assert segments == bs4_segments(html)
+
+    # Same lookups as the HTML path of `WebAgentTextEnv`
+    clickables = {
+        f'{b.get_text()}'.lower(): b
+        for b in soup.find_all(class_='btn') + soup.find_all(class_='product-link')
+    }
+    for opt in soup.select('input[type="radio"]'):
+        clickables[f'{opt.get("value")}'] = opt
+    assert list(page.clickables) == list(clickables)
+    for text, element in page.clickables.items():
+        assert element.name == clickables[text].name
+        assert element.attrs == clickables[text].attrs
+
+    assert page.has_search_bar == (soup.find(id='search_input') is not None)
+    image = soup.find(id='product-image')
+    assert page.image_url == (image['src'] if image is not None else None)
+    instruction = soup.find(id='instruction-text')
+    assert page.instruction_text == (instruction.h4.text if instruction is not None else None)
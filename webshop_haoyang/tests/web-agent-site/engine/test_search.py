@@ -0,0 +1,72 @@
+import math
+from web_agent_site.engine.search import *
+
+DOCS = {
+    'B01': 'red running shoe for men',
+    'B02': 'blue running shoe',
+    'B03': 'red dress cotton red',
+    'B04': 'lemon shampoo with natural oils',
+    'B05': 'red shoe',
+}
+
+def bm25_scores(query, k1=BM25_K1, b=BM25_B):
+    docs = {docid: tokenize(text) for docid, text in DOCS.items()}
+    avg_len = sum(len(t) for t in docs.values()) / len(docs)
+    scores = {}
+    for docid, tokens in docs.items():
+        score = 0.0
+        for term in tokenize(query):
+            tf = tokens.count(term)
+            if tf == 0:
+                continue
+            df = sum(term in t for t in docs.values())
+            idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+            score += idf * tf / (tf + k1 * (1 - b + b * len(tokens) / avg_len))
+        if score > 0:
+            scores[docid] = score
+    return scores
+
+def test_tokenize():
+    assert tokenize('The Red-Shoe, for MEN!') == ['red', 'shoe', 'men']
+
+def test_bm25_scores():
+    searcher = BM25Searcher(list(DOCS), list(DOCS.values()))
+    for query in ['red shoe', 'running', 'red red', 'cotton dress', 'purple']:
+        expected = bm25_scores(query)
+        hits = searcher.search(query, k=10)
+        assert {h.docid: round(h.score, 4) for h in hits} == {d: round(s, 4) for d, s in expected.items()}
+        assert [h.score for h in hits] == sorted((h.score for h in hits), reverse=True)
+
+def test_bm25_search_many():
+    searcher = BM25Searcher(list(DOCS), list(DOCS.values()))
+    queries = ['red shoe', 'shampoo', '', 'running shoe']
+    batched = searcher.search_many(queries, k=2)
+    assert [[h.docid for h in hits] for hits in batched] == \
+        [[h.docid for h in searcher.search(q, k=2)] for q in queries]
+    assert batched[2] == []
+    assert all(len(hits) <= 2 for hits in batched)
+
+def test_bm25_ties_in_document_order():
+    searcher = BM25Searcher(['B1', 'B2', 'B3'], ['soap', 'soap', 'soap'])
+    assert [h.docid for h in searcher.search('soap', k=2)] == ['B1', 'B2']
+
+def test_product_document():
+    product = {
+        'asin': 'B01', 'Title': 'Red Shoe', 'Description': 'Nice', 'BulletPoints': ['Comfy'],
+        'options': {'size': ['8', '9'], 'color': ['red']},
+    }
+    assert product_document(product) == {
+        'id': 'B01',
+        'contents': 'red shoe nice comfy size: 8, 9, and color: red',
+    }
+
+def test_index_document():
+    product = {'asin': 'B01', 'Title': 'Red Shoe', 'Description': 'Nice', 'BulletPoints': ['Comfy'], 'options': {}}
+    doc = index_document(product, 12)
+    assert doc['row'] == '0000000012' and doc['contents'] == 'red shoe nice comfy '
+    # Term order is row order
+    assert row_term(9) < row_term(10) < row_term(REMOVED_ROW)
+    # Moved documents are re-indexed
+    assert document_hash(doc) == document_hash(index_document(product, 12))
+    assert document_hash(doc) != document_hash(index_document(product, 13))
+    assert removed_document('B01')['row'] == row_term(REMOVED_ROW)
@@ -0,0 +1,43 @@
+import pytest
+from web_agent_site.engine.catalog import write_catalog, open_catalog
+from web_agent_site.engine.shared import *
+
+def test_shared_server_state():
+    goals = [
+        {'asin': 'B000000001', 'instruction_text': 'i want shoes', 'goal_options': {'size': '9'}},
+        {'asin': 'B000000002', 'instruction_text': 'i want soap', 'goal_options': []},
+    ]
+    state = SharedServerState.create(goals, [0.5, 2.0], [10.0, 20.0, 30.0], catalog_dir='catalog')
+    try:
+        attached = SharedServerState.attach(state.name)
+        assert attached.meta == {'catalog_dir': 'catalog'}
+        assert len(attached.goals) == 2
+        assert attached.goals[1] == goals[1]
+        assert attached.goals[-2] == goals[0]
+        assert attached.weights.tolist() == [0.5, 2.0]
+        assert attached.prices.tolist() == [10.0, 20.0, 30.0]
+        with pytest.raises(IndexError):
+            attached.goals[2]
+
+        # Attached copies are independent of the shared goal
+        attached.goals[0]['instruction_text'] = 'changed'
+        assert attached.goals[0]['instruction_text'] == 'i want shoes'
+        attached.unlink()  # no-op for non-owners
+        attached.close()
+    finally:
+        state.unlink()
+        state.close()
+
+def test_shared_prices(tmp_path):
+    source = tmp_path / 'items.json'
+    source.write_text('[]')
+    products = [
+        {'asin': 'B000000002', 'pricing': [1.0], 'Attributes': []},
+        {'asin': 'B000000001', 'pricing': [2.0], 'Attributes': []},
+    ]
+    write_catalog(products, [0, 1], str(tmp_path / 'items.catalog'), [str(source)])
+    catalog = open_catalog(str(tmp_path / 'items.catalog'))
+    prices = SharedPrices(catalog, [7.0, 8.0])
+    assert prices['B000000001'] == 8.0
+    assert prices.get('B000000003') is None
+    assert dict(prices) == {'B000000002': 7.0, 'B000000001': 8.0}
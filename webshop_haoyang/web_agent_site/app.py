@@ -14,6 +14,7 @@ from rich import print
 from web_agent_site.engine.engine import (
     load_products,
     init_search_engine,
+    get_search_index_name,
     convert_web_app_string_to_var,
     get_top_n_product_from_keywords,
     get_product_per_page,
@@ -31,10 +32,11 @@ from web_agent_site.utils import (
 app = Flask(__name__)
 
 search_engine = None
+search_index = None
 all_products = None
 product_item_dict = None
 product_prices = None
-attribute_to_asins = None
+product_index = None
 goals = None
 weights = None
 
@@ -50,17 +52,19 @@ def home():
 def index(session_id):
     global user_log_dir
     global all_products, product_item_dict, \
-           product_prices, attribute_to_asins, \
-           search_engine, \
+           product_prices, product_index, \
+           search_engine, search_index, \
            goals, weights, user_sessions
 
     if search_engine is None:
-        all_products, product_item_dict, product_prices, attribute_to_asins = \
+        all_products, product_item_dict, product_prices, product_index = \
             load_products(
                 filepath=DEFAULT_FILE_PATH,
                 num_products=DEBUG_PROD_SIZE
             )
-        search_engine = init_search_engine(num_products=DEBUG_PROD_SIZE)
+        search_engine = init_search_engine(
+            num_products=DEBUG_PROD_SIZE, product_item_dict=product_item_dict)
+        search_index = get_search_index_name(DEBUG_PROD_SIZE, product_item_dict=product_item_dict)
         goals = get_goals(all_products, product_prices)
         random.seed(233)
         random.shuffle(goals)
@@ -117,7 +121,8 @@ def search_results(session_id, keywords, page):
         search_engine,
         all_products,
         product_item_dict,
-        attribute_to_asins,
+        product_index,
+        search_index,
     )
     products = get_product_per_page(top_n_products, page)
     html = map_action_to_html(
@@ -0,0 +1,515 @@
+"""
+Compiled, memory-mapped product catalog.
+
+`load_products` normally runs `json.load` over the whole of
+`items_shuffle.json` and normalizes every product in Python before the first
+episode can start. `compile_catalog` (see `engine.py`) runs that
+normalization once and hands the result to `write_catalog`, which lays it out
+on disk as:
+
+    meta.json       -- format version + fingerprint of the source files
+    records.bin     -- one JSON-encoded normalized product per row
+    offsets.npy     -- int64 (N + 1) byte offsets of each row in records.bin
+    asins.npy       -- |S10 asin per row
+    asin_order.npy  -- argsort of asins.npy, for binary search lookups
+    source_idx.npy  -- position of each row in the source JSON list
+    pricing.npy     -- float64 (N, 2) normalized pricing, NaN when single
+    {attr,category,query}_names.json -- sorted vocabulary of each indexed field
+    {attr,category,query}_offsets.npy, ..._rows.npy -- CSR value -> row index
+    {title,image}.bin, ..._offsets.npy -- lower-case title and image url per row
+    {title,image}_hash.npy, ..._hash_rows.npy -- sorted key hashes -> rows
+    goals.bin, goal_offsets.npy -- JSON-encoded goal fields of each row (empty
+                      for rows without instructions)
+    {human,synthetic}_goal_rows.npy -- rows with human / synthetic instructions
+
+`open_catalog` maps those files back in and exposes the same
+`all_products` / `product_item_dict` / `product_prices` / `product_index`
+views that `load_products` returns; products are only decoded on access.
+`ProductCatalog.lookups` serves `url2asin` / `asin2name` / `name2asin` from the
+title and image files without decoding products, and
+`ProductCatalog.goal_products` gives `get_goals` the goal fields alone.
+"""
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import random
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+import numpy as np
+
+from web_agent_site.engine.index import ProductIndex, ProductLookups, build_postings, product_image_url
+
+CATALOG_VERSION = 4
+ASIN_DTYPE = 'S10'
+PRODUCT_CACHE_SIZE = 4096
+
+# Instruction fields are stored for both goal modes and stripped on decode
+HUMAN_GOAL_KEYS = ('instructions',)
+SYNTHETIC_GOAL_KEYS = ('instruction_text', 'instruction_attributes')
+# Product fields `get_human_goals` / `get_synthetic_goals` read besides the instructions
+GOAL_FIELDS = ('asin', 'category', 'query', 'name', 'product_category', 'Title', 'options')
+
+# Indexed product field -> file prefix of its postings
+POSTING_FILES = {'Attributes': 'attr', 'category': 'category', 'query': 'query'}
+
+
+def catalog_path_for(filepath):
+    """Default location of the compiled catalog for a product JSON file"""
+    return os.path.splitext(filepath)[0] + '.catalog'
+
+
+def key_hash(key):
+    """Stable 64-bit hash of a string key"""
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def fingerprint(paths):
+    """Size + mtime of each source file, used to detect a stale catalog"""
+    result = {}
+    for path in paths:
+        stat = os.stat(path)
+        result[os.path.basename(path)] = [stat.st_size, int(stat.st_mtime)]
+    return result
+
+
+def write_catalog(products, source_idxs, out_dir, source_paths):
+    """
+    Write normalized products to `out_dir` in the compiled catalog format.
+
+    Arguments:
+    products (`list`) -- normalized product dicts, in `all_products` order
+    source_idxs (`list`) -- index of each product in the source JSON list
+    out_dir (`str`) -- catalog directory, created if missing
+    source_paths (`list`) -- files the catalog was built from
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    offsets = np.zeros(len(products) + 1, dtype=np.int64)
+    pricing = np.full((len(products), 2), np.nan, dtype=np.float64)
+    with open(os.path.join(out_dir, 'records.bin'), 'wb') as f:
+        for row, product in enumerate(products):
+            record = json.dumps(product).encode('utf-8')
+            f.write(record)
+            offsets[row + 1] = offsets[row] + len(record)
+            # empty pricing is priced at 100.0, as in `generate_product_prices`
+            values = product['pricing'][:2] or [100.0]
+            pricing[row, :len(values)] = values
+
+    asins = np.array([p['asin'] for p in products], dtype=ASIN_DTYPE)
+    postings = build_postings(products, list(POSTING_FILES))
+    for field, prefix in POSTING_FILES.items():
+        write_postings(out_dir, prefix, postings[field])
+    write_strings(out_dir, 'title', [p['Title'].lower() if 'Title' in p else None for p in products])
+    write_strings(out_dir, 'image', [product_image_url(p) for p in products])
+    write_goals(out_dir, products)
+
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, 'asins.npy'), asins)
+    np.save(os.path.join(out_dir, 'asin_order.npy'), np.argsort(asins, kind='stable'))
+    np.save(os.path.join(out_dir, 'source_idx.npy'), np.asarray(source_idxs, dtype=np.int64))
+    np.save(os.path.join(out_dir, 'pricing.npy'), pricing)
+
+    # Written last so a partially written catalog is never picked up
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(
+            version=CATALOG_VERSION,
+            num_products=len(products),
+            sources=fingerprint(source_paths),
+        ), f)
+
+
+def write_goals(out_dir, products):
+    """Write the goal fields of each product with instructions, so goals are built without decoding products"""
+    offsets = np.zeros(len(products) + 1, dtype=np.int64)
+    human_rows, synthetic_rows = [], []
+    with open(os.path.join(out_dir, 'goals.bin'), 'wb') as f:
+        for row, product in enumerate(products):
+            record = b''
+            human = 'instructions' in product
+            synthetic = product.get('instruction_text') is not None
+            if human or synthetic:
+                keys = GOAL_FIELDS + HUMAN_GOAL_KEYS + SYNTHETIC_GOAL_KEYS
+                record = json.dumps({key: product[key] for key in keys if key in product}).encode('utf-8')
+                f.write(record)
+            offsets[row + 1] = offsets[row] + len(record)
+            if human:
+                human_rows.append(row)
+            if synthetic:
+                synthetic_rows.append(row)
+    np.save(os.path.join(out_dir, 'goal_offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, 'human_goal_rows.npy'), np.asarray(human_rows, dtype=np.int64))
+    np.save(os.path.join(out_dir, 'synthetic_goal_rows.npy'), np.asarray(synthetic_rows, dtype=np.int64))
+
+
+def write_postings(out_dir, prefix, postings):
+    """Write value -> rows `postings` as a sorted vocabulary plus CSR arrays"""
+    names = sorted(postings)
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    flat_rows = []
+    for i, name in enumerate(names):
+        rows = postings[name]
+        offsets[i + 1] = offsets[i] + len(rows)
+        flat_rows += rows
+    np.save(os.path.join(out_dir, f'{prefix}_offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, f'{prefix}_rows.npy'), np.asarray(flat_rows, dtype=np.int64))
+    with open(os.path.join(out_dir, f'{prefix}_names.json'), 'w') as f:
+        json.dump(names, f)
+
+
+def write_strings(out_dir, prefix, strings):
+    """
+    Write one string per row plus a hash index to find the rows of a string;
+    `None` is stored as an empty string and left out of the hash index.
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    hashes, rows = [], []
+    with open(os.path.join(out_dir, f'{prefix}.bin'), 'wb') as f:
+        for row, string in enumerate(strings):
+            data = (string or '').encode('utf-8')
+            f.write(data)
+            offsets[row + 1] = offsets[row] + len(data)
+            if string is not None:
+                hashes.append(key_hash(string))
+                rows.append(row)
+    hashes = np.array(hashes, dtype=np.uint64)
+    rows = np.array(rows, dtype=np.int64)
+    # Sorted by hash, then row, so the last row of a key ends its run
+    order = np.lexsort((rows, hashes))
+    np.save(os.path.join(out_dir, f'{prefix}_offsets.npy'), offsets)
+    np.save(os.path.join(out_dir, f'{prefix}_hash.npy'), hashes[order])
+    np.save(os.path.join(out_dir, f'{prefix}_hash_rows.npy'), rows[order])
+
+
+def open_catalog(catalog_dir, source_paths=None, num_products=None, human_goals=True):
+    """
+    Open a compiled catalog, or return `None` if it is missing or stale.
+
+    Arguments:
+    catalog_dir (`str`) -- directory written by `write_catalog`
+    source_paths (`list`) -- if given, files whose fingerprint must still match
+    num_products (`int`) -- only expose products from the first `num_products`
+        entries of the source JSON, same as `load_products`
+    human_goals (`bool`) -- which instruction fields to keep on decode
+    """
+    meta_path = os.path.join(catalog_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != CATALOG_VERSION:
+        return None
+    if source_paths is not None and meta['sources'] != fingerprint(source_paths):
+        return None
+    return ProductCatalog(catalog_dir, num_products=num_products, human_goals=human_goals)
+
+
+class ProductCatalog:
+    """Read-only view over a compiled catalog directory"""
+    def __init__(self, catalog_dir, num_products=None, human_goals=True):
+        self.catalog_dir = catalog_dir
+        self.num_products = num_products
+        self.human_goals = human_goals
+
+        def load(name):
+            return np.load(os.path.join(catalog_dir, name), mmap_mode='r')
+
+        self.offsets = load('offsets.npy')
+        self.asins = load('asins.npy')
+        self.asin_order = load('asin_order.npy')
+        self.source_idx = load('source_idx.npy')
+        self.pricing = load('pricing.npy')
+
+        with open(os.path.join(catalog_dir, 'records.bin'), 'rb') as f:
+            # mmap of an empty file is not allowed
+            self.records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(f.fileno()).st_size > 0 else b''
+
+        # `num_products` selects a prefix of the source list, which is a prefix of rows
+        if num_products is None:
+            self.size = len(self.asins)
+        else:
+            self.size = int(np.searchsorted(self.source_idx, num_products, side='left'))
+
+        self.postings = {
+            field: CatalogPostings(self, prefix) for field, prefix in POSTING_FILES.items()
+        }
+
+        self.product = lru_cache(maxsize=PRODUCT_CACHE_SIZE)(self._decode)
+
+    def __len__(self):
+        return self.size
+
+    def _decode(self, row):
+        start, end = int(self.offsets[row]), int(self.offsets[row + 1])
+        product = json.loads(self.records[start:end])
+        drop = SYNTHETIC_GOAL_KEYS if self.human_goals else HUMAN_GOAL_KEYS
+        for key in drop:
+            product.pop(key, None)
+        return product
+
+    def row_of(self, asin):
+        """Row of `asin` in the catalog, or `None` if it is not exposed"""
+        try:
+            key = asin.encode('ascii')
+        except (AttributeError, UnicodeEncodeError):
+            return None
+        pos = int(np.searchsorted(self.asins, key, sorter=self.asin_order))
+        if pos >= len(self.asin_order):
+            return None
+        row = int(self.asin_order[pos])
+        if self.asins[row] != key or row >= self.size:
+            return None
+        return row
+
+    def asin(self, row):
+        return self.asins[row].decode('ascii')
+
+    def product_prices(self):
+        """Same sampling as `generate_product_prices`, without decoding products"""
+        product_prices = dict()
+        pricing = self.pricing[:self.size].tolist()
+        for row, (low, high) in enumerate(pricing):
+            if high != high:  # NaN -> single price
+                price = low
+            else:
+                price = random.uniform(low, high)
+            product_prices[self.asin(row)] = price
+        return product_prices
+
+    def product_index(self):
+        return CatalogProductIndex(self)
+
+    def goal_products(self, human_goals=True):
+        """
+        Exposed products with human (or synthetic) instructions, holding only
+        the fields `get_goals` reads; decodes `goals.bin`, not the products.
+        """
+        def load(name):
+            return np.load(os.path.join(self.catalog_dir, name), mmap_mode='r')
+
+        offsets = load('goal_offsets.npy')
+        rows = load('human_goal_rows.npy' if human_goals else 'synthetic_goal_rows.npy')
+        rows = rows[:int(np.searchsorted(rows, self.size, side='left'))].tolist()
+        drop = SYNTHETIC_GOAL_KEYS if human_goals else HUMAN_GOAL_KEYS
+        products = []
+        with open(os.path.join(self.catalog_dir, 'goals.bin'), 'rb') as f:
+            records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if rows else b''
+            for row in rows:
+                product = json.loads(records[int(offsets[row]):int(offsets[row + 1])])
+                for key in drop:
+                    product.pop(key, None)
+                products.append(product)
+        return products
+
+    def lookups(self):
+        titles, images = CatalogStrings(self, 'title'), CatalogStrings(self, 'image')
+        return ProductLookups(
+            CatalogUrlToAsin(self, images),
+            CatalogAsinToName(self, titles),
+            CatalogNameToAsin(self, titles),
+        )
+
+    def views(self):
+        """Returns (all_products, product_item_dict, product_prices, product_index)"""
+        return (
+            CatalogProducts(self),
+            CatalogProductDict(self),
+            self.product_prices(),
+            self.product_index(),
+        )
+
+
+class CatalogProducts(Sequence):
+    """Lazy `all_products` list"""
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __len__(self):
+        return len(self.catalog)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.catalog.product(row) for row in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('product index out of range')
+        return self.catalog.product(idx)
+
+
+class CatalogProductDict(Mapping):
+    """Lazy `product_item_dict` mapping asin -> product"""
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def __getitem__(self, asin):
+        row = self.catalog.row_of(asin)
+        if row is None:
+            raise KeyError(asin)
+        return self.catalog.product(row)
+
+    def __contains__(self, asin):
+        return self.catalog.row_of(asin) is not None
+
+    def __iter__(self):
+        return (self.catalog.asin(row) for row in range(len(self.catalog)))
+
+    def __len__(self):
+        return len(self.catalog)
+
+
+class CatalogPostings(Mapping):
+    """Lazy value -> rows postings of one indexed field, limited to the exposed rows"""
+    def __init__(self, catalog, prefix):
+        self.catalog = catalog
+        self.offsets = np.load(os.path.join(catalog.catalog_dir, f'{prefix}_offsets.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(catalog.catalog_dir, f'{prefix}_rows.npy'), mmap_mode='r')
+        with open(os.path.join(catalog.catalog_dir, f'{prefix}_names.json')) as f:
+            self.names = json.load(f)
+
+    def __getitem__(self, value):
+        i = bisect.bisect_left(self.names, value)
+        if i == len(self.names) or self.names[i] != value:
+            raise KeyError(value)
+        rows = self.rows[self.offsets[i]:self.offsets[i + 1]]
+        # Rows are ascending, so the exposed ones are a prefix
+        end = int(np.searchsorted(rows, self.catalog.size, side='left'))
+        if end == 0:
+            raise KeyError(value)
+        return rows[:end].tolist()
+
+    def __iter__(self):
+        return (name for name in self.names if name in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class CatalogProductIndex(ProductIndex):
+    """`ProductIndex` over the catalog postings, without decoding products for asins"""
+    def __init__(self, catalog):
+        super().__init__(CatalogProducts(catalog), catalog.postings)
+        self.catalog = catalog
+
+    def asin(self, row):
+        return self.catalog.asin(row)
+
+
+class CatalogStrings:
+    """Per-row strings written by `write_strings`, with lookups limited to the exposed rows"""
+    def __init__(self, catalog, prefix):
+        self.catalog = catalog
+
+        def load(name):
+            return np.load(os.path.join(catalog.catalog_dir, name), mmap_mode='r')
+
+        self.offsets = load(f'{prefix}_offsets.npy')
+        self.hashes = load(f'{prefix}_hash.npy')
+        self.hash_rows = load(f'{prefix}_hash_rows.npy')
+        with open(os.path.join(catalog.catalog_dir, f'{prefix}.bin'), 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(f.fileno()).st_size > 0 else b''
+
+    def __getitem__(self, row):
+        return self.data[int(self.offsets[row]):int(self.offsets[row + 1])].decode('utf-8')
+
+    def last_row(self, string):
+        """Last exposed row holding `string`, or `None`"""
+        h = np.uint64(key_hash(string))
+        start = int(np.searchsorted(self.hashes, h, side='left'))
+        end = int(np.searchsorted(self.hashes, h, side='right'))
+        for row in self.hash_rows[start:end][::-1].tolist():
+            if row < self.catalog.size and self[row] == string:
+                return row
+        return None
+
+    def keys(self):
+        """Distinct exposed strings of the hash index"""
+        for row in self.hash_rows.tolist():
+            if row < self.catalog.size:
+                string = self[row]
+                if self.last_row(string) == row:
+                    yield string
+
+
+class CatalogUrlToAsin(Mapping):
+    """Lazy `url2asin` mapping image url -> upper-case asin"""
+    def __init__(self, catalog, images):
+        self.catalog = catalog
+        self.images = images
+
+    def __getitem__(self, url):
+        row = self.images.last_row(url) if isinstance(url, str) else None
+        if row is None:
+            raise KeyError(url)
+        return self.catalog.asin(row).upper()
+
+    def __iter__(self):
+        return self.images.keys()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class CatalogAsinToName(Mapping):
+    """Lazy `asin2name` mapping lower-case asin -> lower-case title"""
+    def __init__(self, catalog, titles):
+        self.catalog = catalog
+        self.titles = titles
+
+    def _row(self, asin):
+        if not isinstance(asin, str):
+            return None
+        row = self.catalog.row_of(asin.upper())
+        if row is None or self.catalog.asin(row).lower() != asin:
+            return None
+        return row
+
+    def __getitem__(self, asin):
+        row = self._row(asin)
+        if row is None:
+            raise KeyError(asin)
+        return self.titles[row]
+
+    def __contains__(self, asin):
+        return self._row(asin) is not None
+
+    def __iter__(self):
+        return (self.catalog.asin(row).lower() for row in range(len(self.catalog)))
+
+    def __len__(self):
+        return len(self.catalog)
+
+
+class CatalogNameToAsin(Mapping):
+    """Lazy `name2asin` mapping lower-case title -> lower-case asin"""
+    def __init__(self, catalog, titles):
+        self.catalog = catalog
+        self.titles = titles
+
+    def __getitem__(self, name):
+        row = self.titles.last_row(name) if isinstance(name, str) else None
+        if row is None:
+            raise KeyError(name)
+        return self.catalog.asin(row).lower()
+
+    def __iter__(self):
+        return self.titles.keys()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+if __name__ == '__main__':
+    import argparse
+    from web_agent_site.engine.engine import compile_catalog
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Compile the product catalog for fast loading')
+    parser.add_argument('--filepath', default=DEFAULT_FILE_PATH, help='Product JSON file')
+    parser.add_argument('--out', default=None, help='Catalog directory (default: next to --filepath)')
+    args = parser.parse_args()
+    compile_catalog(args.filepath, out_dir=args.out)
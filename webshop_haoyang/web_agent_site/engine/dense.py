@@ -0,0 +1,368 @@
+"""
+Dense retrieval backend for the keyword search.
+
+Product embeddings are computed once (`python -m web_agent_site.engine.dense`)
+and stored in a directory as:
+
+    meta.json         -- encoder model name, dimension and number of products
+    asins.npy         -- |S10 asin per row
+    embeddings.npy    -- float16 (N, dim) L2-normalized embeddings, memory-mapped
+    ivf_centroids.npy -- float32 (nlist, dim) k-means centroids
+    ivf_order.npy, ivf_offsets.npy -- rows grouped by nearest centroid
+    hnsw.faiss        -- optional faiss HNSW index over the embeddings
+
+`DenseSearcher` answers queries by inner product with a faiss HNSW index if
+faiss is installed, or with the NumPy IVF lists otherwise (only the `nprobe`
+closest clusters are scanned). Searches can be restricted to the rows of a
+smaller catalog: small subsets are scanned exactly, larger ones through the
+IVF lists with other rows masked out. Any embedding matrix can be stored with
+`write_dense_store`, e.g. CLIP image embeddings, as long as the searcher gets
+an encoder that maps queries into the same space. `HybridSearcher` fuses a
+lexical backend and a dense one with reciprocal rank fusion.
+"""
+import json
+import os
+
+import numpy as np
+
+from web_agent_site.engine.catalog import ASIN_DTYPE
+from web_agent_site.engine.search import SearchBackend, SearchHit
+
+DEFAULT_DENSE_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+DENSE_ANN_METHODS = ('auto', 'faiss', 'ivf', 'exact')
+DEFAULT_NPROBE = 16
+HNSW_M = 32
+HNSW_EF_SEARCH = 128
+KMEANS_ITERS = 10
+KMEANS_SAMPLE_PER_LIST = 256
+EXACT_CHUNK_SIZE = 1 << 16
+# Row subsets up to this size are scanned exactly instead of through an index
+EXACT_SUBSET_ROWS = 1 << 16
+# Reciprocal rank fusion constant (Cormack et al., 2009)
+RRF_K = 60
+
+
+def normalize_rows(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def top_k_rows(scores, rows, k):
+    """Best `k` (row, score) pairs, ties by row as in the lexical backends"""
+    if len(scores) > k:
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        keep = scores >= kth
+        scores, rows = scores[keep], rows[keep]
+    order = np.lexsort((rows, -scores))[:k]
+    return rows[order], scores[order]
+
+
+def kmeans(x, nlist, iters=KMEANS_ITERS, seed=0):
+    """Spherical k-means centroids of the rows of `x`, fit on a sample"""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(x), nlist * KMEANS_SAMPLE_PER_LIST)
+    sample = normalize_rows(x[np.sort(rng.choice(len(x), sample_size, replace=False))])
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+    for _ in range(iters):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        for c in range(nlist):
+            members = sample[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def assign_clusters(embeddings, centroids, chunk_size=EXACT_CHUNK_SIZE):
+    assign = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), chunk_size):
+        chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+        assign[start:start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assign
+
+
+def write_dense_store(out_dir, asins, embeddings, model=None, nlist=None, seed=0, build_faiss=False):
+    """
+    Write product embeddings and their IVF lists to `out_dir`.
+
+    Arguments:
+    out_dir (`str`) -- store directory, created if missing
+    asins (`list`) -- asin of each row
+    embeddings (`np.ndarray`) -- (N, dim) product embeddings
+    model (`str`) -- name of the encoder that produced them, used for queries
+    nlist (`int`) -- number of IVF clusters (default: about sqrt(N))
+    build_faiss (`bool`) -- also build and save a faiss HNSW index
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    embeddings = normalize_rows(embeddings)
+    num_rows, dim = embeddings.shape
+    nlist = max(1, min(num_rows, nlist or int(np.sqrt(num_rows)))) if num_rows else 0
+
+    np.save(os.path.join(out_dir, 'asins.npy'), np.array(asins, dtype=ASIN_DTYPE))
+    np.save(os.path.join(out_dir, 'embeddings.npy'), embeddings.astype(np.float16))
+    if num_rows:
+        centroids = kmeans(embeddings, nlist, seed=seed)
+        assign = assign_clusters(embeddings, centroids)
+        order = np.argsort(assign, kind='stable')
+        offsets = np.searchsorted(assign[order], np.arange(nlist + 1))
+    else:
+        centroids = np.zeros((0, dim), dtype=np.float32)
+        order = offsets = np.zeros(1, dtype=np.int64)
+    np.save(os.path.join(out_dir, 'ivf_centroids.npy'), centroids.astype(np.float32))
+    np.save(os.path.join(out_dir, 'ivf_order.npy'), order.astype(np.int64))
+    np.save(os.path.join(out_dir, 'ivf_offsets.npy'), np.asarray(offsets, dtype=np.int64))
+    if build_faiss:
+        import faiss
+        faiss.write_index(build_hnsw(embeddings), os.path.join(out_dir, 'hnsw.faiss'))
+
+    # Written last so a partially written store is never picked up
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(model=model, dim=dim, num_products=num_rows, nlist=nlist), f)
+
+
+def build_hnsw(embeddings, chunk_size=EXACT_CHUNK_SIZE):
+    import faiss
+    index = faiss.IndexHNSWFlat(embeddings.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    for start in range(0, len(embeddings), chunk_size):
+        index.add(np.ascontiguousarray(embeddings[start:start + chunk_size], dtype=np.float32))
+    return index
+
+
+def store_version(store_dir):
+    """Write time of a store's `meta.json` (written last), or `None` if there is no store"""
+    try:
+        return os.stat(os.path.join(store_dir, 'meta.json')).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class DenseStore:
+    """Memory-mapped view of a directory written by `write_dense_store`"""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(store_dir, name), mmap_mode='r')
+
+        self.asins = load('asins.npy')
+        self.embeddings = load('embeddings.npy')
+        self.centroids = np.load(os.path.join(store_dir, 'ivf_centroids.npy'))
+        self.order = load('ivf_order.npy')
+        self.offsets = load('ivf_offsets.npy')
+
+    def __len__(self):
+        return len(self.asins)
+
+    def asin(self, row):
+        return self.asins[row].decode('ascii')
+
+    def rows_of(self, asins):
+        """Sorted rows of the `asins` that are in the store"""
+        keys = np.array(list(asins), dtype=ASIN_DTYPE)
+        return np.flatnonzero(np.isin(self.asins, keys))
+
+
+class TextEncoder:
+    """Mean-pooled transformer sentence embeddings, loaded on first use"""
+    def __init__(self, model=DEFAULT_DENSE_MODEL, batch_size=64, device='cpu'):
+        self.model_name = model
+        self.batch_size = batch_size
+        self.device = device
+        self.tokenizer = None
+        self.model = None
+
+    def __call__(self, texts):
+        import torch
+        if self.model is None:
+            from transformers import AutoModel, AutoTokenizer
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            self.model = AutoModel.from_pretrained(self.model_name).to(self.device).eval()
+        outputs = []
+        with torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                batch = self.tokenizer(
+                    list(texts[start:start + self.batch_size]), padding=True,
+                    truncation=True, max_length=256, return_tensors='pt',
+                ).to(self.device)
+                hidden = self.model(**batch).last_hidden_state
+                mask = batch['attention_mask'].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+                outputs.append(pooled.cpu().numpy())
+        if not outputs:
+            return np.zeros((0, 0), dtype=np.float32)
+        return normalize_rows(np.concatenate(outputs))
+
+
+class DenseSearcher(SearchBackend):
+    """
+    Nearest products of the query embedding by inner product.
+
+    Arguments:
+    store (`DenseStore`) -- product embeddings
+    encoder (callable) -- maps a list of queries to an (n, dim) array
+        (default: `TextEncoder` of the store's model)
+    ann (`str`) -- 'faiss' (HNSW), 'ivf' (NumPy IVF lists), 'exact' or 'auto'
+        (faiss if installed, else ivf)
+    nprobe (`int`) -- IVF clusters scanned per query, more if they hold fewer
+        than `k` rows
+    rows (`np.ndarray`) -- if given, only these store rows are searched; up to
+        `EXACT_SUBSET_ROWS` of them are scanned exactly, more use the IVF lists
+    """
+    def __init__(self, store, encoder=None, ann='auto', nprobe=DEFAULT_NPROBE, rows=None):
+        if ann not in DENSE_ANN_METHODS:
+            raise ValueError(f'Unknown ann method {ann!r}, expected one of {DENSE_ANN_METHODS}')
+        self.store = store
+        self.encoder = encoder if encoder is not None else \
+            TextEncoder(store.meta.get('model') or DEFAULT_DENSE_MODEL)
+        self.nprobe = nprobe
+        self.rows = None if rows is None else np.unique(np.asarray(rows, dtype=np.int64))
+        self.mask = None
+        if self.rows is not None and ann != 'exact':
+            if len(self.rows) <= EXACT_SUBSET_ROWS:
+                ann = 'exact'
+            else:
+                # The HNSW graph cannot skip rows, the IVF lists can
+                ann = 'ivf'
+                self.mask = np.zeros(len(store), dtype=bool)
+                self.mask[self.rows] = True
+        if ann == 'auto':
+            try:
+                import faiss  # noqa: F401
+                ann = 'faiss'
+            except ImportError:
+                ann = 'ivf'
+        self.ann = ann
+        self.faiss_index = self._load_faiss() if ann == 'faiss' else None
+
+    def _load_faiss(self):
+        import faiss
+        path = os.path.join(self.store.store_dir, 'hnsw.faiss')
+        index = faiss.read_index(path) if os.path.exists(path) else build_hnsw(self.store.embeddings)
+        index.hnsw.efSearch = max(HNSW_EF_SEARCH, index.hnsw.efSearch)
+        return index
+
+    def search(self, query, k=10):
+        return self.search_many([query], k=k)[0]
+
+    def __len__(self):
+        return len(self.store) if self.rows is None else len(self.rows)
+
+    def search_many(self, queries, k=10):
+        if not queries or len(self) == 0:
+            return [[] for _ in queries]
+        vectors = normalize_rows(self.encoder(list(queries)))
+        if self.ann == 'faiss':
+            scores, rows = self.faiss_index.search(vectors, min(k, len(self.store)))
+            results = [(r[r >= 0], s[r >= 0]) for r, s in zip(rows, scores)]
+        elif self.ann == 'ivf':
+            results = [self._search_ivf(vector, k) for vector in vectors]
+        else:
+            results = self._search_exact(vectors, k)
+        return [
+            [SearchHit(self.store.asin(row), float(score)) for row, score in zip(rows, scores)]
+            for rows, scores in results
+        ]
+
+    def _search_ivf(self, vector, k):
+        clusters = np.argsort(-(self.store.centroids @ vector), kind='stable')
+        candidates, num_candidates = [], 0
+        for probed, c in enumerate(clusters.tolist()):
+            if probed >= self.nprobe and num_candidates >= k:
+                break
+            rows = np.asarray(self.store.order[self.store.offsets[c]:self.store.offsets[c + 1]])
+            if self.mask is not None:
+                rows = rows[self.mask[rows]]
+            candidates.append(rows)
+            num_candidates += len(rows)
+        rows = np.concatenate(candidates)
+        rows.sort()  # sequential reads from the memory map
+        scores = np.asarray(self.store.embeddings[rows], dtype=np.float32) @ vector
+        return top_k_rows(scores, rows, k)
+
+    def _search_exact(self, vectors, k):
+        best = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in vectors]
+        for start in range(0, len(self), EXACT_CHUNK_SIZE):
+            if self.rows is None:
+                rows = np.arange(start, min(start + EXACT_CHUNK_SIZE, len(self.store)))
+                chunk = self.store.embeddings[start:start + EXACT_CHUNK_SIZE]
+            else:
+                rows = self.rows[start:start + EXACT_CHUNK_SIZE]
+                chunk = self.store.embeddings[rows]
+            chunk_scores = vectors @ np.asarray(chunk, dtype=np.float32).T
+            for i, scores in enumerate(chunk_scores):
+                merged_rows = np.concatenate([best[i][0], rows])
+                merged_scores = np.concatenate([best[i][1], scores])
+                best[i] = top_k_rows(merged_scores, merged_rows, k)
+        return best
+
+
+class HybridSearcher(SearchBackend):
+    """
+    Reciprocal rank fusion of a lexical and a dense backend: each product
+    scores sum(weight / (RRF_K + rank)) over the rankings it appears in.
+
+    Arguments:
+    lexical (`SearchBackend`), dense (`SearchBackend`) -- backends to fuse
+    depth (`int`) -- hits taken from each backend before fusion
+    dense_weight (`float`) -- weight of the dense ranking (lexical weight is 1)
+    """
+    def __init__(self, lexical, dense, depth=100, dense_weight=1.0):
+        self.lexical = lexical
+        self.dense = dense
+        self.depth = depth
+        self.dense_weight = dense_weight
+
+    def search(self, query, k=10):
+        return self.search_many([query], k=k)[0]
+
+    def search_many(self, queries, k=10):
+        depth = max(k, self.depth)
+        lexical_hits = self.lexical.search_many(queries, k=depth)
+        dense_hits = self.dense.search_many(queries, k=depth)
+        return [self.fuse(l, d, k) for l, d in zip(lexical_hits, dense_hits)]
+
+    def fuse(self, lexical_hits, dense_hits, k):
+        scores = dict()
+        for weight, hits in [(1.0, lexical_hits), (self.dense_weight, dense_hits)]:
+            for rank, hit in enumerate(hits, start=1):
+                scores[hit.docid] = scores.get(hit.docid, 0.0) + weight / (RRF_K + rank)
+        # Ties keep the lexical order, then the dense order (dicts keep insertion order)
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [SearchHit(docid, score) for docid, score in ranked]
+
+
+if __name__ == '__main__':
+    import argparse
+    from tqdm import tqdm
+    from web_agent_site.engine.engine import DENSE_DIR, load_products
+    from web_agent_site.engine.search import product_document
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Embed all products for the dense search backend')
+    parser.add_argument('--filepath', default=DEFAULT_FILE_PATH, help='Product JSON file')
+    parser.add_argument('--out', default=DENSE_DIR, help='Store directory')
+    parser.add_argument('--model', default=DEFAULT_DENSE_MODEL, help='Hugging Face encoder')
+    parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--nlist', default=None, type=int, help='IVF clusters (default: sqrt(#products))')
+    parser.add_argument('--faiss', action='store_true', help='also build a faiss HNSW index')
+    args = parser.parse_args()
+
+    all_products, *_ = load_products(args.filepath)
+    docs = [product_document(p) for p in tqdm(all_products, total=len(all_products))]
+    encoder = TextEncoder(args.model, batch_size=args.batch_size, device=args.device)
+    embeddings = []
+    for start in tqdm(range(0, len(docs), 1024)):
+        embeddings.append(encoder([d['contents'] for d in docs[start:start + 1024]]))
+    write_dense_store(
+        args.out,
+        [d['id'] for d in docs],
+        np.concatenate(embeddings),
+        model=args.model,
+        nlist=args.nlist,
+        build_faiss=args.faiss,
+    )
+    print(f'Embedded {len(docs)} products into {args.out}')
@@ -4,17 +4,24 @@ import os
 import re
 import json
 import random
-from collections import defaultdict
 from ast import literal_eval
+from collections import OrderedDict
 from decimal import Decimal
 
 import cleantext
 from tqdm import tqdm
-from rank_bm25 import BM25Okapi
-from flask import render_template_string
+from flask import has_request_context, url_for as flask_url_for
+from jinja2 import Environment, FileSystemLoader
 from rich import print
-from pyserini.search.lucene import LuceneSearcher
 
+from web_agent_site.engine.catalog import (
+    catalog_path_for,
+    open_catalog,
+    write_catalog,
+)
+from web_agent_site.engine.dense import DenseSearcher, DenseStore, HybridSearcher, store_version
+from web_agent_site.engine.index import INDEX_FIELDS, ProductIndex, build_postings
+from web_agent_site.engine.search import BM25Searcher, LuceneBackend, has_manifest, index_version
 from web_agent_site.utils import (
     BASE_DIR,
     DEFAULT_FILE_PATH,
@@ -24,9 +31,17 @@ from web_agent_site.utils import (
 )
 
 TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
+SEARCH_ENGINE_DIR = os.path.join(BASE_DIR, '../search_engine')
+DENSE_DIR = os.path.join(SEARCH_ENGINE_DIR, 'dense')
 
 SEARCH_RETURN_N = 50
 PRODUCT_WINDOW = 10
+SEARCH_CACHE_SIZE = 10000
+SEARCH_BACKENDS = ('lucene', 'bm25', 'dense', 'hybrid')
+# Catalog size -> Lucene index directory under `search_engine/`
+LUCENE_INDEXES = {None: 'indexes', 100: 'indexes_100', 1000: 'indexes_1k', 100000: 'indexes_100k'}
+# Leading keywords of searches that do not go to the search backend
+SPECIAL_SEARCH_MODES = ('<r>', '<a>', '<c>', '<q>')
 TOP_K_ATTR = 10
 
 END_BUTTON = 'Buy Now'
@@ -41,19 +56,51 @@ ACTION_TO_TEMPLATE = {
     'Attributes': 'attributes_page.html',
 }
 
+# Compiled page templates, loaded once per process (see `get_template`)
+_template_env = None
+# URL map used to build `url_for` links when rendering outside of a Flask request
+_url_adapter = None
+
+
+def set_url_map(url_map):
+    """Build template links against `url_map` when no Flask request is active"""
+    global _url_adapter
+    _url_adapter = url_map.bind('localhost')
+
+
+def template_url_for(endpoint, **values):
+    """`url_for` for templates; same links as `flask.url_for` in a test request"""
+    if has_request_context():
+        return flask_url_for(endpoint, **values)
+    if _url_adapter is None:
+        raise RuntimeError('Rendering outside of a Flask request requires `set_url_map`.')
+    return _url_adapter.build(endpoint, values)
+
+
+def get_template(name):
+    """Compiled template `name` from `TEMPLATE_DIR`, cached for the process"""
+    global _template_env
+    if _template_env is None:
+        # Same settings Flask uses for `render_template_string`
+        _template_env = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            autoescape=True,
+            auto_reload=False,
+            cache_size=-1,
+        )
+        _template_env.globals['url_for'] = template_url_for
+    return _template_env.get_template(name)
+
+
 def map_action_to_html(action, **kwargs):
     action_name, action_arg = parse_action(action)
     if action_name == 'start':
-        path = os.path.join(TEMPLATE_DIR, 'search_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = get_template('search_page.html').render(
             session_id=kwargs['session_id'],
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'search':
-        path = os.path.join(TEMPLATE_DIR, 'results_page.html')
-        html = render_template_string(
-            read_html_template(path=path),
+        html = get_template('results_page.html').render(
             session_id=kwargs['session_id'],
             products=kwargs['products'],
             keywords=kwargs['keywords'],
@@ -62,9 +109,7 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs['instruction_text'],
         )
     elif action_name == 'click' and action_arg == END_BUTTON:
-        path = os.path.join(TEMPLATE_DIR, 'done_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = get_template('done_page.html').render(
             session_id=kwargs['session_id'],
             reward=kwargs['reward'],
             asin=kwargs['asin'],
@@ -79,9 +124,7 @@ def map_action_to_html(action, **kwargs):
             product_category=kwargs.get('product_category'),
         )
     elif action_name == 'click' and action_arg in ACTION_TO_TEMPLATE:
-        path = os.path.join(TEMPLATE_DIR, ACTION_TO_TEMPLATE[action_arg])
-        html = render_template_string(
-            read_html_template(path),
+        html = get_template(ACTION_TO_TEMPLATE[action_arg]).render(
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -91,9 +134,7 @@ def map_action_to_html(action, **kwargs):
             instruction_text=kwargs.get('instruction_text')
         )
     elif action_name == 'click':
-        path = os.path.join(TEMPLATE_DIR, 'item_page.html')
-        html = render_template_string(
-            read_html_template(path),
+        html = get_template('item_page.html').render(
             session_id=kwargs['session_id'],
             product_info=kwargs['product_info'],
             keywords=kwargs['keywords'],
@@ -108,12 +149,6 @@ def map_action_to_html(action, **kwargs):
     return html
 
 
-def read_html_template(path):
-    with open(path) as f:
-        template = f.read()
-    return template
-
-
 def parse_action(action):
     """
     Parse action string to action name and its arguments.
@@ -145,19 +180,129 @@ def convert_web_app_string_to_var(name, string):
     return var
 
 
+class SearchCache:
+    """
+    Bounded LRU cache of ranked search results, shared by every `SimServer` in
+    the process. Keys are (index name, k, normalized query), values the ranked
+    ASINs returned by the searcher.
+    """
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        asins = self.entries.get(key)
+        if asins is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return asins
+
+    def put(self, key, asins):
+        self.entries[key] = tuple(asins)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def info(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self.entries), maxsize=self.maxsize)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def save(self, path):
+        """Write entries, least recently used first, to a JSON file"""
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump([[*key, list(asins)] for key, asins in self.entries.items()], f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Add entries written by `save`; returns False if `path` is missing"""
+        if not os.path.exists(path):
+            return False
+        with open(path) as f:
+            for index, k, query, asins in json.load(f):
+                if (index, k, query) not in self.entries:
+                    self.put((index, k, query), asins)
+        return True
+
+
+search_cache = SearchCache()
+
+
+def normalize_keywords(keywords):
+    """Search query for `keywords`, with whitespace collapsed as the analyzer would"""
+    return ' '.join(' '.join(keywords).split())
+
+
+def search_asins(search_engine, keywords, k=SEARCH_RETURN_N, search_index=None):
+    """
+    Ranked ASINs of the top `k` hits for `keywords`.
+
+    Arguments:
+    search_engine (`SearchBackend`) -- searcher to query
+    keywords (`list`) -- search keywords
+    k (`int`) -- number of hits
+    search_index (`str`) -- name of the index `search_engine` was opened on, see
+        `get_search_index_name`; if set, results are cached in `search_cache`
+    """
+    key = (search_index, k, normalize_keywords(keywords))
+    if search_index is not None:
+        asins = search_cache.get(key)
+        if asins is not None:
+            return asins
+    hits = search_engine.search(' '.join(keywords), k=k)
+    # Documents are indexed with the ASIN as their id, see `search_engine/build_index.py`
+    asins = tuple(hit.docid for hit in hits)
+    if search_index is not None:
+        search_cache.put(key, asins)
+    return asins
+
+
+def search_asins_many(search_engine, keywords_list, k=SEARCH_RETURN_N, search_index=None):
+    """
+    Same as `search_asins` for a batch of keyword lists; queries that are not
+    cached are sent to the search backend in one `search_many` call.
+    """
+    results = [None] * len(keywords_list)
+    missing = dict()  # query -> positions in `keywords_list`
+    for i, keywords in enumerate(keywords_list):
+        key = (search_index, k, normalize_keywords(keywords))
+        if search_index is not None:
+            results[i] = search_cache.get(key)
+        if results[i] is None:
+            missing.setdefault(' '.join(keywords), []).append(i)
+    if missing:
+        queries = list(missing)
+        for query, hits in zip(queries, search_engine.search_many(queries, k=k)):
+            asins = tuple(hit.docid for hit in hits)
+            if search_index is not None:
+                search_cache.put((search_index, k, normalize_keywords([query])), asins)
+            for i in missing[query]:
+                results[i] = asins
+    return results
+
+
 def get_top_n_product_from_keywords(
         keywords,
         search_engine,
         all_products,
         product_item_dict,
-        attribute_to_asins=None,
+        product_index=None,
+        search_index=None,
     ):
     if keywords[0] == '<r>':
         top_n_products = random.sample(all_products, k=SEARCH_RETURN_N)
+    elif keywords[0] in INDEX_FIELDS and product_index is not None:
+        top_n_products = product_index.search(keywords)
     elif keywords[0] == '<a>':
         attribute = ' '.join(keywords[1:]).strip()
-        asins = attribute_to_asins[attribute]
-        top_n_products = [p for p in all_products if p['asin'] in asins]
+        top_n_products = [p for p in all_products if attribute in p['Attributes']]
     elif keywords[0] == '<c>':
         category = keywords[1].strip()
         top_n_products = [p for p in all_products if p['category'] == category]
@@ -165,10 +310,7 @@ def get_top_n_product_from_keywords(
         query = ' '.join(keywords[1:]).strip()
         top_n_products = [p for p in all_products if p['query'] == query]
     else:
-        keywords = ' '.join(keywords)
-        hits = search_engine.search(keywords, k=SEARCH_RETURN_N)
-        docs = [search_engine.doc(hit.docid) for hit in hits]
-        top_n_asins = [json.loads(doc.raw())['id'] for doc in docs]
+        top_n_asins = search_asins(search_engine, keywords, search_index=search_index)
         top_n_products = [product_item_dict[asin] for asin in top_n_asins if asin in product_item_dict]
     return top_n_products
 
@@ -192,19 +334,77 @@ def generate_product_prices(all_products):
     return product_prices
 
 
-def init_search_engine(num_products=None):
-    if num_products == 100:
-        indexes = 'indexes_100'
-    elif num_products == 1000:
-        indexes = 'indexes_1k'
-    elif num_products == 100000:
-        indexes = 'indexes_100k'
-    elif num_products is None:
-        indexes = 'indexes'
-    else:
+def get_search_index_name(num_products=None, backend='lucene', product_item_dict=None, dense_dir=DENSE_DIR):
+    """
+    Name of the index `init_search_engine` opens with the same arguments, used
+    in `search_cache` keys. It includes the version of the index files, so
+    results saved for an index that was rebuilt or updated are not reused.
+    """
+    if backend == 'bm25':
+        return f'bm25_{num_products}'
+    if backend == 'dense':
+        return f'dense_{num_products}@{store_version(dense_dir)}'
+    index_dir, _ = lucene_index(num_products, product_item_dict)
+    size_name = LUCENE_INDEXES.get(num_products, f'indexes_{num_products}')
+    name = f'{size_name}@{os.path.basename(index_dir)}.{index_version(index_dir)}'
+    if backend == 'hybrid':
+        return f'hybrid_{num_products}@{name}+{store_version(dense_dir)}'
+    return name
+
+
+def lucene_index(num_products=None, product_item_dict=None):
+    """
+    Lucene index directory for a catalog of `num_products`, and the number of
+    catalog rows its searches are restricted to (`None` for all documents).
+    The full index built by `search_engine/build_index.py` serves every catalog
+    size with a row filter, given the loaded `product_item_dict`; otherwise
+    the prebuilt index of that size is used. `LuceneBackend` drops the filter
+    when the rows cover every indexed document.
+    """
+    full_index = os.path.join(SEARCH_ENGINE_DIR, LUCENE_INDEXES[None])
+    if product_item_dict is not None and has_manifest(full_index):
+        return full_index, len(product_item_dict)
+    if num_products not in LUCENE_INDEXES:
         raise NotImplementedError(f'num_products being {num_products} is not supported yet.')
-    search_engine = LuceneSearcher(os.path.join(BASE_DIR, f'../search_engine/{indexes}'))
-    return search_engine
+    return os.path.join(SEARCH_ENGINE_DIR, LUCENE_INDEXES[num_products]), None
+
+
+def init_search_engine(num_products=None, backend='lucene', all_products=None, product_item_dict=None,
+                       dense_dir=DENSE_DIR):
+    """
+    Search backend over the first `num_products` products.
+
+    Arguments:
+    num_products (`int`) -- catalog size
+    backend (`str`) -- 'lucene' (prebuilt pyserini index, needs Java), 'bm25'
+        (in-memory index built from `all_products`), 'dense' (product
+        embeddings in `dense_dir`, see `engine/dense.py`) or 'hybrid' (rank
+        fusion of 'lucene' and 'dense')
+    all_products (`list`) -- products to index for the 'bm25' backend
+    product_item_dict (`dict`) -- loaded products; searches of a full index
+        built by `search_engine/build_index.py` are filtered to their rows
+        instead of opening a separate index per catalog size
+    dense_dir (`str`) -- store written by `python -m web_agent_site.engine.dense`
+    """
+    if backend in ('dense', 'hybrid'):
+        store = DenseStore(dense_dir)
+        # The store embeds the full catalog, smaller catalogs only search their rows
+        rows = None
+        if num_products is not None and product_item_dict is not None:
+            rows = store.rows_of(product_item_dict)
+        dense = DenseSearcher(store, rows=rows)
+        if backend == 'dense':
+            return dense
+        lexical = init_search_engine(num_products, 'lucene', all_products, product_item_dict)
+        return HybridSearcher(lexical, dense)
+    if backend == 'lucene':
+        index_dir, num_rows = lucene_index(num_products, product_item_dict)
+        return LuceneBackend(index_dir, num_rows=num_rows)
+    elif backend == 'bm25':
+        if all_products is None:
+            raise ValueError('The bm25 search backend needs `all_products` to index.')
+        return BM25Searcher.from_products(all_products)
+    raise ValueError(f'Unknown search backend {backend!r}, expected one of {SEARCH_BACKENDS}')
 
 
 def clean_product_keys(products):
@@ -227,7 +427,142 @@ def clean_product_keys(products):
     return products
 
 
+def normalize_product(p, all_reviews=None, all_ratings=None):
+    """Rewrite a raw scraped product (in place) into the fields the site renders"""
+    all_reviews = all_reviews or dict()
+    all_ratings = all_ratings or dict()
+    asin = p['asin']
+
+    p['Title'] = p['name']
+    p['Description'] = p['full_description']
+    p['Reviews'] = all_reviews.get(asin, [])
+    p['Rating'] = all_ratings.get(asin, 'N.A.')
+    for r in p['Reviews']:
+        if 'score' not in r:
+            r['score'] = r.pop('stars')
+        if 'review' not in r:
+            r['body'] = ''
+        else:
+            r['body'] = r.pop('review')
+    p['BulletPoints'] = p['small_description'] \
+        if isinstance(p['small_description'], list) else [p['small_description']]
+
+    pricing = p.get('pricing')
+    if pricing is None or not pricing:
+        pricing = [100.0]
+        price_tag = '$100.0'
+    else:
+        pricing = [
+            float(Decimal(re.sub(r'[^\d.]', '', price)))
+            for price in pricing.split('$')[1:]
+        ]
+        if len(pricing) == 1:
+            price_tag = f"${pricing[0]}"
+        else:
+            price_tag = f"${pricing[0]} to ${pricing[1]}"
+            pricing = pricing[:2]
+    p['pricing'] = pricing
+    p['Price'] = price_tag
+
+    options = dict()
+    customization_options = p['customization_options']
+    option_to_image = dict()
+    if customization_options:
+        for option_name, option_contents in customization_options.items():
+            if option_contents is None:
+                continue
+            option_name = option_name.lower()
+
+            option_values = []
+            for option_content in option_contents:
+                option_value = option_content['value'].strip().replace('/', ' | ').lower()
+                option_image = option_content.get('image', None)
+
+                option_values.append(option_value)
+                option_to_image[option_value] = option_image
+            options[option_name] = option_values
+    p['options'] = options
+    p['option_to_image'] = option_to_image
+    return p
+
+
+def is_valid_product(product, asins):
+    """Skip malformed and duplicate asins; records accepted asins in `asins`"""
+    asin = product['asin']
+    if asin == 'nan' or len(asin) > 10:
+        return False
+    if asin in asins:
+        return False
+    asins.add(asin)
+    return True
+
+
+def load_attributes():
+    with open(DEFAULT_ATTR_PATH) as f:
+        attributes = json.load(f)
+    with open(HUMAN_ATTR_PATH) as f:
+        human_attributes = json.load(f)
+    print('Attributes loaded.')
+    print("HUMAN ATTRIBUTES PATH=" + HUMAN_ATTR_PATH)
+    return attributes, human_attributes
+
+
+def compile_catalog(filepath=DEFAULT_FILE_PATH, out_dir=None):
+    """
+    One-time preprocessing step: normalize every product in `filepath` and
+    write the result as a memory-mapped catalog that `load_products` picks up
+    on subsequent runs. Instruction fields for both human and synthetic goals
+    are stored; `load_products` keeps the ones matching `human_goals`.
+    """
+    out_dir = catalog_path_for(filepath) if out_dir is None else out_dir
+    with open(filepath) as f:
+        products = json.load(f)
+    print('Products loaded.')
+    products = clean_product_keys(products)
+    attributes, human_attributes = load_attributes()
+
+    asins = set()
+    all_products, source_idxs = [], []
+    for i, p in tqdm(enumerate(products), total=len(products)):
+        if not is_valid_product(p, asins):
+            continue
+        asin = p['asin']
+        normalize_product(p)
+        if asin in attributes and 'attributes' in attributes[asin]:
+            p['Attributes'] = attributes[asin]['attributes']
+        else:
+            p['Attributes'] = ['DUMMY_ATTR']
+        if asin in human_attributes:
+            p['instructions'] = human_attributes[asin]
+        p['instruction_text'] = attributes.get(asin, {}).get('instruction', None)
+        p['instruction_attributes'] = attributes.get(asin, {}).get('instruction_attributes', None)
+        p['MainImage'] = p['images'][0]
+        p['query'] = p['query'].lower().strip()
+        all_products.append(p)
+        source_idxs.append(i)
+
+    write_catalog(
+        all_products,
+        source_idxs,
+        out_dir,
+        source_paths=[filepath, DEFAULT_ATTR_PATH, HUMAN_ATTR_PATH],
+    )
+    print(f'Catalog of {len(all_products)} products written to {out_dir}.')
+    return out_dir
+
+
 def load_products(filepath, num_products=None, human_goals=True):
+    # Use the compiled catalog (see `compile_catalog`) if it is up to date
+    catalog = open_catalog(
+        catalog_path_for(filepath),
+        source_paths=[filepath, DEFAULT_ATTR_PATH, HUMAN_ATTR_PATH],
+        num_products=num_products,
+        human_goals=human_goals,
+    ) if os.path.exists(filepath) else None
+    if catalog is not None:
+        print('Products loaded from compiled catalog.')
+        return catalog.views()
+
     # TODO: move to preprocessing step -> enforce single source of truth
     with open(filepath) as f:
         products = json.load(f)
@@ -242,86 +577,18 @@ def load_products(filepath, num_products=None, human_goals=True):
     #     all_reviews[r['asin']] = r['reviews']
     #     all_ratings[r['asin']] = r['average_rating']
 
-    if human_goals:
-        with open(HUMAN_ATTR_PATH) as f:
-            human_attributes = json.load(f)
-    with open(DEFAULT_ATTR_PATH) as f:
-        attributes = json.load(f)
-    with open(HUMAN_ATTR_PATH) as f:
-        human_attributes = json.load(f)
-    print('Attributes loaded.')
-    print("HUMAN ATTRIBUTES PATH=" + HUMAN_ATTR_PATH)
+    attributes, human_attributes = load_attributes()
 
     asins = set()
     all_products = []
-    attribute_to_asins = defaultdict(set)
     if num_products is not None:
         # using item_shuffle.json, we assume products already shuffled
         products = products[:num_products]
     for i, p in tqdm(enumerate(products), total=len(products)):
-        asin = p['asin']
-        if asin == 'nan' or len(asin) > 10:
-            continue
-
-        if asin in asins:
+        if not is_valid_product(p, asins):
             continue
-        else:
-            asins.add(asin)
-
-        products[i]['category'] = p['category']
-        products[i]['query'] = p['query']
-        products[i]['product_category'] = p['product_category']
-
-        products[i]['Title'] = p['name']
-        products[i]['Description'] = p['full_description']
-        products[i]['Reviews'] = all_reviews.get(asin, [])
-        products[i]['Rating'] = all_ratings.get(asin, 'N.A.')
-        for r in products[i]['Reviews']:
-            if 'score' not in r:
-                r['score'] = r.pop('stars')
-            if 'review' not in r:
-                r['body'] = ''
-            else:
-                r['body'] = r.pop('review')
-        products[i]['BulletPoints'] = p['small_description'] \
-            if isinstance(p['small_description'], list) else [p['small_description']]
-
-        pricing = p.get('pricing')
-        if pricing is None or not pricing:
-            pricing = [100.0]
-            price_tag = '$100.0'
-        else:
-            pricing = [
-                float(Decimal(re.sub(r'[^\d.]', '', price)))
-                for price in pricing.split('$')[1:]
-            ]
-            if len(pricing) == 1:
-                price_tag = f"${pricing[0]}"
-            else:
-                price_tag = f"${pricing[0]} to ${pricing[1]}"
-                pricing = pricing[:2]
-        products[i]['pricing'] = pricing
-        products[i]['Price'] = price_tag
-
-        options = dict()
-        customization_options = p['customization_options']
-        option_to_image = dict()
-        if customization_options:
-            for option_name, option_contents in customization_options.items():
-                if option_contents is None:
-                    continue
-                option_name = option_name.lower()
-
-                option_values = []
-                for option_content in option_contents:
-                    option_value = option_content['value'].strip().replace('/', ' | ').lower()
-                    option_image = option_content.get('image', None)
-
-                    option_values.append(option_value)
-                    option_to_image[option_value] = option_image
-                options[option_name] = option_values
-        products[i]['options'] = options
-        products[i]['option_to_image'] = option_to_image
+        asin = p['asin']
+        normalize_product(products[i], all_reviews, all_ratings)
 
         # without color, size, price, availability
         # if asin in attributes and 'attributes' in attributes[asin]:
@@ -355,10 +622,9 @@ def load_products(filepath, num_products=None, human_goals=True):
 
         all_products.append(products[i])
 
-    for p in all_products:
-        for a in p['Attributes']:
-            attribute_to_asins[a].add(p['asin'])
+    # Attribute, category and query -> products, for the `<a>`, `<c>` and `<q>` searches
+    product_index = ProductIndex(all_products, build_postings(all_products))
 
     product_item_dict = {p['asin']: p for p in all_products}
     product_prices = generate_product_prices(all_products)
-    return all_products, product_item_dict, product_prices, attribute_to_asins
+    return all_products, product_item_dict, product_prices, product_index
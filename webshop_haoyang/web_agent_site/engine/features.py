@@ -0,0 +1,172 @@
+"""
+Memory-mapped store of the product image features.
+
+`feat_conv.pt` (ResNet features, one row per image) and `feat_ids.pt` (the
+image url of each row) used to be unpickled with `torch.load` in every
+process, and each `WebAgentTextEnv` built its own `{url: row}` dict.
+`compile_feature_store` converts them once into a directory of:
+
+    meta.json     -- format version, dtype + fingerprint of the source files
+    feats.npy     -- (N, dim) features, memory-mapped
+    url_hash.npy  -- sorted uint64 hashes of the image urls
+    url_row.npy   -- row of `feats.npy` for each hash
+
+`open_feature_store` maps them back in: startup is an `mmap` call, every env
+process shares the same page cache, and `FeatureStore.get` returns a tensor
+view of the mapped row (float16 stores are converted on access).
+"""
+import json
+import os
+
+import numpy as np
+
+from web_agent_site.engine.catalog import fingerprint, key_hash
+from web_agent_site.utils import FEAT_CONV, FEAT_IDS, FEAT_STORE_DIR
+
+FEATURE_STORE_VERSION = 1
+
+
+def build_url_index(urls):
+    """
+    Sorted url hashes and their rows. A url listed twice maps to its last row,
+    as the `{url: idx}` dict it replaces did.
+    """
+    rows = {}
+    for row, url in enumerate(urls):
+        rows[url] = row
+    hashes = {}
+    for url, row in rows.items():
+        h = key_hash(url)
+        if h in hashes:
+            raise ValueError(f'Image url hash collision: {url!r} and {hashes[h][0]!r}')
+        hashes[h] = (url, row)
+    hash_array = np.array(sorted(hashes), dtype=np.uint64)
+    row_array = np.array([hashes[int(h)][1] for h in hash_array], dtype=np.int64)
+    return hash_array, row_array
+
+
+def write_feature_store(out_dir, urls, feats, dtype='float32', source_paths=()):
+    """
+    Write image features to `out_dir` in the feature store format.
+
+    Arguments:
+    out_dir (`str`) -- store directory, created if missing
+    urls (`list`) -- image url of each row of `feats`
+    feats (`np.ndarray` or `torch.Tensor`) -- (N, dim) features
+    dtype (`str`) -- 'float32' or 'float16' (half the size, converted on access)
+    source_paths (`list`) -- files the store was built from
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    feats = np.asarray(feats.numpy() if hasattr(feats, 'numpy') else feats, dtype=dtype)
+    hashes, rows = build_url_index(urls)
+    np.save(os.path.join(out_dir, 'feats.npy'), feats)
+    np.save(os.path.join(out_dir, 'url_hash.npy'), hashes)
+    np.save(os.path.join(out_dir, 'url_row.npy'), rows)
+
+    # Written last so a partially written store is never picked up
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(
+            version=FEATURE_STORE_VERSION,
+            dtype=dtype,
+            shape=list(feats.shape),
+            sources=fingerprint(source_paths),
+        ), f)
+
+
+def compile_feature_store(feat_conv=FEAT_CONV, feat_ids=FEAT_IDS, out_dir=FEAT_STORE_DIR, dtype='float32'):
+    """One-time conversion of `feat_conv.pt` and `feat_ids.pt` into a feature store"""
+    import torch
+    write_feature_store(
+        out_dir,
+        list(torch.load(feat_ids)),
+        torch.load(feat_conv),
+        dtype=dtype,
+        source_paths=[feat_conv, feat_ids],
+    )
+    return out_dir
+
+
+def open_feature_store(store_dir=FEAT_STORE_DIR, source_paths=None):
+    """
+    Open a feature store, or return `None` if it is missing or stale.
+
+    Arguments:
+    store_dir (`str`) -- directory written by `write_feature_store`
+    source_paths (`list`) -- if given, files whose fingerprint must still match
+    """
+    meta_path = os.path.join(store_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('version') != FEATURE_STORE_VERSION:
+        return None
+    if source_paths is not None and meta['sources'] != fingerprint(source_paths):
+        return None
+    return FeatureStore(store_dir)
+
+
+def load_feature_store(store_dir=FEAT_STORE_DIR, feat_conv=FEAT_CONV, feat_ids=FEAT_IDS):
+    """Open the feature store of `feat_conv`/`feat_ids`, compiling it first if needed"""
+    source_paths = [feat_conv, feat_ids] if os.path.exists(feat_conv) else None
+    store = open_feature_store(store_dir, source_paths)
+    if store is None:
+        compile_feature_store(feat_conv, feat_ids, store_dir)
+        store = FeatureStore(store_dir)
+    return store
+
+
+class FeatureStore:
+    """Read-only image features looked up by image url"""
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        # Copy-on-write mapping: shared pages, and torch accepts it as writable
+        self.feats = np.load(os.path.join(store_dir, 'feats.npy'), mmap_mode='c')
+        self.hashes = np.load(os.path.join(store_dir, 'url_hash.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(store_dir, 'url_row.npy'), mmap_mode='r')
+
+    def __getstate__(self):
+        # Spawned workers map the files again instead of receiving a copy
+        return {'store_dir': self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_dir'])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, url):
+        return self.row(url) is not None
+
+    @property
+    def dim(self):
+        return self.feats.shape[1]
+
+    def row(self, url):
+        """Row of the features of `url`, or `None`"""
+        h = np.uint64(key_hash(url))
+        i = np.searchsorted(self.hashes, h)
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return int(self.rows[i])
+        return None
+
+    def get(self, url, default=None):
+        """Float32 tensor of the features of `url`, a view of the mapped file when stored as float32"""
+        import torch
+        row = self.row(url)
+        if row is None:
+            return default
+        return torch.from_numpy(self.feats[row]).float()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert feat_conv.pt and feat_ids.pt into a memory-mapped feature store')
+    parser.add_argument('--feat_conv', default=FEAT_CONV)
+    parser.add_argument('--feat_ids', default=FEAT_IDS)
+    parser.add_argument('--out', default=FEAT_STORE_DIR, help='Store directory')
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    args = parser.parse_args()
+    compile_feature_store(args.feat_conv, args.feat_ids, args.out, args.dtype)
+    print(f'Feature store of {len(FeatureStore(args.out))} images written to {args.out}')
@@ -2,18 +2,56 @@
 Functions for specifying goals and reward calculations.
 """
 import itertools
+import json
+import os
 import random
-import spacy
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 from rich import print
 from thefuzz import fuzz
+from thefuzz.utils import full_process
+from web_agent_site.engine.catalog import CatalogProducts
 from web_agent_site.engine.normalize import normalize_color
+from web_agent_site.utils import DEFAULT_NOUN_TABLE_PATH
 
-nlp = spacy.load("en_core_web_lg")
+try:
+    from rapidfuzz import fuzz as rfuzz
+    from rapidfuzz.process import cdist
+except ImportError:
+    cdist = None
 
 PRICE_RANGE = [10.0 * i for i in range(1, 100)]
 
+NOUN_POS = ('PNOUN', 'NOUN', 'PROPN')
+NOUN_CACHE_SIZE = 65536
+# Larger goal sets (e.g. synthetic goals) rely on the on-disk table and the LRU
+MAX_PRECOMPUTED_GOAL_NAMES = 50000
+
+# Product/goal name -> lowercased noun tokens, see `build_noun_table`
+noun_table = dict()
+_loaded_noun_tables = set()
+
+SPACY_MODEL = 'en_core_web_lg'
+# Components `get_type_reward` does not need; POS tags come from tok2vec, tagger and attribute_ruler
+SPACY_TAGGER_EXCLUDE = ['parser', 'ner', 'lemmatizer']
+NOUN_BACKENDS = ('spacy', 'spacy_tagger', 'table')
+
+_nlp = dict()  # pipeline name -> loaded spaCy pipeline
+_noun_backend = 'spacy'
+
+# Attribute/option pairs above this `token_set_ratio` count as a match
+FUZZY_MATCH_THRESHOLD = 85
+PROCESSED_CACHE_SIZE = 65536
+SEARCH_TEXT_CACHE_SIZE = 4096
+_search_texts = OrderedDict()  # asin -> {field: lowercased text}
+PRODUCT_REWARD_CACHE_SIZE = 65536
+# (goal asin, instruction, product asin) -> type and attribute rewards
+_product_rewards = OrderedDict()
+
 def get_goals(all_products, product_prices, human_goals=True):
+    # A compiled catalog stores the goal fields apart, so products are not decoded
+    if isinstance(all_products, CatalogProducts):
+        all_products = all_products.catalog.goal_products(human_goals)
     if human_goals:
         return get_human_goals(all_products, product_prices)
     else:
@@ -135,6 +173,122 @@ def get_synthetic_goals(all_products, product_prices):
     return goals
 
 
+def get_nlp(tagger_only=False):
+    """
+    Load the spaCy pipeline on first use, so importing this module stays cheap.
+
+    Arguments:
+    tagger_only (`bool`) -- drop the parser, NER and lemmatizer, which do not
+        change the POS tags but take time and memory
+    """
+    key = 'spacy_tagger' if tagger_only else 'spacy'
+    if key not in _nlp:
+        import spacy
+        exclude = SPACY_TAGGER_EXCLUDE if tagger_only else []
+        _nlp[key] = spacy.load(SPACY_MODEL, exclude=exclude)
+    return _nlp[key]
+
+
+def set_noun_backend(backend):
+    """
+    Choose how `extract_nouns` parses names missing from `noun_table`.
+
+    Arguments:
+    backend (`str` or callable) -- 'spacy' (full pipeline, default),
+        'spacy_tagger' (tagger-only pipeline), 'table' (no spaCy, names missing
+        from `noun_table` have no nouns) or a function mapping a list of names
+        to a list of noun token lists
+    """
+    global _noun_backend
+    if not callable(backend) and backend not in NOUN_BACKENDS:
+        raise ValueError(f'Unknown noun backend {backend!r}, expected one of {NOUN_BACKENDS} or a callable')
+    _noun_backend = backend
+    _parse_nouns.cache_clear()
+    _product_rewards.clear()
+
+
+def clear_product_caches():
+    """
+    Drop the per-ASIN caches of `get_search_text` and `get_product_rewards`;
+    call when products or goals are (re)loaded, since their keys only name ASINs.
+    """
+    _search_texts.clear()
+    _product_rewards.clear()
+
+
+def extract_nouns(names, batch_size=256):
+    """Lowercased noun tokens of each name, in order and with duplicates"""
+    if callable(_noun_backend):
+        return [list(nouns) for nouns in _noun_backend(list(names))]
+    if _noun_backend == 'table':
+        return [[] for _ in names]
+    nlp = get_nlp(tagger_only=_noun_backend == 'spacy_tagger')
+    return [
+        [t.text.lower() for t in doc if t.pos_ in NOUN_POS]
+        for doc in nlp.pipe(names, batch_size=batch_size)
+    ]
+
+
+def build_noun_table(names):
+    """Parse the names missing from `noun_table` in one batch and add them"""
+    if _noun_backend == 'table':
+        return noun_table
+    missing = sorted({name for name in names if isinstance(name, str) and name not in noun_table})
+    if missing:
+        noun_table.update(zip(missing, extract_nouns(missing)))
+    return noun_table
+
+
+def load_noun_table(path=DEFAULT_NOUN_TABLE_PATH):
+    """Add a table written by `save_noun_table` once per process; returns False if `path` is missing"""
+    if path in _loaded_noun_tables:
+        return True
+    if not os.path.exists(path):
+        return False
+    with open(path) as f:
+        noun_table.update(json.load(f))
+    _loaded_noun_tables.add(path)
+    return True
+
+
+def save_noun_table(path=DEFAULT_NOUN_TABLE_PATH):
+    with open(path, 'w') as f:
+        json.dump(noun_table, f)
+
+
+def init_noun_table(goals=None, path=DEFAULT_NOUN_TABLE_PATH):
+    """
+    Load the precomputed product table. With `goals`, also parse the goal names
+    missing from it in one batch (spaCy is only loaded if there are any) and
+    return the noun tokens of all goal names, e.g. to hand to worker processes.
+    """
+    load_noun_table(path)
+    if goals is None:
+        return None
+    names = {goal['name'] for goal in goals}
+    if len(names) <= MAX_PRECOMPUTED_GOAL_NAMES:
+        build_noun_table(names)
+    return {name: noun_table[name] for name in names if name in noun_table}
+
+
+def add_noun_table(table):
+    """Add noun tokens parsed elsewhere, e.g. the goal names `init_noun_table` returned in the parent"""
+    noun_table.update(table)
+
+
+@lru_cache(maxsize=NOUN_CACHE_SIZE)
+def _parse_nouns(name):
+    return extract_nouns([name])[0]
+
+
+def get_nouns(name):
+    """Noun tokens of a product or goal name, from `noun_table` or parsed once"""
+    nouns = noun_table.get(name)
+    if nouns is None:
+        nouns = _parse_nouns(name)
+    return nouns
+
+
 def get_type_reward(purchased_product, goal):
     """Determines the type reward - captures whether chosen product is in the same category"""
     query_match = purchased_product['query'] == goal['query']
@@ -148,11 +302,8 @@ def get_type_reward(purchased_product, goal):
     purchased_type = purchased_product['name']
     desired_type = goal['name']
 
-    purchased_type_parse = nlp(purchased_type)
-    desired_type_parse = nlp(desired_type)
-
-    purchased_type_parse = [t.text.lower() for t in purchased_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
-    desired_type_parse = [t.text.lower() for t in desired_type_parse if t.pos_ in ('PNOUN', 'NOUN', 'PROPN')]
+    purchased_type_parse = get_nouns(purchased_type)
+    desired_type_parse = get_nouns(desired_type)
 
     n_intersect_type = len(
         set(purchased_type_parse) & set(desired_type_parse)
@@ -183,32 +334,71 @@ def get_type_reward(purchased_product, goal):
     )
 
 
+@lru_cache(maxsize=PROCESSED_CACHE_SIZE)
+def _processed(s):
+    """String as `fuzz.token_set_ratio` compares it (ascii, alphanumeric, lowercased)"""
+    return full_process(s, force_ascii=True)
+
+
+def fuzzy_matches(queries, choices):
+    """
+    Whether each query has a `fuzz.token_set_ratio` above `FUZZY_MATCH_THRESHOLD`
+    with any of the choices. Scores all pairs in one `rapidfuzz` call if available.
+    """
+    if not queries or not choices:
+        return [False] * len(queries)
+    if cdist is None:
+        return [
+            any(fuzz.token_set_ratio(c, q) > FUZZY_MATCH_THRESHOLD for c in choices)
+            for q in queries
+        ]
+    # Same processing and rounding as `fuzz.token_set_ratio`
+    scores = cdist(
+        [_processed(q) for q in queries],
+        [_processed(c) for c in choices],
+        scorer=rfuzz.token_set_ratio,
+    )
+    return [any(round(score) > FUZZY_MATCH_THRESHOLD for score in row) for row in scores.tolist()]
+
+
+def get_search_text(purchased_product, field):
+    """Lowercased 'Title', 'BulletPoints' or 'Description' of a product, cached per ASIN"""
+    asin = purchased_product.get('asin')
+    if asin is None:
+        texts = dict()
+    elif asin in _search_texts:
+        texts = _search_texts[asin]
+        _search_texts.move_to_end(asin)
+    else:
+        texts = _search_texts[asin] = dict()
+        if len(_search_texts) > SEARCH_TEXT_CACHE_SIZE:
+            _search_texts.popitem(last=False)
+    if field not in texts:
+        text = purchased_product[field]
+        if field == 'BulletPoints':
+            text = ' '.join(text)
+        texts[field] = text.lower()
+    return texts[field]
+
+
 def get_attribute_reward(purchased_product, goal):
     """Determines whether purchased products shares same attributes as goal"""
     purchased_attrs = purchased_product['Attributes']
     goal_attrs = goal['attributes']
 
+    # Check whether goal attribute found in purchased product attribute list
+    matches = fuzzy_matches(goal_attrs, purchased_attrs)
+
     num_attr_matches = 0
-    for g_attr in goal_attrs:
-        matched = False
-        # Check whether goal attribute found in purchased product attribute list
-        for p_attr in purchased_attrs:
-            score = fuzz.token_set_ratio(p_attr, g_attr)
-            if score > 85:
-                num_attr_matches += 1
-                matched = True
-                break
+    for g_attr, matched in zip(goal_attrs, matches):
         # If not in purchased attrs, check Title, Bullet Points (Features), Desc
         if (
-            not matched and
-            (
-                g_attr in purchased_product['Title'].lower() or
-                g_attr in ' '.join(purchased_product['BulletPoints']).lower() or
-                g_attr in purchased_product['Description'].lower()
-            )
+            matched or
+            g_attr in get_search_text(purchased_product, 'Title') or
+            g_attr in get_search_text(purchased_product, 'BulletPoints') or
+            g_attr in get_search_text(purchased_product, 'Description')
         ):
             num_attr_matches += 1
-            matched = True
     
     r_attr = num_attr_matches / len(goal_attrs)
     return r_attr, num_attr_matches
@@ -220,29 +410,43 @@ def get_option_reward(purchased_options, goal_options):
     goal_options = [normalize_color(o) for o in goal_options]
 
     # Perform fuzzy matching of each purchased option against each goal option
-    num_option_matches = 0
-    for g_option in goal_options:
-        for p_option in purchased_options:
-            score = fuzz.token_set_ratio(p_option, g_option)
-            if score > 85:
-                num_option_matches += 1
-                break
+    num_option_matches = sum(fuzzy_matches(goal_options, purchased_options))
     
     # Calculate option reward as fraction of goal options hit
     r_option = num_option_matches / len(goal_options) if len(goal_options) > 0 else None
     return r_option, num_option_matches
 
 
+def get_product_rewards(purchased_product, goal):
+    """
+    Type and attribute rewards of a product for a goal, as
+    (`get_type_reward` dict, r_att, num_attr_matches). They do not depend on
+    the selected options or price, so they are computed once per (goal, ASIN).
+    """
+    key = (goal.get('asin'), goal.get('instruction_text'), purchased_product.get('asin'))
+    if None in key:
+        return (get_type_reward(purchased_product, goal), *get_attribute_reward(purchased_product, goal))
+    if key in _product_rewards:
+        _product_rewards.move_to_end(key)
+        return _product_rewards[key]
+    rewards = _product_rewards[key] = (
+        get_type_reward(purchased_product, goal),
+        *get_attribute_reward(purchased_product, goal),
+    )
+    if len(_product_rewards) > PRODUCT_REWARD_CACHE_SIZE:
+        _product_rewards.popitem(last=False)
+    return rewards
+
+
 def get_reward(purchased_product, goal, price, options, **kwargs):
     """Get cumulative reward score for purchased product and goal"""
-    r_type_dict = get_type_reward(purchased_product, goal)
+    # Only the option and price terms change as options are clicked
+    r_type_dict, r_att, num_attr_matches = get_product_rewards(purchased_product, goal)
 
     r_price = (
         price <= goal['price_upper']
     ) if goal['price_upper'] > 0 else None
 
-    r_att, num_attr_matches = get_attribute_reward(purchased_product, goal)
-
     r_option, num_option_matches = get_option_reward(
         list(options.values()),
         goal['goal_options'].items()
@@ -275,3 +479,18 @@ def get_reward(purchased_product, goal, price, options, **kwargs):
             info['w_price'] = 1 / (len(goal['attributes']) + len(goal['goal_options']) + 1)
         return total_reward, info
     return total_reward
+
+
+if __name__ == '__main__':
+    import argparse
+    from web_agent_site.engine.engine import load_products
+    from web_agent_site.utils import DEFAULT_FILE_PATH
+
+    parser = argparse.ArgumentParser(description='Precompute noun tokens of all product names for the type reward')
+    parser.add_argument('--filepath', default=DEFAULT_FILE_PATH, help='Product JSON file')
+    parser.add_argument('--out', default=DEFAULT_NOUN_TABLE_PATH, help='Output JSON table')
+    args = parser.parse_args()
+    all_products, *_ = load_products(args.filepath)
+    build_noun_table(p['name'] for p in all_products if 'name' in p)
+    save_noun_table(args.out)
+    print(f'Saved noun tokens of {len(noun_table)} names to {args.out}')
@@ -0,0 +1,151 @@
+"""
+Secondary indexes over the product catalog.
+
+The `<a>`, `<c>` and `<q>` search modes select every product with a given
+attribute, category or query. Instead of scanning `all_products` on each
+search, `build_postings` maps each field value to the positions of its
+products in `all_products` once, and `ProductIndex` answers lookups from those
+postings. Positions are kept in ascending order, so results come back in the
+same order as a scan of `all_products`.
+
+Postings are a `{field: {value: [row, ...]}}` mapping. `load_products` builds
+them as plain dicts; a compiled catalog stores them on disk (see `catalog.py`)
+and exposes a lazy mapping with the same interface.
+
+`ProductLookups` holds the image url -> asin, asin -> name and name -> asin
+mappings used by the agents (`WebEnv`, `get_raw_image`), built from the loaded
+products instead of parsing the product file a second time.
+"""
+from collections.abc import Mapping
+
+# Search mode -> product field it looks up
+INDEX_FIELDS = {
+    '<a>': 'Attributes',
+    '<c>': 'category',
+    '<q>': 'query',
+}
+MULTI_VALUED_FIELDS = {'Attributes'}
+
+
+def field_values(product, field):
+    """Values of `field` in `product` to index, skipping missing values"""
+    value = product.get(field)
+    if value is None:
+        return []
+    if field in MULTI_VALUED_FIELDS:
+        return [v for v in value if v is not None]
+    return [value]
+
+
+def build_postings(products, fields=None):
+    """
+    Map each value of each indexed field to the sorted, distinct rows of the
+    products that have it.
+
+    Arguments:
+    products (`list`) -- products in `all_products` order
+    fields (`list`) -- fields to index (default: all of `INDEX_FIELDS`)
+    """
+    fields = list(INDEX_FIELDS.values()) if fields is None else fields
+    postings = {field: dict() for field in fields}
+    for row, product in enumerate(products):
+        for field in fields:
+            for value in field_values(product, field):
+                rows = postings[field].setdefault(value, [])
+                # Rows are visited in order, so only the last one can repeat
+                if not rows or rows[-1] != row:
+                    rows.append(row)
+    return postings
+
+
+class ProductIndex:
+    """
+    Lookups of products by attribute, category or query.
+
+    Arguments:
+    all_products (`Sequence`) -- products, as returned by `load_products`
+    postings (`dict`) -- field -> (value -> ascending rows of `all_products`)
+    """
+    def __init__(self, all_products, postings):
+        self.all_products = all_products
+        self.postings = postings
+        self.attribute_to_asins = AttributeToAsins(self)
+
+    def rows(self, field, value):
+        return self.postings[field].get(value, [])
+
+    def asin(self, row):
+        return self.all_products[row]['asin']
+
+    def products(self, field, value):
+        """Products whose `field` has `value`, in `all_products` order"""
+        return [self.all_products[row] for row in self.rows(field, value)]
+
+    def values(self, field):
+        """Indexed values of `field`"""
+        return self.postings[field].keys()
+
+    def search(self, keywords):
+        """Products for `<a>`, `<c>` or `<q>` search keywords"""
+        field = INDEX_FIELDS[keywords[0]]
+        if field == 'category':
+            value = keywords[1].strip()
+        else:
+            value = ' '.join(keywords[1:]).strip()
+        return self.products(field, value)
+
+
+class AttributeToAsins(Mapping):
+    """`attribute_to_asins` view of a `ProductIndex`; unknown attributes map to an empty set"""
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, attribute):
+        return {self.index.asin(row) for row in self.index.rows('Attributes', attribute)}
+
+    def __contains__(self, attribute):
+        return len(self.index.rows('Attributes', attribute)) > 0
+
+    def __iter__(self):
+        return (a for a in self.index.values('Attributes') if a in self)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def product_image_url(product):
+    """Image url of a product, as mapped by `url2asin`: the first non-empty of the first two images"""
+    images = product.get('images')
+    if not images:
+        return None
+    url = images[0]
+    if len(url) == 0 and len(images) > 1:
+        url = images[1]
+    return url
+
+
+class ProductLookups:
+    """
+    Mappings from page contents back to products. On duplicates the last
+    product wins, as when the dicts are built in `all_products` order.
+
+    Arguments:
+    url2asin (`Mapping`) -- image url -> upper-case asin
+    asin2name (`Mapping`) -- lower-case asin -> lower-case title
+    name2asin (`Mapping`) -- lower-case title -> lower-case asin
+    """
+    def __init__(self, url2asin, asin2name, name2asin):
+        self.url2asin = url2asin
+        self.asin2name = asin2name
+        self.name2asin = name2asin
+
+    @classmethod
+    def from_products(cls, products):
+        url2asin, asin2name = dict(), dict()
+        for product in products:
+            url = product_image_url(product)
+            if url is not None:
+                url2asin[url] = product['asin'].upper()
+            asin2name[product['asin'].lower()] = product['Title'].lower()
+        name2asin = {name: asin for asin, name in asin2name.items()}
+        return cls(url2asin, asin2name, name2asin)
@@ -0,0 +1,226 @@
+"""
+Structured page model of a rendered WebShop page.
+
+`WebAgentTextEnv` normally re-parses the page HTML with BeautifulSoup every
+time it needs the observation text, the clickables, the product image or the
+instruction. In structured mode `SimServer` builds a `PageModel` right after
+rendering a page, with a single pass of the standard library tokenizer (no
+parse tree), and the env reads everything from it.
+
+The pass reproduces what BeautifulSoup's `html.parser` builder yields for the
+WebShop templates: text is split at every tag, whitespace-only strings outside
+of `<pre>` collapse to '\\n' or ' ', void elements never contain text and an
+end tag closes the most recent open tag of the same name (or nothing). This
+keeps observations byte-identical to the HTML path.
+"""
+from html.parser import HTMLParser
+
+# Same sets as BeautifulSoup's HTML tree builder
+VOID_ELEMENTS = {
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
+    'link', 'menuitem', 'meta', 'param', 'source', 'track', 'wbr',
+    'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+    'nextid', 'spacer',
+}
+PRESERVE_WHITESPACE = {'pre', 'textarea'}
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# Parents of strings that are not part of the observation, see `tag_visible`
+INVISIBLE_PARENTS = {'style', 'script', 'head', 'title', 'meta', '[document]'}
+ROOT = '[document]'
+
+PAGE_NAMES = ['search_results', 'item_page', 'item_sub_page', 'done']
+
+
+def page_type_of(url):
+    """Page name of `url`, same rule as `SimServer.get_page_name`"""
+    if url is None:
+        return None
+    for page_name in PAGE_NAMES:
+        if page_name in url:
+            return page_name
+    return ''  # index page
+
+
+class Element:
+    """Attributes and text of a page element, with the `Tag` accessors the env uses"""
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.text = ''
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def get_text(self):
+        return self.text
+
+    def __repr__(self):
+        return f'Element({self.name!r}, {self.attrs!r}, {self.text!r})'
+
+
+class Segment:
+    """A visible text string and the element it belongs to"""
+    __slots__ = ('text', 'parent', 'parent_class')
+
+    def __init__(self, text, parent, parent_class):
+        self.text = text
+        self.parent = parent
+        self.parent_class = parent_class
+
+
+class PageModel:
+    """
+    Everything the text env reads from a page.
+
+    Attributes:
+    page_type (`str`) -- '' (search page), 'search_results', 'item_page',
+        'item_sub_page' or 'done'
+    segments (`list`) -- visible text `Segment`s in document order
+    clickables (`dict`) -- clickable text -> `Element`, as `text_to_clickable`
+    has_search_bar (`bool`) -- whether the page has the search input
+    image_url (`str`) -- product image source, or `None`
+    instruction_text (`str`) -- instruction shown on the page, or `None`
+    """
+    def __init__(self, page_type, segments, clickables, has_search_bar,
+                 image_url, instruction_text):
+        self.page_type = page_type
+        self.segments = segments
+        self.clickables = clickables
+        self.has_search_bar = has_search_bar
+        self.image_url = image_url
+        self.instruction_text = instruction_text
+
+
+def build_page_model(html, url=None):
+    """Build the `PageModel` of a rendered page"""
+    parser = _PageParser()
+    parser.feed(html)
+    parser.close()
+
+    text_to_clickable = {
+        element.text.lower(): element
+        for element in parser.buttons + parser.product_links
+    }
+    for element in parser.radios:
+        text_to_clickable[f'{element.get("value")}'] = element
+
+    return PageModel(
+        page_type=page_type_of(url),
+        segments=parser.segments,
+        clickables=text_to_clickable,
+        has_search_bar=parser.has_search_bar,
+        image_url=parser.image_url,
+        instruction_text=parser.instruction_text,
+    )
+
+
+class _PageParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []  # open elements
+        self.data = []
+        self.segments = []
+        self.buttons = []
+        self.product_links = []
+        self.radios = []
+        self.has_search_bar = False
+        self.image_url = None
+        self.instruction_text = None
+        self.instruction_div = None  # open `#instruction-text` element
+        self.instruction_h4 = None
+
+    def flush(self):
+        """Emit buffered text as one string, like `BeautifulSoup.endData`"""
+        if not self.data:
+            return
+        text = ''.join(self.data)
+        self.data = []
+        if not any(e.name in PRESERVE_WHITESPACE for e in self.stack) and \
+                not text.strip(ASCII_SPACES):
+            text = '\n' if '\n' in text else ' '
+
+        # Text of every open element, e.g. button labels or the instruction
+        for element in self.stack:
+            element.text += text
+
+        parent = self.stack[-1] if self.stack else None
+        parent_name = parent.name if parent is not None else ROOT
+        if parent_name in INVISIBLE_PARENTS or text == '\n':
+            return
+        parent_class = parent.get('class') if parent is not None else None
+        self.segments.append(Segment(text, parent_name, parent_class))
+
+    def handle_starttag(self, tag, attrs):
+        self.flush()
+        attrs = {k: ('' if v is None else v) for k, v in attrs}
+        if 'class' in attrs:
+            attrs['class'] = attrs['class'].split()
+        element = Element(tag, attrs)
+
+        classes = attrs.get('class', [])
+        if 'btn' in classes:
+            self.buttons.append(element)
+        if 'product-link' in classes:
+            self.product_links.append(element)
+        if tag == 'input' and attrs.get('type') == 'radio':
+            self.radios.append(element)
+        element_id = attrs.get('id')
+        if element_id == 'search_input':
+            self.has_search_bar = True
+        elif element_id == 'product-image' and self.image_url is None:
+            self.image_url = attrs.get('src')
+        elif element_id == 'instruction-text' and self.instruction_text is None:
+            self.instruction_div = element
+        if tag == 'h4' and self.instruction_div is not None and \
+                self.instruction_h4 is None and self.instruction_div in self.stack:
+            self.instruction_h4 = element
+
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self.flush()
+        if not any(e.name == tag for e in self.stack):
+            return
+        while self.stack:
+            element = self.stack.pop()
+            self._closed(element)
+            if element.name == tag:
+                break
+
+    def _closed(self, element):
+        if element is self.instruction_h4:
+            self.instruction_text = element.text
+        if element is self.instruction_div:
+            self.instruction_div = None
+
+    def handle_data(self, data):
+        self.data.append(data)
+
+    def handle_comment(self, data):
+        self.flush()
+
+    def handle_decl(self, decl):
+        self.flush()
+
+    def handle_pi(self, data):
+        self.flush()
+
+    def unknown_decl(self, data):
+        self.flush()
+
+    def close(self):
+        super().close()
+        self.flush()
+        # Elements left open at the end of the document
+        while self.stack:
+            self._closed(self.stack.pop())
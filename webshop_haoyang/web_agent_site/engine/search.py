@@ -0,0 +1,281 @@
+"""
+Search backends for the `SimServer` keyword search.
+
+A backend answers `search(query, k)` with ranked hits that carry the product
+ASIN as `docid` and a `score`, the same interface as pyserini's
+`LuceneSearcher`, plus `search_many(queries, k)` to rank a batch of queries at
+once.
+
+`LuceneBackend` queries the prebuilt Lucene indexes under `search_engine/`
+(needs pyserini and a JVM). On the index built by `search_engine/build_index.py`
+it can restrict searches to the first rows of the catalog with a Lucene filter,
+so smaller catalogs do not need their own index.
+`BM25Searcher` builds a sparse BM25 index in memory from the same document
+text that `search_engine/build_index.py` indexes, so small catalogs and tests
+need neither Java nor an index directory. It follows Lucene's BM25 (k1=0.9, b=0.4, as in pyserini) with a
+simpler analyzer: lowercased word tokens minus Lucene's English stop words,
+without stemming, so rankings are close to but not the same as Lucene's.
+"""
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+BM25_K1 = 0.9
+BM25_B = 0.4
+LUCENE_THREADS = min(8, os.cpu_count() or 1)
+
+# Lucene `EnglishAnalyzer.ENGLISH_STOP_WORDS_SET`
+STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'if', 'in',
+    'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'such', 'that', 'the',
+    'their', 'then', 'there', 'these', 'they', 'this', 'to', 'was', 'will',
+    'with',
+}
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Written next to an index by `search_engine/build_index.py`: asin -> document hash
+MANIFEST_FILE = 'documents.manifest.json'
+# Indexed field holding the catalog row of each document, see `row_term`
+ROW_FIELD = 'row'
+ROW_DIGITS = 10
+# Row of documents whose product was removed from the catalog; outside every row filter
+REMOVED_ROW = 10 ** ROW_DIGITS - 1
+
+
+def product_document(product):
+    """Search document of a product: its ASIN and lowercased searchable text"""
+    option_texts = []
+    options = product.get('options', {})
+    for option_name, option_contents in options.items():
+        option_contents_text = ', '.join(option_contents)
+        option_texts.append(f'{option_name}: {option_contents_text}')
+    option_text = ', and '.join(option_texts)
+
+    return dict(
+        id=product['asin'],
+        contents=' '.join([
+            product['Title'],
+            product['Description'],
+            product['BulletPoints'][0],
+            option_text,
+        ]).lower(),
+    )
+
+
+def row_term(row):
+    """Indexed value of a catalog row, zero-padded so that term order is row order"""
+    return f'{row:0{ROW_DIGITS}d}'
+
+
+def index_document(product, row):
+    """`product_document` plus the catalog row that sub-catalog searches filter on"""
+    doc = product_document(product)
+    doc[ROW_FIELD] = row_term(row)
+    return doc
+
+
+def removed_document(asin):
+    """Replaces the document of a product removed from the catalog, so no row filter matches it"""
+    return {'id': asin, 'contents': asin.lower(), ROW_FIELD: row_term(REMOVED_ROW)}
+
+
+def document_hash(doc):
+    # Covers the row too, so documents that moved in the catalog are re-indexed
+    return hashlib.md5(json.dumps(doc, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def index_version(index_dir):
+    """
+    Latest Lucene commit of `index_dir` as '<segments file>.<mtime>', or `None`
+    if there is none. Every build and `build_index.py --update` writes a new
+    commit, so the version changes with the indexed documents.
+    """
+    try:
+        names = [name for name in os.listdir(index_dir) if name.startswith('segments_')]
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    # Lucene numbers commits in base 36
+    name = max(names, key=lambda name: int(name[len('segments_'):], 36))
+    return f'{name}.{os.stat(os.path.join(index_dir, name)).st_mtime_ns}'
+
+
+def has_manifest(index_dir):
+    return os.path.exists(os.path.join(index_dir, MANIFEST_FILE))
+
+
+def read_manifest(index_dir):
+    """Document hashes of an index built by `build_index.py`, or `None`"""
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(index_dir, manifest):
+    with open(os.path.join(index_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOP_WORDS]
+
+
+class SearchHit:
+    __slots__ = ('docid', 'score')
+
+    def __init__(self, docid, score):
+        self.docid = docid
+        self.score = score
+
+    def __repr__(self):
+        return f'SearchHit({self.docid!r}, {self.score:.4f})'
+
+
+class SearchBackend:
+    """Interface of the keyword search used by `SimServer`"""
+    def search(self, query, k=10):
+        """Top `k` hits for `query`, best first"""
+        raise NotImplementedError
+
+    def search_many(self, queries, k=10):
+        """Top `k` hits for each query"""
+        return [self.search(query, k=k) for query in queries]
+
+
+class LuceneBackend(SearchBackend):
+    """
+    Prebuilt pyserini/Lucene index; `search_many` runs `threads` queries in parallel.
+
+    With `num_rows`, only documents of the first `num_rows` catalog rows match:
+    each query gets a FILTER clause on the `row` field that `build_index.py`
+    indexes, so Lucene skips other documents while scoring. Term statistics
+    still come from the whole index. The filter is dropped when the index has
+    no documents beyond those rows, i.e. the catalog covers the whole index and
+    no removed products left placeholders.
+    """
+    def __init__(self, index_dir, threads=LUCENE_THREADS, num_rows=None):
+        from pyserini.search.lucene import LuceneSearcher
+        self.searcher = LuceneSearcher(index_dir)
+        self.threads = threads
+        if num_rows is not None and num_rows >= self.searcher.num_docs:
+            num_rows = None
+        self.num_rows = num_rows
+        if num_rows is not None:
+            from pyserini.analysis import get_lucene_analyzer
+            from pyserini.pyclass import autoclass
+            # Same bag-of-words query `LuceneSearcher.search` builds from a string
+            self.analyzer = get_lucene_analyzer()
+            self.query_generator = autoclass('io.anserini.search.query.BagOfWordsQueryGenerator')()
+            self.query_builder = autoclass('org.apache.lucene.search.BooleanQuery$Builder')
+            self.occur = autoclass('org.apache.lucene.search.BooleanClause$Occur')
+            self.row_filter = autoclass('org.apache.lucene.search.TermRangeQuery').newStringRange(
+                ROW_FIELD, row_term(0), row_term(max(num_rows - 1, 0)), True, True)
+            # `batch_search` only takes query strings, so filtered queries of a
+            # batch run on these threads; pyjnius releases the GIL in Lucene calls
+            self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def filtered_query(self, query):
+        builder = self.query_builder()
+        builder.add(self.query_generator.buildQuery('contents', self.analyzer, query), self.occur.MUST)
+        builder.add(self.row_filter, self.occur.FILTER)
+        return builder.build()
+
+    def search(self, query, k=10):
+        if self.num_rows is None:
+            return self.searcher.search(query, k=k)
+        if self.num_rows == 0:
+            return []
+        return self.searcher.search(self.filtered_query(query), k=k)
+
+    def search_many(self, queries, k=10):
+        if self.num_rows is not None:
+            return list(self.executor.map(lambda query: self.search(query, k=k), queries))
+        qids = [str(i) for i in range(len(queries))]
+        results = self.searcher.batch_search(list(queries), qids, k=k, threads=self.threads)
+        return [results[qid] for qid in qids]
+
+
+class BM25Searcher(SearchBackend):
+    """
+    In-memory BM25 over a sparse (term x document) weight matrix.
+
+    Arguments:
+    docids (`list`) -- id of each document, returned as `SearchHit.docid`
+    contents (`list`) -- text of each document
+    k1 (`float`), b (`float`) -- BM25 parameters
+    """
+    def __init__(self, docids, contents, k1=BM25_K1, b=BM25_B):
+        self.docids = list(docids)
+        self.vocab = dict()
+        rows, cols = [], []
+        for row, text in enumerate(contents):
+            for token in tokenize(text):
+                rows.append(row)
+                cols.append(self.vocab.setdefault(token, len(self.vocab)))
+        num_docs = len(self.docids)
+        tf = csr_matrix(
+            (np.ones(len(cols), dtype=np.float32), (rows, cols)),
+            shape=(num_docs, len(self.vocab)),
+        )
+        tf.sum_duplicates()
+
+        # Lucene BM25: idf * tf / (tf + k1 * (1 - b + b * dl / avgdl))
+        doc_len = np.asarray(tf.sum(axis=1)).ravel()
+        avg_doc_len = doc_len.mean() if num_docs else 1.0
+        df = np.bincount(tf.indices, minlength=len(self.vocab))
+        idf = np.log1p((num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = (k1 * (1 - b + b * doc_len / avg_doc_len)).astype(np.float32)
+        data = tf.data / (tf.data + np.repeat(norm, np.diff(tf.indptr))) * idf[tf.indices]
+        weights = csr_matrix((data.astype(np.float32), tf.indices, tf.indptr), shape=tf.shape)
+        # term -> documents, so a batch of queries is one sparse product
+        self.term_weights = weights.T.tocsr()
+
+    @classmethod
+    def from_products(cls, products, **kwargs):
+        docs = [product_document(p) for p in products]
+        return cls([d['id'] for d in docs], [d['contents'] for d in docs], **kwargs)
+
+    def query_matrix(self, queries):
+        """Sparse (query x term) counts; repeated terms count once per occurrence, as in Lucene"""
+        rows, cols = [], []
+        for row, query in enumerate(queries):
+            for token in tokenize(query):
+                col = self.vocab.get(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        return csr_matrix(
+            (np.ones(len(cols), dtype=np.float32), (rows, cols)),
+            shape=(len(queries), len(self.vocab)),
+        )
+
+    def search(self, query, k=10):
+        return self.search_many([query], k=k)[0]
+
+    def search_many(self, queries, k=10):
+        # One sparse product scores the whole batch; rows have no duplicate
+        # entries, only unsorted document indices, which `_top_k` does not need
+        scores = (self.query_matrix(queries) @ self.term_weights).tocsr()
+        results = []
+        for row in range(len(queries)):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            results.append(self._top_k(scores.data[start:end], scores.indices[start:end], k))
+        return results
+
+    def _top_k(self, data, docs, k):
+        if len(data) > k:
+            # Keep every document tied with the k-th best score before sorting
+            kth = np.partition(data, len(data) - k)[len(data) - k]
+            keep = data >= kth
+            data, docs = data[keep], docs[keep]
+        # Best score first, ties by document order as in Lucene
+        order = np.lexsort((docs, -data))[:k]
+        return [SearchHit(self.docids[doc], float(score)) for doc, score in zip(docs[order], data[order])]
@@ -0,0 +1,171 @@
+"""
+Shared-memory server state for running env workers in separate processes.
+
+A `SimServer` built in the parent process publishes its goal list, goal
+weights and sampled product prices into one `multiprocessing.shared_memory`
+segment. Worker processes attach to the segment by name and re-open the
+compiled product catalog (see `catalog.py`), which is a read-only mmap, so N
+workers share a single copy of both through the page cache.
+
+Segment layout (all offsets are stored in the header):
+
+    [8 byte header length][header JSON][goal offsets int64 (G + 1)]
+    [goal records (JSON)][goal weights float64 (G)][product prices float64 (N)]
+"""
+import json
+from collections.abc import Mapping, Sequence
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+HEADER_LEN_BYTES = 8
+
+
+def _align(n, alignment=8):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _tracker_pid():
+    """Pid of the resource tracker of the owning process, started if needed"""
+    resource_tracker.ensure_running()
+    return resource_tracker._resource_tracker._pid
+
+
+def _shares_tracker(owner_tracker_pid):
+    """
+    Whether this process reports to the owner's resource tracker. Forked
+    children inherit the tracker pid, spawned children only its pipe; a process
+    started outside of `multiprocessing` gets a tracker of its own.
+    """
+    tracker = resource_tracker._resource_tracker
+    pid, fd = getattr(tracker, '_pid', None), getattr(tracker, '_fd', None)
+    return pid == owner_tracker_pid or (pid is None and fd is not None)
+
+
+class SharedServerState:
+    """Goals + prices of a `SimServer`, backed by a named shared memory segment"""
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        buf = shm.buf
+        header_len = int.from_bytes(bytes(buf[:HEADER_LEN_BYTES]), 'little')
+        self.header = json.loads(bytes(buf[HEADER_LEN_BYTES:HEADER_LEN_BYTES + header_len]))
+
+        def array(name, length, dtype):
+            return np.ndarray((length,), dtype=dtype, buffer=buf, offset=self.header[name])
+
+        num_goals = self.header['num_goals']
+        self.goal_offsets = array('goal_offsets', num_goals + 1, np.int64)
+        self.weights = array('weights', num_goals, np.float64)
+        self.prices = array('prices', self.header['num_products'], np.float64)
+        self.goals = SharedGoals(self)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def meta(self):
+        """Arguments needed to rebuild the server in a worker"""
+        return self.header['meta']
+
+    @classmethod
+    def create(cls, goals, weights, prices, **meta):
+        """
+        Copy `goals`, their `weights` and the per-catalog-row `prices` into a
+        new shared memory segment. The creating process owns the segment and
+        should `unlink` it once all workers are done.
+        """
+        records = [json.dumps(goal).encode('utf-8') for goal in goals]
+        goal_offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        goal_offsets[1:] = np.cumsum([len(r) for r in records])
+
+        # Header size depends on the offsets it stores, so lay out with a fixed-width guess
+        header = dict(num_goals=len(goals), num_products=len(prices), meta=meta, tracker_pid=_tracker_pid())
+        layout_start = _align(HEADER_LEN_BYTES + len(json.dumps(dict(header, **{
+            'goal_offsets': 10 ** 15, 'records': 10 ** 15, 'weights': 10 ** 15, 'prices': 10 ** 15,
+        })).encode('utf-8')))
+        header['goal_offsets'] = layout_start
+        header['records'] = header['goal_offsets'] + goal_offsets.nbytes
+        header['weights'] = _align(header['records'] + int(goal_offsets[-1]))
+        header['prices'] = header['weights'] + 8 * len(goals)
+        size = header['prices'] + 8 * len(prices)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        header_bytes = json.dumps(header).encode('utf-8')
+        shm.buf[:HEADER_LEN_BYTES] = len(header_bytes).to_bytes(HEADER_LEN_BYTES, 'little')
+        shm.buf[HEADER_LEN_BYTES:HEADER_LEN_BYTES + len(header_bytes)] = header_bytes
+        pos = header['records']
+        for record in records:
+            shm.buf[pos:pos + len(record)] = record
+            pos += len(record)
+
+        state = cls(shm, owner=True)
+        state.goal_offsets[:] = goal_offsets
+        state.weights[:] = weights
+        state.prices[:] = prices
+        return state
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a segment created by another process"""
+        shm = shared_memory.SharedMemory(name=name)
+        state = cls(shm, owner=False)
+        # Only the owner may unlink; a tracker of our own would unlink the segment on exit
+        if not _shares_tracker(state.header['tracker_pid']):
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return state
+
+    def goal(self, idx):
+        start, end = int(self.goal_offsets[idx]), int(self.goal_offsets[idx + 1])
+        pos = self.header['records']
+        return json.loads(bytes(self.shm.buf[pos + start:pos + end]))
+
+    def close(self):
+        # Drop numpy views first, otherwise the buffer cannot be released
+        self.goal_offsets = self.weights = self.prices = None
+        self.shm.close()
+
+    def unlink(self):
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedGoals(Sequence):
+    """Lazy goal list; each access decodes a fresh copy of the goal"""
+    def __init__(self, state):
+        self.state = state
+
+    def __len__(self):
+        return self.state.header['num_goals']
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.state.goal(i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('goal index out of range')
+        return self.state.goal(idx)
+
+
+class SharedPrices(Mapping):
+    """`product_prices` view mapping asin -> price through the catalog row index"""
+    def __init__(self, catalog, prices):
+        self.catalog = catalog
+        self.prices = prices
+
+    def __getitem__(self, asin):
+        row = self.catalog.row_of(asin)
+        if row is None:
+            raise KeyError(asin)
+        return float(self.prices[row])
+
+    def __contains__(self, asin):
+        return self.catalog.row_of(asin) is not None
+
+    def __iter__(self):
+        return (self.catalog.asin(row) for row in range(len(self.catalog)))
+
+    def __len__(self):
+        return len(self.catalog)
@@ -12,14 +12,36 @@ from flask import Flask
 from web_agent_site.engine.engine import (
     load_products,
     init_search_engine,
+    get_search_index_name,
     get_top_n_product_from_keywords,
+    search_asins_many,
+    search_cache,
+    SPECIAL_SEARCH_MODES,
+    SEARCH_RETURN_N,
     map_action_to_html,
+    set_url_map,
     parse_action,
     get_product_per_page,
     ACTION_TO_TEMPLATE,
     END_BUTTON, NEXT_PAGE, PREV_PAGE, BACK_TO_SEARCH,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.catalog import (
+    CatalogProductDict,
+    CatalogProducts,
+    ProductCatalog,
+)
+from web_agent_site.engine.features import FeatureStore, load_feature_store
+from web_agent_site.engine.goal import (
+    add_noun_table,
+    clear_product_caches,
+    get_reward,
+    get_goals,
+    init_noun_table,
+    set_noun_backend,
+)
+from web_agent_site.engine.index import ProductLookups
+from web_agent_site.engine.page import Segment, build_page_model
+from web_agent_site.engine.shared import SharedPrices, SharedServerState
 from web_agent_site.utils import (
     DEFAULT_FILE_PATH,
     FEAT_CONV,
@@ -51,6 +73,8 @@ class WebAgentTextEnv(gym.Env):
 
         Arguments:
         observation_mode (`str`) -- ['html' | 'text'] (default 'html')
+        feat_conv (`FeatureStore`) -- image features for `get_image` (default: the store
+            of FEAT_CONV, see `engine/features.py`); a tensor of FEAT_CONV also works
         get_image
         filter_goals
         limit_goals
@@ -59,6 +83,13 @@ class WebAgentTextEnv(gym.Env):
         session
         session_prefix
         show_attrs
+        structured -- read observations from the server's page model instead of parsing HTML
+        html_parser -- BeautifulSoup parser for pages (default 'html.parser'); 'lxml' is
+            faster but does not give byte-identical text observations
+        noun_backend -- noun extraction for the type reward, see `set_noun_backend`
+            (default: full spaCy pipeline, loaded on first use)
+        search_cache_path -- JSON file to load search results from and save them to on close
+        search_backend -- 'lucene' (default), 'bm25', 'dense' or 'hybrid', see `init_search_engine`
         """
         super(WebAgentTextEnv, self).__init__()
         self.observation_mode = observation_mode
@@ -67,9 +98,11 @@ class WebAgentTextEnv(gym.Env):
         self.file_path = file_path
 
         # Newly added: keep a (url -> asin) mapping so it's easier to find the product image when training
+        # (default: `SimServer.lookups.url2asin`)
         self.url2asin = url2asin
 
-        # print("url2asin Loaded")
+        if self.kwargs.get('noun_backend') is not None:
+            set_noun_backend(self.kwargs['noun_backend'])
 
         self.base_url = 'http://127.0.0.1:3000'
         self.server = SimServer(
@@ -80,30 +113,45 @@ class WebAgentTextEnv(gym.Env):
             self.kwargs.get('num_products'),
             self.kwargs.get('human_goals'),
             self.kwargs.get('show_attrs', False),
+            shared_name=self.kwargs.get('shared_name'),
+            search_cache_path=self.kwargs.get('search_cache_path'),
+            search_backend=self.kwargs.get('search_backend', 'lucene'),
         ) if server is None else server
 
         # print("SIMSERVER LOADED")
 
-        self.browser = SimBrowser(self.server)
+        self.browser = SimBrowser(self.server, structured=self.kwargs.get('structured', False))
 
         # print("LINE 94")
 
         self.session = self.kwargs.get('session')
         self.session_prefix = self.kwargs.get('session_prefix')
+        self.feature_store = None
         if self.kwargs.get('get_image', 0):
-            # memory_info = psutil.Process().memory_info()
-            # print(f"TORCH before, RSS: {memory_info.rss / (1024 * 1024):.2f} MB")
-            self.feats = feat_conv
-            # self.feats = torch.load(FEAT_CONV)
-            # memory_info = psutil.Process().memory_info()
-            # print(f"TORCH after, RSS: {memory_info.rss / (1024 * 1024):.2f} MB")
-            self.ids = torch.load(FEAT_IDS)
-            self.ids = {url: idx for idx, url in enumerate(self.ids)}
+            if feat_conv is None or isinstance(feat_conv, FeatureStore):
+                # Memory-mapped features shared by all env processes
+                self.feature_store = feat_conv if feat_conv is not None else load_feature_store()
+            else:
+                # A features tensor loaded from FEAT_CONV, rows listed in FEAT_IDS
+                self.feats = feat_conv
+                self.ids = torch.load(FEAT_IDS)
+                self.ids = {url: idx for idx, url in enumerate(self.ids)}
         # print("LINE 109")
         self.prev_obs = []
         self.prev_actions = []
         self.num_prev_obs = self.kwargs.get('num_prev_obs', 0)
         self.num_prev_actions = self.kwargs.get('num_prev_actions', 0)
+
+        # Last parsed page, shared by every reader of the current page
+        self.html_parser = self.kwargs.get('html_parser', 'html.parser')
+        self.parsed_html = None
+        self.parsed_obj = None
+        self.num_parses = 0
+        self.num_steps = 0
+        # Available actions of the page they were computed for, until the page changes
+        self.actions_html = None
+        self.available_actions = None
+        self.actions_clickables = None
         self.reset()
 
     def step(self, action):
@@ -117,6 +165,7 @@ class WebAgentTextEnv(gym.Env):
         If action not valid, perform nothing.
         """
         info = None
+        self.num_steps += 1
         self.get_available_actions()
 
         # Determine action type (click, search) and argument
@@ -149,6 +198,25 @@ class WebAgentTextEnv(gym.Env):
 
     def get_available_actions(self):
         """Returns list of available actions at the current step"""
+        html = self.browser.page_source
+        if self.available_actions is not None and \
+                (html is self.actions_html or html == self.actions_html):
+            self.text_to_clickable = self.actions_clickables
+            return self.available_actions
+        self.available_actions = self._get_available_actions()
+        self.actions_html = html
+        self.actions_clickables = self.text_to_clickable
+        return self.available_actions
+
+    def _get_available_actions(self):
+        page = self.browser.page
+        if page is not None:
+            self.text_to_clickable = dict(page.clickables)
+            return dict(
+                has_search_bar=page.has_search_bar,
+                clickables=list(self.text_to_clickable.keys()),
+            )
+
         html_obj = self._parse_html()
 
         # Collect search bar, buttons, links, and options as clickables
@@ -173,34 +241,37 @@ class WebAgentTextEnv(gym.Env):
     def parse_html(self, html=None):
         return self._parse_html(html=html)
     
+    def get_image_url(self):
+        """Source of the product image on the current page, or `None`"""
+        if self.browser.page is not None:
+            return self.browser.page.image_url
+        html_obj = self._parse_html(self.browser.page_source)
+        image = html_obj.find(id='product-image')
+        return image['src'] if image is not None else None
+
     def get_image(self):
         """Scrape image from page HTML and return as a list of pixel values"""
-        html_obj = self._parse_html(self.browser.page_source)
-        # print(type(html_obj))
-        # print("HTML_OBJ: {}".format(html_obj))
-        image_url = html_obj.find(id='product-image')
+        image_url = self.get_image_url()
         if image_url is not None:
-            # print("line 153")
-            image_url = image_url['src']
-            if image_url in self.ids:
-                # print("line 156")
+            if self.feature_store is not None:
+                image = self.feature_store.get(image_url)
+                if image is not None:
+                    return image
+            elif image_url in self.ids:
                 image_idx = self.ids[image_url]
                 image = self.feats[image_idx]
                 return image
-        # print("line 160")
         return torch.zeros(512)
     
     # Newly added: get the cached raw image instead of its ResNEt embedding
     # Returns a PIL.Image object
     def get_raw_image(self):
-        html_obj = self._parse_html(self.browser.page_source)
-        image_url = html_obj.find(id='product-image')
+        image_url = self.get_image_url()
         if image_url is None:
-            # print(html_obj)
             return "none"
-        image_url = image_url['src']
+        url2asin = self.url2asin if self.url2asin is not None else self.server.lookups.url2asin
         try: # just in case the image doesn't exist due to some strange reasons
-            asin = self.url2asin[image_url]
+            asin = url2asin[image_url]
         except:
             print("ASIN not found: " + image_url)
             return "none"
@@ -214,6 +285,8 @@ class WebAgentTextEnv(gym.Env):
 
     def get_instruction_text(self):
         """Get corresponding instruction text for current environment session"""
+        if self.browser.page is not None:
+            return self.browser.page.instruction_text
         html_obj = self._parse_html(self.browser.page_source)
         instruction_text = html_obj.find(id='instruction-text').h4.text
         return instruction_text
@@ -228,8 +301,16 @@ class WebAgentTextEnv(gym.Env):
         """
         if html is None:
             html = self.state['html']
-        html_obj = BeautifulSoup(html, 'html.parser')
-        return html_obj
+        if html is not self.parsed_html and html != self.parsed_html:
+            self.parsed_obj = BeautifulSoup(html, self.html_parser)
+            self.parsed_html = html
+            self.num_parses += 1
+        return self.parsed_obj
+
+    @property
+    def parses_per_step(self):
+        """Average number of HTML parses per `step`, including the readers after it"""
+        return self.num_parses / max(self.num_steps, 1)
     
     @property
     def observation(self):
@@ -238,8 +319,12 @@ class WebAgentTextEnv(gym.Env):
         if self.observation_mode == 'html':
             return html
         elif self.observation_mode == 'text':
+            if self.browser.page is not None:
+                return self.convert_segments_to_text(self.browser.page.segments, simple=True)
             return self.convert_html_to_text(html, simple=True)
         elif self.observation_mode == 'text_rich':
+            if self.browser.page is not None:
+                return self.convert_segments_to_text(self.browser.page.segments, simple=False)
             return self.convert_html_to_text(html, simple=False)
         elif self.observation_mode == 'url':
             return self.state['url']
@@ -263,24 +348,31 @@ class WebAgentTextEnv(gym.Env):
     def convert_html_to_text(self, html, simple=False):
         """Strip HTML of tags and add separators to convert observation into simple mode"""
         texts = self._parse_html(html).findAll(text=True)
-        visible_texts = filter(tag_visible, texts)
+        segments = [
+            Segment(str(t), t.parent.name, t.parent.get('class'))
+            for t in filter(tag_visible, texts) if t != '\n'
+        ]
+        return self.convert_segments_to_text(segments, simple=simple)
+
+    def convert_segments_to_text(self, segments, simple=False):
+        """Join the visible text `Segment`s of a page into a `text` or `text_rich` observation"""
         if simple:
             # For `simple` mode, return just [SEP] separators
-            return ' [SEP] '.join(t.strip() for t in visible_texts if t != '\n')
+            return ' [SEP] '.join(s.text.strip() for s in segments)
         else:
             # Otherwise, return an observation with tags mapped to specific, unique separators
             observation = ''
-            for t in visible_texts:
-                if t == '\n': continue
-                if t.parent.name == 'button':  # button
+            for s in segments:
+                t = s.text
+                if s.parent == 'button':  # button
                     processed_t = f'[button] {t} [button_]'
-                elif t.parent.name == 'label':  # options
+                elif s.parent == 'label':  # options
                     if f'"{t}"' in self.state['url']:
                         processed_t = f'  [clicked button] {t} [clicked button_]'
                         observation = f'You have clicked {t}.\n' + observation
                     else:
                         processed_t = f'  [button] {t} [button_]'
-                elif t.parent.get('class') == ["product-link"]: # product asins
+                elif s.parent_class == ["product-link"]: # product asins
                     if f'{t}' in self.server.user_sessions[self.session]['asins']:
                         processed_t = f'\n[clicked button] {t} [clicked button_]'
                     else:
@@ -358,6 +450,7 @@ class WebAgentTextEnvBase(gym.Env):
             self.kwargs.get('num_products'),
             self.kwargs.get('human_goals'),
             self.kwargs.get('show_attrs', False),
+            shared_name=self.kwargs.get('shared_name'),
         ) if server is None else server
         self.browser = SimBrowser(self.server)
 
@@ -574,6 +667,9 @@ class SimServer:
         num_products=None,
         human_goals=0,
         show_attrs=False,
+        shared_name=None,
+        search_cache_path=None,
+        search_backend='lucene',
     ):
         """
         Constructor for simulated server serving WebShop application
@@ -583,16 +679,60 @@ class SimServer:
         limit_goals (`int`) -- Limit to number of goals available
         num_products (`int`) -- Number of products to search across
         human_goals (`bool`) -- If true, load human goals; otherwise, load synthetic goals
+        shared_name (`str`) -- If set, attach to the catalog and goals published by `share()`
+            in another process instead of loading them (other loading arguments are ignored)
+        search_cache_path (`str`) -- If set, load cached search results from this file and
+            save them back on `close()`
+        search_backend (`str`) -- 'lucene' for the prebuilt index, 'bm25' to index the
+            loaded products in memory, 'dense' for embedding search or 'hybrid' for
+            both 'lucene' and 'dense', see `init_search_engine`
         """
-        # Load all products, goals, and search engine
         self.base_url = base_url
-        self.all_products, self.product_item_dict, self.product_prices, _ = \
+        self.show_attrs = show_attrs
+        self.shared = None
+        self.search_backend = search_backend
+        self._lookups = None
+        if shared_name is not None:
+            self._attach_shared(shared_name)
+        else:
+            self._load(file_path, filter_goals, limit_goals, num_products, human_goals)
+
+        # Set extraneous housekeeping variables
+        self.weights = [goal['weight'] for goal in self.goals] \
+            if self.shared is None else self.shared.weights.tolist()
+        self.cum_weights = [0]
+        for w in self.weights:
+            self.cum_weights.append(self.cum_weights[-1] + w)
+        self.user_sessions = dict()
+        self.search_time = 0
+        self.render_time = 0
+        self.sample_time = 0
+        self.assigned_instruction_text = None  # TODO: very hacky, should remove
+
+        # Lucene results are cached process-wide, optionally across runs
+        self.search_cache_path = search_cache_path
+        if search_cache_path is not None:
+            search_cache.load(search_cache_path)
+
+        # Rewards cached for another catalog or goal set in this process are stale
+        clear_product_caches()
+
+        # Noun tokens for the type reward: the precomputed table, plus the goal
+        # names the parent parsed in `share()`; other names are parsed on first use
+        init_noun_table()
+        if self.shared is not None:
+            add_noun_table(self.shared.meta.get('goal_nouns') or {})
+
+    def _load(self, file_path, filter_goals, limit_goals, num_products, human_goals):
+        # Load all products, goals, and search engine
+        self.all_products, self.product_item_dict, self.product_prices, self.product_index = \
             load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
         # print("FILE_PATH")
         # print(file_path)
-        self.search_engine = init_search_engine(num_products=num_products)
+        self.search_engine = init_search_engine(
+            num_products, self.search_backend, self.all_products, self.product_item_dict)
+        self.search_index = get_search_index_name(num_products, self.search_backend, self.product_item_dict)
         self.goals = get_goals(self.all_products, self.product_prices, human_goals)
-        self.show_attrs = show_attrs
 
         # print("ALL_PRODUCTS")
         # print(len(self.all_products))
@@ -627,17 +767,124 @@ class SimServer:
             self.goals = [self.goals[i] for i in idxs]
         print(f'Loaded {len(self.goals)} goals.')
 
-        # Set extraneous housekeeping variables
-        self.weights = [goal['weight'] for goal in self.goals]
-        self.cum_weights = [0]
-        for w in self.weights:
-            self.cum_weights.append(self.cum_weights[-1] + w)
-        self.user_sessions = dict()
-        self.search_time = 0
-        self.render_time = 0
-        self.sample_time = 0
-        self.assigned_instruction_text = None  # TODO: very hacky, should remove
-        
+    def _attach_shared(self, shared_name):
+        """Rebuild server state from a segment published by `share()`"""
+        self.shared = SharedServerState.attach(shared_name)
+        meta = self.shared.meta
+        catalog = ProductCatalog(
+            meta['catalog_dir'],
+            num_products=meta['num_products'],
+            human_goals=meta['human_goals'],
+        )
+        self.all_products = CatalogProducts(catalog)
+        self.product_item_dict = CatalogProductDict(catalog)
+        self.product_prices = SharedPrices(catalog, self.shared.prices)
+        self.product_index = catalog.product_index()
+        self.search_engine = init_search_engine(
+            meta['num_products'], self.search_backend, self.all_products, self.product_item_dict)
+        self.search_index = get_search_index_name(meta['num_products'], self.search_backend, self.product_item_dict)
+        self.goals = self.shared.goals
+
+    def share(self):
+        """
+        Publish goals and product prices to shared memory so that worker
+        processes can construct `SimServer(..., shared_name=name)` and share
+        this server's product table instead of loading their own copy.
+        Requires the compiled product catalog. Returns the segment name.
+        """
+        if not isinstance(self.product_item_dict, CatalogProductDict):
+            raise ValueError(
+                'Shared mode requires a compiled product catalog, '
+                'run `python -m web_agent_site.engine.catalog` first.'
+            )
+        if self.shared is None:
+            catalog = self.product_item_dict.catalog
+            # `product_prices` of a catalog is filled in catalog row order
+            prices = list(self.product_prices.values())
+            assert len(prices) == len(catalog)
+            self.shared = SharedServerState.create(
+                self.goals,
+                self.weights,
+                prices,
+                catalog_dir=catalog.catalog_dir,
+                num_products=catalog.num_products,
+                human_goals=catalog.human_goals,
+                # Goal names are parsed once here instead of in every worker
+                goal_nouns=init_noun_table(self.goals),
+            )
+        return self.shared.name
+
+    def search_many(self, keywords_list, k=SEARCH_RETURN_N):
+        """
+        Products found for each keyword list, as a search action would rank them,
+        resolved with one batched call to the search backend.
+
+        Arguments:
+        keywords_list (`list`) -- keyword lists (or query strings), e.g. for all
+            candidate queries of many goals
+        k (`int`) -- number of results per keyword query; `<r>`, `<a>`, `<c>` and `<q>`
+            searches return the same products as a search action
+        """
+        keywords_list = [
+            keywords.split(' ') if isinstance(keywords, str) else keywords
+            for keywords in keywords_list
+        ]
+        keyword_idxs = [
+            i for i, keywords in enumerate(keywords_list) if keywords[0] not in SPECIAL_SEARCH_MODES
+        ]
+        top_n_asins = search_asins_many(
+            self.search_engine,
+            [keywords_list[i] for i in keyword_idxs],
+            k=k,
+            search_index=self.search_index,
+        )
+        results = [None] * len(keywords_list)
+        for i, asins in zip(keyword_idxs, top_n_asins):
+            results[i] = [self.product_item_dict[asin] for asin in asins if asin in self.product_item_dict]
+        for i, keywords in enumerate(keywords_list):
+            if results[i] is None:
+                results[i] = get_top_n_product_from_keywords(
+                    keywords,
+                    self.search_engine,
+                    self.all_products,
+                    self.product_item_dict,
+                    self.product_index,
+                    self.search_index,
+                )
+        return results
+
+    @property
+    def lookups(self):
+        """
+        `ProductLookups` (image url -> asin, asin <-> name) of the loaded products,
+        served from the compiled catalog when there is one
+        """
+        if self._lookups is None:
+            if isinstance(self.product_item_dict, CatalogProductDict):
+                self._lookups = self.product_item_dict.catalog.lookups()
+            else:
+                self._lookups = ProductLookups.from_products(self.all_products)
+        return self._lookups
+
+    def search_cache_info(self):
+        """Hits, misses and size of the process-wide search result cache"""
+        return search_cache.info()
+
+    def save_search_cache(self):
+        if self.search_cache_path is not None:
+            search_cache.save(self.search_cache_path)
+
+    def close(self):
+        """
+        Save the search cache if `search_cache_path` is set and detach from shared
+        memory, removing the segment if this server created it
+        """
+        self.save_search_cache()
+        if self.shared is not None:
+            self.shared.unlink()
+            self.shared.close()
+            self.shared = None
+
     @app.route('/', methods=['GET', 'POST'])
     def index(self, session_id, **kwargs):
         """Redirect to the search page with the given session ID"""
@@ -669,6 +916,8 @@ class SimServer:
             self.search_engine,
             self.all_products,
             self.product_item_dict,
+            self.product_index,
+            self.search_index,
         )
         self.search_time += time.time() - old_time
         
@@ -809,88 +1058,92 @@ class SimServer:
         """Map action to the corresponding page"""
         status = dict(reward=0.0, done=False)
 
-        with app.app_context(), app.test_request_context():
-            # Create/determine goal, instruction_text from current session
-            if session_id not in self.user_sessions:
-                idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
-                # print("len(goals)={}".format(len(self.goals)))
-                goal = self.goals[idx]
-                instruction_text = goal['instruction_text']
-                self.user_sessions[session_id] = {'goal': goal, 'done': False}
-            else:
-                instruction_text = \
-                    self.user_sessions[session_id]['goal']['instruction_text']
-            if self.assigned_instruction_text is not None:
-                instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
-                self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
-            session = self.user_sessions[session_id]
-
-            if not kwargs:
-                # If no action, reset the session variables
-                kwargs['instruction_text'] = instruction_text
-                html, url = self.index(session_id, **kwargs)
-                self.user_sessions[session_id].update(
-                    {
-                        'keywords': None,
-                        'page': None,
-                        'asin': None,
-                        'asins': set(),
-                        'options': dict(),
-                        'actions': defaultdict(int)
-                    }
+        # Create/determine goal, instruction_text from current session
+        if session_id not in self.user_sessions:
+            idx = session_int if (session_int is not None and isinstance(session_int, int)) else random_idx(self.cum_weights) 
+            # print("len(goals)={}".format(len(self.goals)))
+            goal = self.goals[idx]
+            instruction_text = goal['instruction_text']
+            self.user_sessions[session_id] = {'goal': goal, 'done': False}
+        else:
+            instruction_text = \
+                self.user_sessions[session_id]['goal']['instruction_text']
+        if self.assigned_instruction_text is not None:
+            instruction_text = self.assigned_instruction_text  # TODO: very hacky, should remove
+            self.user_sessions[session_id]['goal']['instruction_text'] = instruction_text
+        session = self.user_sessions[session_id]
+
+        if not kwargs:
+            # If no action, reset the session variables
+            kwargs['instruction_text'] = instruction_text
+            html, url = self.index(session_id, **kwargs)
+            self.user_sessions[session_id].update(
+                {
+                    'keywords': None,
+                    'page': None,
+                    'asin': None,
+                    'asins': set(),
+                    'options': dict(),
+                    'actions': defaultdict(int)
+                }
+            )
+        elif 'keywords' in kwargs:
+            # If search keywords are available, run a search
+            html, url = self.search_results(session_id, **kwargs)
+        elif 'clickable_name' in kwargs:
+            clickable_name = kwargs['clickable_name'].lower()
+            if clickable_name == END_BUTTON.lower():
+                # If "buy now" clicked, calculate reward and flag session as terminated
+                html, url, reward = self.done(session_id, **kwargs)
+                status['reward'] = reward
+                status['done'] = True
+            elif clickable_name == BACK_TO_SEARCH.lower():
+                # If "back to search" clicked, recursively reset the session back to search page
+                html, url, status = self.receive(session_id, current_url)
+            elif (clickable_name == NEXT_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "next page" clicked from search results, re-render with `page` enumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] + 1,
                 )
-            elif 'keywords' in kwargs:
-                # If search keywords are available, run a search
-                html, url = self.search_results(session_id, **kwargs)
-            elif 'clickable_name' in kwargs:
-                clickable_name = kwargs['clickable_name'].lower()
-                if clickable_name == END_BUTTON.lower():
-                    # If "buy now" clicked, calculate reward and flag session as terminated
-                    html, url, reward = self.done(session_id, **kwargs)
-                    status['reward'] = reward
-                    status['done'] = True
-                elif clickable_name == BACK_TO_SEARCH.lower():
-                    # If "back to search" clicked, recursively reset the session back to search page
-                    html, url, status = self.receive(session_id, current_url)
-                elif (clickable_name == NEXT_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "next page" clicked from search results, re-render with `page` enumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] + 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'search_results'):
-                    # If "prev page" clicked from search results, re-render with `page` denumerated
-                    html, url, status = self.receive(
-                        session_id,
-                        current_url,
-                        keywords=session["keywords"],
-                        page=session["page"] - 1,
-                    )
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_sub_page'):
-                    # If "prev page" clicked from sub page, return to corresponding item page
-                    html, url = self.item_page(session_id, **kwargs)
-                elif (clickable_name == PREV_PAGE.lower() and 
-                      self.get_page_name(current_url) == 'item_page'):
-                    # If "prev page" clicked from item page, return to search results page
-                    html, url = self.search_results(
-                        session_id,
-                        keywords=session["keywords"],
-                        page=session["page"],
-                        **kwargs
-                    )
-                elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
-                    # Render item_sub_page if clickable is description, features, or reviews
-                    html, url = self.item_sub_page(session_id, **kwargs)
-                else:
-                    # Otherwise, render current item page
-                    html, url = self.item_page(session_id, **kwargs)
-            return html, url, status
-    
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'search_results'):
+                # If "prev page" clicked from search results, re-render with `page` denumerated
+                html, url, status = self.receive(
+                    session_id,
+                    current_url,
+                    keywords=session["keywords"],
+                    page=session["page"] - 1,
+                )
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_sub_page'):
+                # If "prev page" clicked from sub page, return to corresponding item page
+                html, url = self.item_page(session_id, **kwargs)
+            elif (clickable_name == PREV_PAGE.lower() and 
+                  self.get_page_name(current_url) == 'item_page'):
+                # If "prev page" clicked from item page, return to search results page
+                html, url = self.search_results(
+                    session_id,
+                    keywords=session["keywords"],
+                    page=session["page"],
+                    **kwargs
+                )
+            elif clickable_name in [k.lower() for k in ACTION_TO_TEMPLATE]:
+                # Render item_sub_page if clickable is description, features, or reviews
+                html, url = self.item_sub_page(session_id, **kwargs)
+            else:
+                # Otherwise, render current item page
+                html, url = self.item_page(session_id, **kwargs)
+        return html, url, status
+
+    def receive_page(self, session_id, current_url, session_int=None, **kwargs):
+        """Same as `receive`, but also returns the `PageModel` of the rendered page"""
+        html, url, status = self.receive(session_id, current_url, session_int=session_int, **kwargs)
+        return html, url, status, build_page_model(html, url)
+
     def get_page_name(self, url):
         """Determine which page (i.e. item_page, search_results) the given URL is pointing at"""
         if url is None:
@@ -907,25 +1160,38 @@ class SimServer:
         return ''  # index page
 
 
+# Pages are rendered without a Flask request, links are built from the routes above
+set_url_map(app.url_map)
+
+
 class SimBrowser:
     """Simulated browser for rendering the HTML source of WebShop environment pages"""
-    def __init__(self, server):
+    def __init__(self, server, structured=False):
         self.server = server
+        self.structured = structured
         self.current_url = None
         self.page_source = None
+        self.page = None  # `PageModel` of the current page in structured mode
         self.session_id = None
 
+    def _receive(self, *args, **kwargs):
+        if self.structured:
+            html, url, status, self.page = self.server.receive_page(*args, **kwargs)
+        else:
+            html, url, status = self.server.receive(*args, **kwargs)
+        return html, url, status
+
     def get(self, url, session_id=None, session_int=None):
         """Set browser variables to corresponding link, page HTML for URL"""
         self.session_id = url.split('/')[-1] if session_id is None else session_id
         self.page_source, _, _ = \
-            self.server.receive(self.session_id, self.current_url, session_int=session_int)
+            self._receive(self.session_id, self.current_url, session_int=session_int)
         self.current_url = url
     
     def click(self, clickable_name, text_to_clickable):
         """Wrapper for `receive` handler for performing click action on current page"""
         self.page_source, self.current_url, status = \
-            self.server.receive(
+            self._receive(
                 self.session_id,
                 current_url=self.current_url,
                 clickable_name=clickable_name,
@@ -938,7 +1204,7 @@ class SimBrowser:
         if isinstance(keywords, str):
             keywords = keywords.split(' ')
         self.page_source, self.current_url, status = \
-            self.server.receive(
+            self._receive(
                 self.session_id,
                 current_url=self.current_url,
                 keywords=keywords,
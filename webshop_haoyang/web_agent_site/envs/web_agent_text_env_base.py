@@ -19,7 +19,7 @@ from web_agent_site.engine.engine import (
     ACTION_TO_TEMPLATE,
     END_BUTTON, NEXT_PAGE, PREV_PAGE, BACK_TO_SEARCH,
 )
-from web_agent_site.engine.goal import get_reward, get_goals
+from web_agent_site.engine.goal import clear_product_caches, get_reward, get_goals
 from web_agent_site.utils import (
     DEFAULT_FILE_PATH,
     FEAT_CONV,
@@ -297,8 +297,10 @@ class SimServer:
         self.base_url = base_url
         self.all_products, self.product_item_dict, self.product_prices, _ = \
             load_products(filepath=file_path, num_products=num_products, human_goals=human_goals)
-        self.search_engine = init_search_engine(num_products=num_products)
+        self.search_engine = init_search_engine(num_products=num_products, product_item_dict=self.product_item_dict)
         self.goals = get_goals(self.all_products, self.product_prices, human_goals)
+        # Rewards cached for another catalog or goal set in this process are stale
+        clear_product_caches()
         self.show_attrs = show_attrs
 
         # Fix outcome for random shuffling of goals
@@ -15,10 +15,15 @@ DEFAULT_REVIEW_PATH = join(BASE_DIR, '../data/reviews.json')
 
 FEAT_CONV = join(BASE_DIR, '../data/feat_conv.pt')
 FEAT_IDS = join(BASE_DIR, '../data/feat_ids.pt')
+# Memory-mapped copy of FEAT_CONV/FEAT_IDS, see `engine/features.py`
+FEAT_STORE_DIR = join(BASE_DIR, '../data/feat_store')
 
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
 HUMAN_ATTR_PATH = join(BASE_DIR, '../data/items_human_ins.json')
 
+# Optional precomputed noun tokens of product names, see `engine/goal.py`
+DEFAULT_NOUN_TABLE_PATH = join(BASE_DIR, '../data/items_nouns.json')
+
 def random_idx(cum_weights):
     """Generate random index by sampling uniformly from sum of all weights, then
     selecting the `min` between the position to keep the list sorted (via bisect)